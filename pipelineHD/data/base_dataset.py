@@ -1,4 +1,5 @@
 from __future__ import division, print_function
+import torch
 import torch.utils.data as data
 import numpy as np
 from PIL import Image
@@ -21,34 +22,76 @@ class BaseDataset(data.Dataset):
 #####################################
 # Image Transform Modules
 #####################################
+# exp(-t) rounds to 0 in float32 for t > 104, so gaussian heatmaps are only rendered within this (squared, in units of
+# radius^2) distance of a keypoint along each axis; the output is identical to evaluating them everywhere.
+GAUSSIAN_WINDOW = 104
+
+def draw_keypoint_patches(m, x, y, valid, half, fill):
+    '''
+    render each valid keypoint into its own patch of a zero-initialized heatmap: the rows and columns within half of
+    the keypoint. all patches are computed at once, as the outer product of per-axis profiles over a KxK window, and
+    written with one indexed assignment into a strided view of the KxK windows of the heatmap, without a python loop
+    over keypoints. nothing is written outside the windows.
+    Input:
+        m (bsz,h,w,N): output heatmap, zeros
+        x, y, valid (bsz,N): keypoint cordinates and validity
+        half: half width of the patches
+        fill: function(dy2, dx2) -> patch values, with dy2 (P,K,1) and dx2 (P,1,K) the squared distances of the window
+            rows / columns to the P keypoints (inf outside the patch, where fill must give 0)
+    '''
+    bsz, h, w, N = m.shape
+    b, n = np.nonzero(valid)
+    x, y = x[b, n], y[b, n]
+    k = int(np.floor(2 * half)) + 1
+    # heatmaps smaller than a window are padded
+    out = m if k <= min(h, w) else np.zeros((bsz, max(h, k), max(w, k), N), dtype=m.dtype)
+    # windows start at the first row / column of the patch, moved inside the heatmap. a window covers the part of the
+    # patch in the heatmap, and may cover more rows / columns
+    x0 = np.clip(np.ceil(x - half), 0, out.shape[2] - k).astype(np.int64)
+    y0 = np.clip(np.ceil(y - half), 0, out.shape[1] - k).astype(np.int64)
+    dx = (x0[:, np.newaxis] + np.arange(k)) - x[:, np.newaxis]
+    dy = (y0[:, np.newaxis] + np.arange(k)) - y[:, np.newaxis]
+    # rows / columns outside the patch are infinitely far: fill gives 0 there
+    dx2 = np.where(np.abs(dx) <= half, dx ** 2, np.inf)
+    dy2 = np.where(np.abs(dy) <= half, dy ** 2, np.inf)
+    s_b, s_y, s_x, s_n = out.strides
+    windows = np.lib.stride_tricks.as_strided(out, shape=(bsz, N, out.shape[1] - k + 1, out.shape[2] - k + 1, k, k),
+                                              strides=(s_b, s_n, s_y, s_x, s_y, s_x), writeable=True)
+    # one window per keypoint channel: windows never overlap
+    windows[b, n, y0, x0] = fill(dy2[:, :, np.newaxis], dx2[:, np.newaxis, :])
+    if out is not m:
+        m[...] = out[:, :h, :w]
+    return m
+
 def kp_to_map(img_sz, kps, mode='gaussian', radius=5):
     '''
-    Keypoint cordinates to heatmap map.
+    Keypoint cordinates to heatmap map. Each keypoint is rendered only within a radius-bounded patch (see
+    draw_keypoint_patches), as the outer product of 1-D profiles (gaussian) or a disk test (binary).
     Input:
         img_size (w,h): size of heatmap
-        kps (N,2): (x,y) cordinates of N keypoints
+        kps (N,2) or (bsz,N,2): (x,y) cordinates of N keypoints. negative values mark missing keypoints
         mode: 'gaussian' or 'binary'
         radius: radius of each keypoints in heatmap
     Output:
-        m (h,w,N): encoded heatmap
+        m (h,w,N) or (bsz,h,w,N): encoded heatmap
     '''
     w, h = img_sz
-    x_grid, y_grid = np.meshgrid(range(w), range(h), indexing = 'xy')
-    m = []
-    for x, y in kps:
-
-        # if x == -1 or y == -1:
-        if x<0 or y<0:
-            m.append(np.zeros((h, w)).astype(np.float32))
-        else:
-            if mode == 'gaussian':
-                m.append(np.exp(-((x_grid - x)**2 + (y_grid - y)**2)/(radius**2)).astype(np.float32))
-            elif mode == 'binary':
-                m.append(((x_grid-x)**2 + (y_grid-y)**2 <= radius**2).astype(np.float32))
-            else:
-                raise NotImplementedError()
-    m = np.stack(m, axis=2)
-    return m
+    kps = np.asarray(kps, dtype=np.float64)
+    batched = kps.ndim == 3
+    if not batched:
+        kps = kps[np.newaxis]
+    x, y = kps[..., 0], kps[..., 1]
+    valid = (x >= 0) & (y >= 0)
+    m = np.zeros((kps.shape[0], h, w, kps.shape[1]), dtype=np.float32)
+    r2 = radius ** 2
+    if mode == 'gaussian':
+        draw_keypoint_patches(m, x, y, valid, np.sqrt(GAUSSIAN_WINDOW * r2),
+                              lambda dy2, dx2: np.exp(-dy2 / r2) * np.exp(-dx2 / r2))
+    elif mode == 'binary':
+        draw_keypoint_patches(m, x, y, valid, radius, lambda dy2, dx2: dy2 + dx2 <= r2)
+    else:
+        raise NotImplementedError()
+    return m if batched else m[0]
 
 
 def seg_label_to_map(seg_label, nc = 7, bin_size=1):
@@ -69,3 +112,134 @@ def seg_label_to_map(seg_label, nc = 7, bin_size=1):
         seg_map = cv2.resize(seg_map, dsize=(w, h), interpolation=cv2.INTER_NEAREST)
     return seg_map
 ###############################################################################
+
+#####################################
+# Raw frame crop / reduced decode
+#####################################
+# raw PersonHD frames are much larger than the training resolution. a raw frame is cropped to a box and resized to the
+# target size; keypoints are mapped with the same transform. the default box is the whole frame (full_frame_box), i.e.
+# an anisotropic resize as in the existing pose labels (see resize_ in pose_transfer_parsing_dataset_personHD_jitter.py).
+# center_crop_box keeps the aspect ratio but cuts off the top and bottom of portrait frames.
+
+_REDUCED_FLAGS = {
+    True: {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8},
+    False: {1: cv2.IMREAD_GRAYSCALE, 2: cv2.IMREAD_REDUCED_GRAYSCALE_2, 4: cv2.IMREAD_REDUCED_GRAYSCALE_4, 8: cv2.IMREAD_REDUCED_GRAYSCALE_8},
+}
+
+def full_frame_box(src_size):
+    '''
+    box of the whole (h,w) source image.
+    Output:
+        box (x0, y0, x1, y1)
+    '''
+    src_h, src_w = src_size
+    return (0, 0, src_w, src_h)
+
+def center_crop_box(src_size, dst_size):
+    '''
+    largest centered box of a (h,w) source image with the aspect ratio of dst_size (h,w).
+    Output:
+        box (x0, y0, x1, y1)
+    '''
+    src_h, src_w = src_size
+    dst_h, dst_w = dst_size
+    if src_w * dst_h > src_h * dst_w:
+        crop_h, crop_w = src_h, int(round(src_h * dst_w / dst_h))
+    else:
+        crop_h, crop_w = int(round(src_w * dst_h / dst_w)), src_w
+    x0, y0 = (src_w - crop_w) // 2, (src_h - crop_h) // 2
+    return (x0, y0, x0 + crop_w, y0 + crop_h)
+
+def reduced_decode_factor(box, dst_size):
+    '''
+    largest jpeg decode reduction (1, 2, 4 or 8) at which the box is still not smaller than dst_size (h,w)
+    '''
+    x0, y0, x1, y1 = box
+    dst_h, dst_w = dst_size
+    for factor in [8, 4, 2]:
+        if (x1 - x0) // factor >= dst_w and (y1 - y0) // factor >= dst_h:
+            return factor
+    return 1
+
+def read_crop_resize(fn, box, dst_size, color=True, factor=1):
+    '''
+    decode an image at 1/factor scale (cv2.IMREAD_REDUCED_*), crop the box (given in full-resolution cordinates) and
+    resize it to dst_size (h,w). color images use area interpolation, label maps (color=False) nearest neighbour.
+    keep factor=1 for png label maps: opencv implements reduced decode of non-jpeg files by interpolation.
+    Output:
+        img: (h,w,3) BGR or (h,w) uint8
+    '''
+    img = cv2.imread(fn, _REDUCED_FLAGS[color][factor])
+    x0, y0, x1, y1 = [int(round(v / factor)) for v in box]
+    img = img[y0:y1, x0:x1]
+    dst_h, dst_w = dst_size
+    if img.shape[0:2] != (dst_h, dst_w):
+        img = cv2.resize(img, (dst_w, dst_h), interpolation=cv2.INTER_AREA if color else cv2.INTER_NEAREST)
+    return img
+
+def crop_resize_keypoints(kps, box, dst_size):
+    '''
+    map (x,y) keypoints of the full-resolution image to the image returned by read_crop_resize. missing keypoints
+    (negative cordinates) and keypoints outside the box are set to -1.
+    Input:
+        kps (N,2)
+    Output:
+        kps (N,2) float32
+    '''
+    kps = np.array(kps, dtype=np.float32).reshape(-1, 2)
+    x0, y0, x1, y1 = box
+    dst_h, dst_w = dst_size
+    scale = np.array([dst_w / (x1 - x0), dst_h / (y1 - y0)], dtype=np.float32)
+    # pixel-center aligned, as cv2.resize
+    out = (kps - np.array([x0, y0], dtype=np.float32) + 0.5) * scale - 0.5
+    invalid = (kps[:, 0] < 0) | (kps[:, 1] < 0) | (out[:, 0] < 0) | (out[:, 1] < 0) | (out[:, 0] > dst_w - 1) | (out[:, 1] > dst_h - 1)
+    out[invalid] = -1
+    return out
+
+def to_uint8_tensor(x, scale=1.):
+    '''
+    (h,w,c) numpy array to (c,h,w) uint8 tensor. scale=255 for float images in [0,1].
+    '''
+    if x.dtype != np.uint8:
+        x = np.clip(np.round(x * scale), 0, 255).astype(np.uint8)
+    return torch.from_numpy(np.ascontiguousarray(x.transpose((2, 0, 1))))
+
+#####################################
+# Tensor versions (batched, run on the model's device)
+#####################################
+def kp_to_map_tensor(kps, img_sz, mode='gaussian', radius=5):
+    '''
+    Batched kp_to_map.
+    Input:
+        kps (bsz,N,2): (x,y) cordinates. negative values mark missing keypoints
+        img_size (w,h): size of heatmap
+    Output:
+        m (bsz,N,h,w): encoded heatmap
+    '''
+    w, h = img_sz
+    kps = kps.float()
+    x = kps[..., 0:1]
+    y = kps[..., 1:2]
+    dx2 = (torch.arange(w, dtype=kps.dtype, device=kps.device) - x) ** 2  # (bsz,N,w)
+    dy2 = (torch.arange(h, dtype=kps.dtype, device=kps.device) - y) ** 2  # (bsz,N,h)
+    if mode == 'gaussian':
+        m = torch.exp(-dy2 / (radius ** 2)).unsqueeze(3) * torch.exp(-dx2 / (radius ** 2)).unsqueeze(2)
+    elif mode == 'binary':
+        m = ((dy2.unsqueeze(3) + dx2.unsqueeze(2)) <= radius ** 2).float()
+    else:
+        raise NotImplementedError()
+    valid = ((x >= 0) & (y >= 0)).float().unsqueeze(3)
+    return m * valid
+
+
+def seg_label_to_map_tensor(seg_label, nc=7):
+    '''
+    Batched one-hot expansion (seg_label_to_map with bin_size=1).
+    Input:
+        seg_label: (bsz,1,H,W) integer class label
+    Output:
+        seg_map: (bsz,nc,H,W) float
+    '''
+    classes = torch.arange(nc, device=seg_label.device).view(1, nc, 1, 1)
+    return (seg_label.long() == classes).float()
+
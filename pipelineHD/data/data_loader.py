@@ -1,4 +1,5 @@
 import torch.utils.data
+import torch.utils.data.distributed
 
 # Todo: disentangle data-related parameters from model options
 
@@ -10,13 +11,29 @@ def CreateDataLoader(opt, split='test'):
     dataset = CreateDataset(opt, split)
     shuffle = (split == 'train' and opt.is_train)
     drop_last = opt.is_train
+    sampler = None
+    if shuffle and getattr(opt, 'locality_chunk', 0) > 0:
+        # splits the pairs among processes by itself in distributed mode
+        from data.pair_sampler import LocalityPairSampler
+        sampler = LocalityPairSampler(dataset.id_list[:len(dataset)], chunk_size=opt.locality_chunk,
+                                      level=opt.locality_level)
+        shuffle = False
+    elif getattr(opt, 'distributed', 0) and shuffle:
+        # each process reads its own part of the split. the parts are padded to equal length
+        sampler = torch.utils.data.distributed.DistributedSampler(dataset, shuffle=shuffle)
+        shuffle = False
+    elif getattr(opt, 'distributed', 0):
+        # evaluation: no padding, so that no sample is counted twice in the metrics averaged over all processes
+        from data.pair_sampler import UnpaddedDistributedSampler
+        sampler = UnpaddedDistributedSampler(dataset)
     dataloader = torch.utils.data.DataLoader(
         dataset = dataset, 
         batch_size = opt.batch_size,
         shuffle = shuffle,
-        num_workers = 8,
+        sampler = sampler,
+        num_workers = opt.n_workers,
         drop_last = drop_last,
-        pin_memory = False)
+        pin_memory = bool(opt.gpu_ids))
     return dataloader
 
 def CreateDataset(opt, split):
@@ -26,6 +43,8 @@ def CreateDataset(opt, split):
         from data.pose_transfer_parsing_dataset_personHD import PoseTransferParsingDataset as DatasetClass
     elif opt.dataset_type == 'pose_transfer_parsing_personHD_jitter':
         from data.pose_transfer_parsing_dataset_personHD_jitter import PoseTransferParsingDataset as DatasetClass
+    elif opt.dataset_type == 'pose_transfer_parsing_personHD_shard':
+        from data.pose_transfer_parsing_dataset_personHD_shard import PoseTransferParsingShardDataset as DatasetClass
    
     else:
         raise ValueError('Dataset mode [%s] not recognized.' % opt.dataset_type)
@@ -0,0 +1,157 @@
+from __future__ import division
+import numpy as np
+import os
+import util.io as io
+
+#####################################
+# Precomputed flow / visibility store
+#####################################
+# layout of a store directory (written by tools/precompute_flow.py):
+#   index.json:     {'image_size': [h, w], 'pairs': [[sid1, sid2], ...]}
+#   pairs_keys.npy: (N,) str. sorted pair keys (see pair_key), the lookup index of the rows
+#   pairs_rows.npy: (N,) int64. row of each sorted key
+#   flow_2to1.npy:  (N, 2, h, w) float16. netF flow, already scaled to pixels and masked by visibility
+#   vis_2.npy:      (N, 1, h, w) uint8. 0-visible, 1-invisible, 2-background
+
+def pair_key(sid1, sid2):
+    return sid1 + '___' + sid2
+
+
+class KeyIndex(object):
+    '''
+    Read-only key -> row mapping of a store directory, kept as two arrays: the sorted keys (<name>_keys.npy) and the
+    row of each of them (<name>_rows.npy). Keys are found by binary search. The arrays are memory-mapped lazily, like
+    the data arrays, so all DataLoader workers share their pages instead of each holding a dict with one python
+    string per sample. Stores written before the index files existed are indexed in memory, from the keys returned by
+    get_keys().
+    '''
+    def __init__(self, store_dir, name, get_keys):
+        self.fns = [os.path.join(store_dir, '%s_%s.npy' % (name, a)) for a in ('keys', 'rows')]
+        self.mapped = all(os.path.isfile(fn) for fn in self.fns)
+        self._keys, self._rows = (None, None) if self.mapped else self.build(get_keys())
+
+    @staticmethod
+    def build(keys):
+        '''
+        Output:
+            sorted keys (str array), row of each sorted key (int64 array)
+        '''
+        keys = np.array(list(keys), dtype=np.str_)
+        order = np.argsort(keys, kind='stable')
+        return keys[order], order.astype(np.int64)
+
+    @staticmethod
+    def save(store_dir, name, keys):
+        keys, rows = KeyIndex.build(keys)
+        np.save(os.path.join(store_dir, '%s_keys.npy' % name), keys)
+        np.save(os.path.join(store_dir, '%s_rows.npy' % name), rows)
+
+    def _open(self):
+        if self._keys is None:
+            self._keys, self._rows = [np.load(fn, mmap_mode='r') for fn in self.fns]
+
+    def __getstate__(self):
+        # do not pickle the mapped arrays into worker processes
+        state = self.__dict__.copy()
+        if self.mapped:
+            state['_keys'] = None
+            state['_rows'] = None
+        return state
+
+    def __len__(self):
+        self._open()
+        return len(self._keys)
+
+    def find(self, key):
+        '''
+        row of key, -1 if the key is unknown
+        '''
+        self._open()
+        i = int(np.searchsorted(self._keys, key))
+        if i < len(self._keys) and self._keys[i] == key:
+            return int(self._rows[i])
+        return -1
+
+    def __contains__(self, key):
+        return self.find(key) >= 0
+
+    def __getitem__(self, key):
+        row = self.find(key)
+        if row < 0:
+            raise KeyError(key)
+        return row
+
+
+class FlowStore(object):
+    '''
+    Read/write access to a store directory. The .npy files are memory-mapped lazily, so the object can be
+    passed to DataLoader workers cheaply and every worker shares the page cache.
+    '''
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        meta = io.load_json(os.path.join(store_dir, 'index.json'))
+        self.image_size = tuple(meta['image_size'])
+        self.index = KeyIndex(store_dir, 'pairs', lambda: [pair_key(*p) for p in meta['pairs']])
+        self._flow = None
+        self._vis = None
+        self._mode = 'r'
+
+    @classmethod
+    def create(cls, store_dir, pairs, image_size):
+        '''
+        create an empty store for the given pairs and open it for writing.
+        '''
+        io.mkdir_if_missing(store_dir)
+        h, w = image_size
+        io.save_json({'image_size': [h, w], 'pairs': [list(p) for p in pairs]}, os.path.join(store_dir, 'index.json'))
+        KeyIndex.save(store_dir, 'pairs', [pair_key(*p) for p in pairs])
+        np.lib.format.open_memmap(os.path.join(store_dir, 'flow_2to1.npy'), mode='w+', dtype=np.float16,
+                                  shape=(len(pairs), 2, h, w))
+        np.lib.format.open_memmap(os.path.join(store_dir, 'vis_2.npy'), mode='w+', dtype=np.uint8,
+                                  shape=(len(pairs), 1, h, w))
+        store = cls(store_dir)
+        store._mode = 'r+'
+        return store
+
+    def _open(self):
+        if self._flow is None:
+            self._flow = np.load(os.path.join(self.store_dir, 'flow_2to1.npy'), mmap_mode=self._mode)
+            self._vis = np.load(os.path.join(self.store_dir, 'vis_2.npy'), mmap_mode=self._mode)
+
+    def __getstate__(self):
+        # do not pickle the mapped arrays into worker processes
+        state = self.__dict__.copy()
+        state['_flow'] = None
+        state['_vis'] = None
+        return state
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, pair):
+        return pair_key(*pair) in self.index
+
+    def get(self, sid1, sid2):
+        '''
+        Output:
+            flow_2to1: (2, h, w) float32
+            vis_2: (1, h, w) float32
+        '''
+        self._open()
+        i = self.index[pair_key(sid1, sid2)]
+        return self._flow[i].astype(np.float32), self._vis[i].astype(np.float32)
+
+    def write(self, rows, flow, vis):
+        '''
+        rows: (bsz,) row index
+        flow: (bsz, 2, h, w)
+        vis: (bsz, 1, h, w)
+        '''
+        self._open()
+        self._flow[rows] = flow.astype(np.float16)
+        self._vis[rows] = vis.astype(np.uint8)
+
+    def flush(self):
+        if self._flow is not None:
+            self._flow.flush()
+            self._vis.flush()
@@ -0,0 +1,98 @@
+from __future__ import division
+import math
+import re
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.utils.data
+
+#####################################
+# Locality-aware pair sampler
+#####################################
+# PersonHD sample ids look like '082_S059': subject id, then video letter and frame number.
+
+def sid_group(sid, level='subject'):
+    '''
+    group key of a sample id.
+        subject: '082_S059' -> '082'
+        video:   '082_S059' -> '082_S' (sid without the trailing frame number)
+    '''
+    if level == 'subject':
+        return sid.split('_')[0]
+    elif level == 'video':
+        return re.sub(r'\d+$', '', sid)
+    else:
+        raise ValueError('unknown group level: %s' % level)
+
+
+class LocalityPairSampler(torch.utils.data.Sampler):
+    '''
+    Random pair order that keeps pairs with the same source subject/video together.
+
+    Every epoch, the pairs of each group (by source id) are shuffled and cut into chunks of chunk_size pairs, and the
+    chunks of all groups are shuffled. chunk_size=1 is a plain random permutation; larger chunks trade randomness for
+    locality, so that decode caches, the page cache and per-source caches see the same frames in consecutive batches.
+
+    With num_replicas > 1 (distributed training), each rank takes a contiguous block of the same global order, padded
+    to equal length as in torch.utils.data.DistributedSampler. Call set_epoch() at the start of every epoch when the
+    ranks must agree; otherwise the epoch counter advances on every iteration.
+    '''
+    def __init__(self, id_list, chunk_size=32, level='subject', num_replicas=None, rank=None, seed=0):
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        self.chunk_size = max(int(chunk_size), 1)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.n_pair = len(id_list)
+        self.num_samples = int(math.ceil(self.n_pair / num_replicas))
+        self.total_size = self.num_samples * num_replicas
+
+        groups = {}
+        for i, (sid1, sid2) in enumerate(id_list):
+            groups.setdefault(sid_group(sid1, level), []).append(i)
+        self.groups = [np.array(g, dtype=np.int64) for g in groups.values()]
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_samples
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        self.epoch += 1
+        chunks = []
+        for g in self.groups:
+            g = g[rng.permutation(len(g))]
+            chunks += [g[i:(i + self.chunk_size)] for i in range(0, len(g), self.chunk_size)]
+        order = np.concatenate([chunks[i] for i in rng.permutation(len(chunks))]) if chunks else np.zeros(0, np.int64)
+        if self.total_size > len(order) > 0:
+            order = np.concatenate([order, np.resize(order, self.total_size - len(order))])
+        order = order[self.rank * self.num_samples:(self.rank + 1) * self.num_samples]
+        return iter(order.tolist())
+
+
+class UnpaddedDistributedSampler(torch.utils.data.Sampler):
+    '''
+    Sequential order split among ranks without padding, for evaluation: every sample is read by exactly one rank, so
+    that metrics averaged over all ranks (util/distributed.all_reduce_errors) do not count samples twice. Each rank
+    takes a contiguous block; blocks differ in length by at most one sample.
+    '''
+    def __init__(self, dataset, num_replicas=None, rank=None):
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        n = len(dataset)
+        self.start = n * rank // num_replicas
+        self.end = n * (rank + 1) // num_replicas
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __iter__(self):
+        return iter(range(self.start, self.end))
@@ -0,0 +1,92 @@
+from __future__ import division
+import numpy as np
+
+#####################################
+# Compact split / pose label index
+#####################################
+# the split file (list of [sid1, sid2] pairs) and the pose label file ({sid: [[x, y], ...]}) are converted at load time
+# into a sorted string table and contiguous numpy arrays. unlike lists / dicts of python objects, the arrays are not
+# touched by reference counting, so DataLoader workers keep sharing their pages with the main process instead of
+# copying them on write.
+
+class SidTable(object):
+    '''
+    sorted table of sample ids. ids are looked up by binary search.
+    '''
+    def __init__(self, sids):
+        self.sids = np.unique(np.array(list(sids), dtype=np.str_))
+
+    def __len__(self):
+        return len(self.sids)
+
+    def __getitem__(self, row):
+        return str(self.sids[row])
+
+    def find(self, sids):
+        '''
+        rows of an array of sids, -1 for unknown sids
+        '''
+        sids = np.asarray(sids, dtype=self.sids.dtype if len(self.sids) else np.str_)
+        rows = np.searchsorted(self.sids, sids)
+        rows = np.minimum(rows, len(self.sids) - 1)
+        found = (len(self.sids) > 0) & (self.sids[rows] == sids)
+        return np.where(found, rows, -1).astype(np.int32)
+
+    def row(self, sid):
+        r = int(self.find([sid])[0])
+        if r < 0:
+            raise KeyError(sid)
+        return r
+
+
+class PairList(object):
+    '''
+    list of (sid1, sid2) pairs stored as an (N, 2) int32 array of rows into a SidTable. supports len(), iteration,
+    integer indexing and slicing like the original list.
+    '''
+    def __init__(self, pairs, table=None):
+        if table is None:
+            pairs = list(pairs)
+            table = SidTable([sid for pair in pairs for sid in pair])
+            self.rows = table.find(np.array(pairs, dtype=np.str_).reshape(-1, 2).ravel()).reshape(-1, 2)
+        else:
+            self.rows = np.asarray(pairs, dtype=np.int32).reshape(-1, 2)
+        self.table = table
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return PairList(self.rows[index], self.table)
+        r1, r2 = self.rows[index]
+        return (self.table[r1], self.table[r2])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class PoseLabel(object):
+    '''
+    read-only {sid: (18, 2) keypoints} mapping. keypoints are stored as one (N, 18, 2) array, int16 if all
+    cordinates are integers and float32 otherwise.
+    '''
+    def __init__(self, pose_label):
+        self.table = SidTable(pose_label.keys())
+        joints = np.array([pose_label[sid] for sid in self.table.sids], dtype=np.float32).reshape(len(self.table), -1, 2)
+        if joints.size == 0 or (np.all(np.round(joints) == joints) and np.abs(joints).max() < 2**15):
+            joints = joints.astype(np.int16)
+        self.joints = joints
+
+    def __len__(self):
+        return len(self.table)
+
+    def __contains__(self, sid):
+        return self.table.find([sid])[0] >= 0
+
+    def __getitem__(self, sid):
+        return self.joints[self.table.row(sid)]
+
+    def keys(self):
+        return [self.table[i] for i in range(len(self.table))]
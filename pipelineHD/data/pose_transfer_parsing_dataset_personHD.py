@@ -2,13 +2,20 @@ from __future__ import division
 import torch
 import torchvision.transforms as transforms
 from .base_dataset import *
+from .flow_store import FlowStore
+from .pose_index import PairList, PoseLabel
 import cv2
 import numpy as np
 import os
+from collections import OrderedDict
 import util.io as io
+from util.lru_cache import SharedArrayCache
 from albumentations  import ColorJitter
 
 class PoseTransferParsingDataset(BaseDataset):
+    # set by init_cache(). readers that only call init_source() (e.g. tools/build_shard.py) decode without cache
+    image_cache = seg_cache = None
+
     def name(self):
         return 'PoseTransferParsingDataset'
 
@@ -20,14 +27,10 @@ class PoseTransferParsingDataset(BaseDataset):
         # set path / load label
         #############################
         data_split = io.load_json(os.path.join(opt.data_root, opt.fn_split))
-        self.img_dir = os.path.join(opt.data_root, opt.img_dir)
-        self.seg_dir = os.path.join(opt.data_root, opt.seg_dir)
-        self.pose_label = io.load_data(os.path.join(opt.data_root, opt.fn_pose))
-
-        self.seg_cihp_dir = os.path.join(opt.data_root, opt.seg_dir)
-        # self.seg_cihp_pred_dir = os.path.join(opt.data_root, opt.seg_pred_dir)
-        self.seg_cihp_pred_dir = opt.seg_pred_dir
-        
+        self.init_source(opt)
+        self.init_cache(opt)
+        if not opt.flow_on_the_fly:
+            self.flow_store = FlowStore(os.path.join(opt.data_root, opt.flow_store_dir))
 
         #############################
         # create index list
@@ -40,11 +43,48 @@ class PoseTransferParsingDataset(BaseDataset):
         # here set debug option
         if opt.debug:
             self.id_list = self.id_list[0:32]
+        self.id_list = PairList(self.id_list)
         self.tensor_normalize_std = transforms.Normalize([0.5, 0.5, 0.5], [0.5, 0.5, 0.5])
         self.to_pil_image = transforms.ToPILImage()
         self.pil_to_tensor = transforms.ToTensor()
         self.color_jitter = transforms.ColorJitter(brightness=0.0, contrast=0.0, saturation=0.0, hue=0.2)
 
+    def init_source(self, opt):
+        self.img_dir = os.path.join(opt.data_root, opt.img_dir)
+        self.seg_dir = os.path.join(opt.data_root, opt.seg_dir)
+        self.pose_label = PoseLabel(io.load_data(os.path.join(opt.data_root, opt.fn_pose)))
+
+        self.seg_cihp_dir = os.path.join(opt.data_root, opt.seg_dir)
+        # self.seg_cihp_pred_dir = os.path.join(opt.data_root, opt.seg_pred_dir)
+        self.seg_cihp_pred_dir = opt.seg_pred_dir
+        if opt.raw_image_size:
+            # img_dir / seg_dir / fn_pose are the raw release: crop and resize every sample on the fly
+            if opt.raw_crop == 'center':
+                self.raw_box = center_crop_box(opt.raw_image_size, opt.image_size)
+            else:
+                self.raw_box = full_frame_box(opt.raw_image_size)
+            self.raw_factor = reduced_decode_factor(self.raw_box, opt.image_size)
+
+    def init_cache(self, opt):
+        '''
+        decoded images / parsing labels, shared by all DataLoader workers. a frame appears in many pairs, so with
+        --image_cache_mb > 0 it is decoded only once while it stays in the cache.
+        '''
+        self.image_cache = self.seg_cache = None
+        if opt.image_cache_mb > 0:
+            h, w = opt.image_size
+            n_bytes = opt.image_cache_mb * 2**20
+            # 3/4 of the budget for rgb images and 1/4 for label maps: same number of slots for both
+            self.image_cache = SharedArrayCache(n_bytes * 3 // 4, (h, w, 3))
+            self.seg_cache = SharedArrayCache(n_bytes // 4, (h, w))
+
+    def get_cache_stats(self):
+        stats = OrderedDict()
+        if self.image_cache is not None:
+            stats['image_cache'] = self.image_cache.get_stats()
+            stats['seg_cache'] = self.seg_cache.get_stats()
+        return stats
+
     def set_len(self, n):
         self._len = n
 
@@ -58,10 +98,22 @@ class PoseTransferParsingDataset(BaseDataset):
         return torch.Tensor(np_data.transpose((2, 0, 1)))
 
     def read_image(self, sid):
+        img = self.read_image_uint8(sid).astype(np.float32)
+        img = img/ 255.
+        return img
+
+    def read_image_uint8(self, sid):
+        if self.image_cache is not None:
+            return self.image_cache.fetch(sid, lambda: self.decode_image(sid))
+        return self.decode_image(sid)
+
+    def decode_image(self, sid):
         fn = os.path.join(self.img_dir, sid + '.jpg')
         # print(fn)
-        img = cv2.imread(fn).astype(np.float32) 
-        img = img/ 255.
+        if self.opt.raw_image_size:
+            img = read_crop_resize(fn, self.raw_box, self.opt.image_size, color=True, factor=self.raw_factor)
+        else:
+            img = cv2.imread(fn)
         img = img[..., [2, 1, 0]]
         return img
     
@@ -69,18 +121,32 @@ class PoseTransferParsingDataset(BaseDataset):
     def read_seg_pred_cihp(self, sid1, sid2):
         fn = os.path.join(self.seg_cihp_pred_dir, sid1 + '___' + sid2 + '.png')
         # print(fn)
-        seg = cv2.imread(fn, cv2.IMREAD_GRAYSCALE).astype(np.float32)
+        seg = self.read_label(fn, 'pred:' + sid1 + '___' + sid2).astype(np.float32)
         # seg = cv2.resize(seg,(256,256))
         seg = seg[..., np.newaxis]
         return seg
 
     def read_seg_cihp(self, sid):
         fn = os.path.join(self.seg_cihp_dir, sid + '.png')
-        seg = cv2.imread(fn, cv2.IMREAD_GRAYSCALE).astype(np.float32)
+        seg = self.read_label(fn, sid, raw=bool(self.opt.raw_image_size)).astype(np.float32)
         # seg = cv2.resize(seg,(256,256))
         seg = seg[..., np.newaxis]
         return seg
+
+    def read_label(self, fn, key, raw=False):
+        if raw:
+            load = lambda: read_crop_resize(fn, self.raw_box, self.opt.image_size, color=False)
+        else:
+            load = lambda: cv2.imread(fn, cv2.IMREAD_GRAYSCALE)
+        if self.seg_cache is not None:
+            return self.seg_cache.fetch(key, load)
+        return load()
         
+    def read_joint(self, sid):
+        if self.opt.raw_image_size:
+            return crop_resize_keypoints(self.pose_label[sid], self.raw_box, self.opt.image_size)
+        return np.array(self.pose_label[sid])
+
     # def resize_(self, x):
     #     y=x*[256/190,256/110]
     #     y=y.astype(np.int)
@@ -91,8 +157,9 @@ class PoseTransferParsingDataset(BaseDataset):
         ######################
         # load data
         ######################
-        img_1 = self.read_image(sid1)
-        img_2 = self.read_image(sid2)
+        read_image = self.read_image_uint8 if self.opt.compact_payload else self.read_image
+        img_1 = read_image(sid1)
+        img_2 = read_image(sid2)
 
         seg_cihp_label_1 = self.read_seg_cihp(sid1)
         # seg_cihp_label_2 = self.read_seg_cihp(sid2) if self.split=='train' else self.read_seg_pred_cihp(sid1, sid2)
@@ -100,9 +167,9 @@ class PoseTransferParsingDataset(BaseDataset):
         
 
 
-        joint_c_1 = np.array(self.pose_label[sid1])
+        joint_c_1 = self.read_joint(sid1)
         
-        joint_c_2 = np.array(self.pose_label[sid2])
+        joint_c_2 = self.read_joint(sid2)
         
         # joint_c_1 = self.resize_(joint_c_1)
         # joint_c_2 = self.resize_(joint_c_2)
@@ -110,6 +177,21 @@ class PoseTransferParsingDataset(BaseDataset):
         # joint_c_1 = joint_c_1[:,::-1]
         # joint_c_2 = joint_c_2[:,::-1]
 
+        if self.opt.compact_payload:
+            # joint maps, one-hot parsing maps and image normalization are computed on the device by
+            # PoseTransferModel.set_input
+            data = {
+                'img_1': to_uint8_tensor(img_1, 255.),
+                'img_2': to_uint8_tensor(img_2, 255.),
+                'joint_c_1': torch.from_numpy(joint_c_1.astype(np.float32)),
+                'joint_c_2': torch.from_numpy(joint_c_2.astype(np.float32)),
+                'seg_cihp_label_1': to_uint8_tensor(seg_cihp_label_1),
+                'seg_cihp_label_2': to_uint8_tensor(seg_cihp_label_2),
+                'id_1': sid1,
+                'id_2': sid2
+            }
+            return self.add_flow(data, sid1, sid2)
+
         h, w = self.opt.image_size
         ######################
         # pack output data
@@ -124,9 +206,19 @@ class PoseTransferParsingDataset(BaseDataset):
             'img_2': self.tensor_normalize_std(self.to_tensor(img_2)),
             'joint_1': self.to_tensor(joint_1),
             'joint_2': self.to_tensor(joint_2),
+            # keypoints: pose content keys of PoseTransferModel.render()
+            'joint_c_1': torch.from_numpy(joint_c_1.astype(np.float32)),
+            'joint_c_2': torch.from_numpy(joint_c_2.astype(np.float32)),
             'seg_cihp_1': self.to_tensor(seg_cihp_1),
             'seg_cihp_2': self.to_tensor(seg_cihp_2),
             'id_1': sid1,
             'id_2': sid2
         }
+        return self.add_flow(data, sid1, sid2)
+
+    def add_flow(self, data, sid1, sid2):
+        if not self.opt.flow_on_the_fly:
+            flow_2to1, vis_2 = self.flow_store.get(sid1, sid2)
+            data['flow_2to1'] = torch.from_numpy(flow_2to1)
+            data['vis_2'] = torch.from_numpy(vis_2)
         return data
\ No newline at end of file
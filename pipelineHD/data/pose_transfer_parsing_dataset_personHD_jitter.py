@@ -1,134 +1,120 @@
 from __future__ import division
 import torch
-import torchvision.transforms as transforms
 from .base_dataset import *
-import cv2
+from .pose_transfer_parsing_dataset_personHD import PoseTransferParsingDataset as PlainPoseTransferParsingDataset
 import numpy as np
-import os
-import util.io as io
-from albumentations  import ColorJitter,ChannelShuffle
-import random
 
-aug_color_jitter_face=ColorJitter(brightness=0.2, contrast=0.2, saturation=0.2, hue=0.2, always_apply=False,p=0.5)
-
-aug_color_jitter=ColorJitter(brightness=0.5, contrast=0.5, saturation=0.5, hue=0.5, always_apply=False,p=0.5)
+#####################################
+# Part-wise color jitter
+#####################################
+# every color jitter op (brightness / contrast / saturation / hue rotation / channel shuffle) is an affine map of the
+# rgb value, so the ops of one part compose into a single 3x4 matrix, and the whole image is jittered in one pass by
+# indexing the per-label matrices with the parsing label map.
+
+# CIHP labels jittered together. 0 (background) is not changed. 13 (face) only gets a weak jitter.
+# 14/15 left/right arm, 16/17 left/right leg and 18/19 left/right shoe share one transform for left-right consistency
+PART_GROUPS = [[i] for i in range(1, 13)] + [[14, 15], [16, 17], [18, 19]]
+FACE_LABEL = 13
+GRAY_WEIGHTS = np.array([0.299, 0.587, 0.114])
+GRAY_AXIS = np.ones(3) / np.sqrt(3)
+GRAY_AXIS_CROSS = np.array([[0, -1, 1], [1, 0, -1], [-1, 1, 0]]) / np.sqrt(3)
+
+def sample_color_ops(rng, strength, shuffle, p=0.5):
+    '''
+    draw the parameters of ColorJitter(brightness=strength, contrast=strength, saturation=strength, hue=strength,
+    p=p) (ops in random order), optionally followed by ChannelShuffle(p=p).
+    '''
+    ops = []
+    if rng.rand() < p:
+        factors = [('brightness', rng.uniform(1 - strength, 1 + strength)),
+                   ('contrast', rng.uniform(1 - strength, 1 + strength)),
+                   ('saturation', rng.uniform(1 - strength, 1 + strength)),
+                   ('hue', rng.uniform(-strength, strength))]
+        ops += [factors[i] for i in rng.permutation(len(factors))]
+    if shuffle and rng.rand() < p:
+        ops.append(('shuffle', rng.permutation(3)))
+    return ops
+
+def sample_part_color_ops(seed, nc=20):
+    '''
+    per-label color ops of Semantic Enhanced Part-wise Augmentation (Section 4.1). the ops only depend on seed, so the
+    two images of a pair get the same jitter.
+    '''
+    rng = np.random.RandomState(seed)
+    part_ops = [[] for _ in range(nc)]
+    part_ops[FACE_LABEL] = sample_color_ops(rng, 0.2, shuffle=False)
+    for group in PART_GROUPS:
+        ops = sample_color_ops(rng, 0.5, shuffle=True)
+        for l in group:
+            part_ops[l] = ops
+    return part_ops
+
+def color_ops_to_affine(ops, mean_rgb):
+    '''
+    Input:
+        ops: list of (name, param) from sample_color_ops
+        mean_rgb: (3,) mean color of the image, used by the contrast op
+    Output:
+        m: (3,4) affine color transform. out = m[:, :3] * rgb + m[:, 3]
+    '''
+    m = np.eye(4)
+    for name, v in ops:
+        t = np.eye(4)
+        if name == 'brightness':
+            t[:3, :3] *= v
+        elif name == 'contrast':
+            # blend with the mean gray level of the (already transformed) image
+            gray_mean = GRAY_WEIGHTS.dot(m[:3, :3].dot(mean_rgb) + m[:3, 3])
+            t[:3, :3] *= v
+            t[:3, 3] = (1 - v) * gray_mean
+        elif name == 'saturation':
+            t[:3, :3] = v * np.eye(3) + (1 - v) * np.tile(GRAY_WEIGHTS, (3, 1))
+        elif name == 'hue':
+            # rotate around the gray axis of the rgb cube, the linear counterpart of an hsv hue shift. v is a
+            # fraction of the full hue circle
+            a = v * 2 * np.pi
+            t[:3, :3] = np.cos(a) * np.eye(3) + np.sin(a) * GRAY_AXIS_CROSS + (1 - np.cos(a)) * np.outer(GRAY_AXIS, GRAY_AXIS)
+        elif name == 'shuffle':
+            t[:3, :3] = np.eye(3)[v]
+        m = t.dot(m)
+    return m[:3]
+
+def part_color_jitter(img, seg, part_ops):
+    '''
+    Input:
+        img: (h,w,3) float rgb image in [0,1]
+        seg: (h,w) or (h,w,1) CIHP label map
+        part_ops: per-label color ops from sample_part_color_ops
+    Output:
+        img_jitter: (h,w,3) float32 in [0,1]
+    '''
+    mean_rgb = img.reshape(-1, 3).mean(axis=0)
+    mats = np.stack([color_ops_to_affine(ops, mean_rgb) for ops in part_ops]).astype(np.float32)
+    m = mats[seg.reshape(seg.shape[:2]).astype(np.int64)]
+    img_jitter = np.einsum('hwij,hwj->hwi', m[..., :3], img.astype(np.float32)) + m[..., 3]
+    return np.clip(img_jitter, 0, 1)
 
-aug_channel_shuffle=ChannelShuffle(p=0.5)
-class PoseTransferParsingDataset(BaseDataset):
+class PoseTransferParsingDataset(PlainPoseTransferParsingDataset):
+    '''
+    PoseTransferParsingDataset with Semantic Enhanced Part-wise Augmentation of the training images. Sources, the
+    decode cache and flows are the ones of the plain dataset.
+    '''
     def name(self):
         return 'PoseTransferParsingDataset'
 
-    def initialize(self, opt, split):
-        self.opt = opt
-        self.data_root = opt.data_root
-        self.split = split
-        #############################
-        # set path / load label
-        #############################
-        data_split = io.load_json(os.path.join(opt.data_root, opt.fn_split))
-        self.img_dir = os.path.join(opt.data_root, opt.img_dir)
-        self.seg_dir = os.path.join(opt.data_root, opt.seg_dir)
-        self.pose_label = io.load_data(os.path.join(opt.data_root, opt.fn_pose))
-
-        self.seg_cihp_dir = os.path.join(opt.data_root, opt.seg_dir)
-        
-
-        #############################
-        # create index list
-        #############################
-        # self.id_list = data_split[split][:50000] if split in data_split.keys() else data_split['test'][:2000]
-        self.id_list = data_split[split] if split in data_split.keys() else data_split['test'][:2000]
-        self._len = len(self.id_list)
-        #############################
-        # other
-        #############################
-        # here set debug option
-        if opt.debug:
-            self.id_list = self.id_list[0:32]
-        self.tensor_normalize_std = transforms.Normalize([0.5, 0.5, 0.5], [0.5, 0.5, 0.5])
-        self.to_pil_image = transforms.ToPILImage()
-        self.pil_to_tensor = transforms.ToTensor()
-        self.color_jitter = transforms.ColorJitter(brightness=0.0, contrast=0.0, saturation=0.0, hue=0.2)
-
-    def set_len(self, n):
-        self._len = n
-
-    def __len__(self):
-        if hasattr(self, '_len') and self._len > 0:
-            return self._len
-        else:
-            return len(self.id_list)
-
-    def to_tensor(self, np_data):
-        return torch.Tensor(np_data.transpose((2, 0, 1)))
-
-    def read_image(self, sid):
-        fn = os.path.join(self.img_dir, sid + '.jpg')
-        # print(fn)
-        # print(os.path.exists(fn))
-        img = cv2.imread(fn).astype(np.float32) 
-        # img = cv2.resize(img,(256,256))
-        img = img/ 255.
-        img = img[..., [2, 1, 0]]
-        return img
-    
-    
-
     def read_image_jitter(self, sid,seg,seed):
-    '''
-    This is the implement of Semantic Enhanced Part-wise Augmentation. As described in Section4.1.  
-    '''
-        fn = os.path.join(self.img_dir, sid + '.jpg')
-        img = cv2.imread(fn).astype(np.float32) 
-        
-        img = img/ 255.
-        random.seed(seed)
+        '''
+        This is the implement of Semantic Enhanced Part-wise Augmentation. As described in Section4.1.  
+        '''
+        # the decoded image comes from the shared cache (if any), the jitter is applied to a copy
+        img = self.read_image(sid)
 
         #13 face: for face we just do litter jitter
         #0 background: no change to background
-        img_jitter_face=aug_color_jitter_face(image=img)['image']
-        img_result=img*(seg==0)+img_jitter_face*(seg==13)
-        for i in range(1,13):
-            img_jitter=aug_color_jitter(image=img)['image']
-            img_shuffle=aug_channel_shuffle(image=img_jitter)['image']
-            img_result+=img_shuffle*(seg==i)
-        
-        # make sure left-right consistency
-        #14 /15 left arm / right arm
-        #16/ 17 left leg / right leg
-        #18/ 19 left shoe / right shoe
-        img_jitter=aug_color_jitter(image=img)['image']
-        img_shuffle=aug_channel_shuffle(image=img_jitter)['image']
-        img_result+=img_shuffle*((seg==14)|(seg==15))
-
-        img_jitter=aug_color_jitter(image=img)['image']
-        img_shuffle=aug_channel_shuffle(image=img_jitter)['image']
-        img_result+=img_shuffle*((seg==16)|(seg==17))
-
-        img_jitter=aug_color_jitter(image=img)['image']
-        img_shuffle=aug_channel_shuffle(image=img_jitter)['image']
-        img_result+=img_shuffle*((seg==18)|(seg==19))
-
-        img = img[..., [2, 1, 0]]
-        
-        return img
-
-
+        #14/15, 16/17, 18/19: left/right arm, leg and shoe share one jitter
+        img_result = part_color_jitter(img, seg, sample_part_color_ops(seed))
+        return img_result
 
-    def read_seg_pred_cihp(self, sid1, sid2):
-        fn = os.path.join(self.seg_cihp_pred_dir, sid1 + '___' + sid2 + '.png')
-        seg = cv2.imread(fn, cv2.IMREAD_GRAYSCALE).astype(np.float32)
-        seg = cv2.resize(seg,(256,256))
-        seg = seg[..., np.newaxis]
-        return seg
-
-    def read_seg_cihp(self, sid):
-        fn = os.path.join(self.seg_cihp_dir, sid + '.png')
-        seg = cv2.imread(fn, cv2.IMREAD_GRAYSCALE).astype(np.float32)
-        # seg = cv2.resize(seg,(256,256))
-        seg = seg[..., np.newaxis]
-        return seg
-        
     def resize_(self, x):
         y=x*[256/190,256/110]
         y=y.astype(np.int)
@@ -152,12 +138,27 @@ class PoseTransferParsingDataset(BaseDataset):
 
         img_2 = self.read_image_jitter(sid2,seg_cihp_label_2,seed) if self.split=='train' else self.read_image(sid2)
 
-        joint_c_1 = np.array(self.pose_label[sid1])
+        joint_c_1 = self.read_joint(sid1)
         
-        joint_c_2 = np.array(self.pose_label[sid2])
+        joint_c_2 = self.read_joint(sid2)
         
         
 
+        if self.opt.compact_payload:
+            # joint maps, one-hot parsing maps and image normalization are computed on the device by
+            # PoseTransferModel.set_input
+            data = {
+                'img_1': to_uint8_tensor(img_1, 255.),
+                'img_2': to_uint8_tensor(img_2, 255.),
+                'joint_c_1': torch.from_numpy(joint_c_1.astype(np.float32)),
+                'joint_c_2': torch.from_numpy(joint_c_2.astype(np.float32)),
+                'seg_cihp_label_1': to_uint8_tensor(seg_cihp_label_1),
+                'seg_cihp_label_2': to_uint8_tensor(seg_cihp_label_2),
+                'id_1': sid1,
+                'id_2': sid2
+            }
+            return self.add_flow(data, sid1, sid2)
+
         h, w = self.opt.image_size
         ######################
         # pack output data
@@ -172,9 +173,12 @@ class PoseTransferParsingDataset(BaseDataset):
             'img_2': self.tensor_normalize_std(self.to_tensor(img_2)),
             'joint_1': self.to_tensor(joint_1),
             'joint_2': self.to_tensor(joint_2),
+            # keypoints: pose content keys of PoseTransferModel.render()
+            'joint_c_1': torch.from_numpy(joint_c_1.astype(np.float32)),
+            'joint_c_2': torch.from_numpy(joint_c_2.astype(np.float32)),
             'seg_cihp_1': self.to_tensor(seg_cihp_1),
             'seg_cihp_2': self.to_tensor(seg_cihp_2),
             'id_1': sid1,
             'id_2': sid2
         }
-        return data
\ No newline at end of file
+        return self.add_flow(data, sid1, sid2)
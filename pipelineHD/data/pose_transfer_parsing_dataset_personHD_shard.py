@@ -0,0 +1,33 @@
+from __future__ import division
+import numpy as np
+import os
+from .pose_transfer_parsing_dataset_personHD import PoseTransferParsingDataset
+from .shard_store import ShardStore
+
+class PoseTransferParsingShardDataset(PoseTransferParsingDataset):
+    '''
+    Same samples as PoseTransferParsingDataset, read from a memory-mapped shard (see tools/build_shard.py) instead of
+    jpg/png files and the pose label file.
+    '''
+    def name(self):
+        return 'PoseTransferParsingShardDataset'
+
+    def init_source(self, opt):
+        self.shard = ShardStore(os.path.join(opt.data_root, opt.shard_dir))
+        assert tuple(opt.image_size) == self.shard.image_size, 'shard image size %s does not match opt.image_size %s' % (self.shard.image_size, opt.image_size)
+
+    def init_cache(self, opt):
+        # reading from the shard is already a memory copy, nothing to cache
+        self.image_cache = self.seg_cache = None
+
+    def read_image_uint8(self, sid):
+        return self.shard.get_image(sid)
+
+    def read_seg_cihp(self, sid):
+        return self.shard.get_seg(sid)[..., np.newaxis].astype(np.float32)
+
+    def read_seg_pred_cihp(self, sid1, sid2):
+        return self.shard.get_seg_pred(sid1, sid2)[..., np.newaxis].astype(np.float32)
+
+    def read_joint(self, sid):
+        return np.array(self.shard.get_joint(sid))
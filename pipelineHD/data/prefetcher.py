@@ -0,0 +1,125 @@
+from __future__ import division
+import queue
+import sys
+import threading
+import torch
+
+#####################################
+# Background batch prefetcher
+#####################################
+
+class _Failure(object):
+    # an exception raised in the prefetch thread, re-raised in the consumer
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+class BatchPrefetcher(object):
+    '''
+    Iterate a DataLoader in a background thread and assemble the model input of the next batches (device transfer,
+    compact payload expansion, see PoseTransferModel.assemble_input) while the current batch is being computed.
+
+    Yields (data, inputs); pass both to model.set_input(data, inputs). On GPU, batches are copied on a side stream
+    into device buffers that are reused, and the model uses the staged tensors as its input without another copy. The
+    main stream waits for the copy of a batch only when it is consumed, and a buffer is overwritten only after the
+    main stream is done with its previous batch. With depth=0, batches are yielded synchronously as (data, None).
+    '''
+
+    def __init__(self, loader, model, depth=2):
+        self.loader = loader
+        self.model = model
+        self.depth = depth
+        self.use_cuda = bool(model.gpu_ids)
+        self.stream = torch.cuda.Stream() if (self.use_cuda and depth > 0) else None
+        # buffer slots for the batches in the queue, the one being consumed and the one being staged
+        self.n_buffers = depth + 2
+        self.buffers = [{} for _ in range(self.n_buffers)]
+        # recorded on the main stream when the consumer moves on from the batch of a slot
+        self.released = [torch.cuda.Event() for _ in range(self.n_buffers)] if self.stream is not None else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def stage(self, data, slot):
+        '''
+        copy the tensors of a batch into the reused device buffers of a slot (on the side stream)
+        '''
+        buffers = self.buffers[slot]
+        # the previous batch of this slot may still be read by the model on the main stream
+        self.stream.wait_event(self.released[slot])
+        staged = {}
+        for k, v in data.items():
+            if not torch.is_tensor(v):
+                staged[k] = v
+                continue
+            buf = buffers.get(k)
+            if buf is None or buf.size() != v.size() or buf.dtype != v.dtype:
+                buf = buffers[k] = torch.empty(v.size(), dtype=v.dtype, device='cuda')
+            staged[k] = buf.copy_(v, non_blocking=True)
+        return staged
+
+    def produce(self, out_queue, stop):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    out_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for i, data in enumerate(self.loader):
+                if self.stream is not None:
+                    with torch.cuda.stream(self.stream):
+                        # copies of one slot and the reads of its previous batch are ordered on the same stream
+                        inputs = self.model.assemble_input(self.stage(data, i % self.n_buffers))
+                        event = torch.cuda.Event()
+                        event.record(self.stream)
+                else:
+                    inputs = self.model.assemble_input(data)
+                    event = None
+                if not put((data, inputs, event, i % self.n_buffers)):
+                    return
+            put(None)
+        except Exception:
+            put(_Failure(sys.exc_info()))
+
+    def __iter__(self):
+        if self.depth <= 0:
+            for data in self.loader:
+                yield data, None
+            return
+
+        out_queue = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self.produce, args=(out_queue, stop))
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                item = out_queue.get()
+                if item is None:
+                    break
+                if isinstance(item, _Failure):
+                    raise item.exc_info[1].with_traceback(item.exc_info[2])
+                data, inputs, event, slot = item
+                if event is not None:
+                    current = torch.cuda.current_stream()
+                    current.wait_event(event)
+                    for v in inputs.values():
+                        if torch.is_tensor(v):
+                            # the tensors were allocated on the side stream but are used on the main stream
+                            v.record_stream(current)
+                yield data, inputs
+                if event is not None:
+                    # all work of this batch has been queued on the main stream: its slot can be reused after it
+                    self.released[slot].record(torch.cuda.current_stream())
+        finally:
+            # also reached when the consumer stops early (break)
+            stop.set()
+            thread.join()
+
+
+def prefetch(loader, model, opt):
+    return BatchPrefetcher(loader, model, depth=opt.prefetch_depth)
@@ -0,0 +1,118 @@
+from __future__ import division
+import numpy as np
+import os
+import util.io as io
+from .flow_store import KeyIndex, pair_key
+
+#####################################
+# Memory-mapped PersonHD shard
+#####################################
+# layout of a shard directory (written by tools/build_shard.py):
+#   index.json:     {'image_size': [h, w], 'ids': [sid, ...], 'pairs': [[sid1, sid2], ...]}
+#   ids_keys.npy, ids_rows.npy:     sorted sample ids and their rows (see flow_store.KeyIndex)
+#   pairs_keys.npy, pairs_rows.npy: sorted pair keys and their rows in seg_pred.npy
+#   img.npy:        (N, h, w, 3) uint8. RGB image
+#   seg.npy:        (N, h, w) uint8. CIHP parsing label
+#   joint.npy:      (N, 18, 2) float32. (x,y) keypoints, negative for missing joints
+#   seg_pred.npy:   (M, h, w) uint8. optional, predicted target parsing of each pair (used at test time)
+
+class ShardStore(object):
+    '''
+    Random access to a shard directory. Every sample is one fixed-stride row, so reading it is a slice of a
+    memory-mapped file: no decode and no per-sample file open. Arrays are mapped lazily (after the object is sent to
+    DataLoader workers), and all workers / jobs reading the same shard share the page cache.
+    '''
+    arrays = ['img', 'seg', 'joint', 'seg_pred']
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        meta = io.load_json(os.path.join(store_dir, 'index.json'))
+        self.image_size = tuple(meta['image_size'])
+        self.index = KeyIndex(store_dir, 'ids', lambda: meta['ids'])
+        self.pair_index = KeyIndex(store_dir, 'pairs', lambda: [pair_key(*p) for p in meta['pairs']])
+        self._data = None
+        self._mode = 'r'
+
+    @classmethod
+    def create(cls, store_dir, ids, image_size, joint_nc=18, pairs=None):
+        '''
+        create an empty shard for the given sample ids (and, optionally, predicted parsing of the given pairs) and
+        open it for writing.
+        '''
+        io.mkdir_if_missing(store_dir)
+        h, w = image_size
+        pairs = pairs or []
+        io.save_json({'image_size': [h, w], 'ids': list(ids), 'pairs': [list(p) for p in pairs]},
+                     os.path.join(store_dir, 'index.json'))
+        KeyIndex.save(store_dir, 'ids', ids)
+        KeyIndex.save(store_dir, 'pairs', [pair_key(*p) for p in pairs])
+        shapes = {
+            'img': ((len(ids), h, w, 3), np.uint8),
+            'seg': ((len(ids), h, w), np.uint8),
+            'joint': ((len(ids), joint_nc, 2), np.float32),
+            'seg_pred': ((len(pairs), h, w), np.uint8),
+        }
+        for name, (shape, dtype) in shapes.items():
+            if shape[0] > 0:
+                np.lib.format.open_memmap(os.path.join(store_dir, name + '.npy'), mode='w+', dtype=dtype,
+                                          shape=shape)
+        store = cls(store_dir)
+        store._mode = 'r+'
+        return store
+
+    def _open(self):
+        if self._data is None:
+            self._data = {}
+            for name in self.arrays:
+                fn = os.path.join(self.store_dir, name + '.npy')
+                if os.path.isfile(fn):
+                    self._data[name] = np.load(fn, mmap_mode=self._mode)
+
+    def __getstate__(self):
+        # do not pickle the mapped arrays into worker processes
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, sid):
+        return sid in self.index
+
+    def get_image(self, sid):
+        '''
+        Output:
+            img: (h, w, 3) uint8 RGB. a read-only view of the mapped file
+        '''
+        self._open()
+        return self._data['img'][self.index[sid]]
+
+    def get_seg(self, sid):
+        '''
+        Output:
+            seg: (h, w) uint8
+        '''
+        self._open()
+        return self._data['seg'][self.index[sid]]
+
+    def get_seg_pred(self, sid1, sid2):
+        self._open()
+        return self._data['seg_pred'][self.pair_index[pair_key(sid1, sid2)]]
+
+    def get_joint(self, sid):
+        '''
+        Output:
+            joint: (18, 2) float32
+        '''
+        self._open()
+        return self._data['joint'][self.index[sid]]
+
+    def write(self, name, rows, values):
+        self._open()
+        self._data[name][rows] = values
+
+    def flush(self):
+        if self._data is not None:
+            for arr in self._data.values():
+                arr.flush()
@@ -7,7 +7,11 @@ import os
 import numpy as np
 import re
 import torch.nn.utils.spectral_norm as spectral_norm
+import torch.utils.checkpoint
+import contextlib
+from typing import Optional
 
+from .modules import warp_acc_flow
 
 def conv(in_channels, out_channels, kernel_size=3, stride=1, padding=0, dilation=1, bias=False, norm_layer=nn.BatchNorm2d):
     model = nn.Sequential(
@@ -19,40 +23,6 @@ def conv(in_channels, out_channels, kernel_size=3, stride=1, padding=0, dilation
 def channel_mapping(in_channels, out_channels, norm_layer=nn.BatchNorm2d, bias=False):
     return conv(in_channels, out_channels, kernel_size=1, norm_layer=norm_layer, bias=bias)
 
-###############################################################################
-# flow-based warping
-###############################################################################
-def warp_acc_flow(x, flow, mode='bilinear', mask=None, mask_value=-1):
-    '''
-    warp an image/tensor according to given flow.
-    Input:
-        x: (bsz, c, h, w)
-        flow: (bsz, c, h, w)
-        mask: (bsz, 1, h, w). 1 for valid region and 0 for invalid region. invalid region will be fill with "mask_value" in the output images.
-    Output:
-        y: (bsz, c, h, w)
-    '''
-    bsz, c, h, w = x.size()
-    # mesh grid
-    xx = x.new_tensor(range(w)).view(1,-1).repeat(h,1)
-    yy = x.new_tensor(range(h)).view(-1,1).repeat(1,w)
-    xx = xx.view(1,1,h,w).repeat(bsz,1,1,1)
-    yy = yy.view(1,1,h,w).repeat(bsz,1,1,1)
-    grid = torch.cat((xx,yy), dim=1).float()
-    grid = grid + flow
-    # scale to [-1, 1]
-    grid[:,0,:,:] = 2.0*grid[:,0,:,:]/max(w-1,1) - 1.0
-    grid[:,1,:,:] = 2.0*grid[:,1,:,:]/max(h-1,1) - 1.0
-
-    grid = grid.permute(0,2,3,1)
-    output = F.grid_sample(x, grid, mode=mode, padding_mode='zeros')
-    # mask = F.grid_sample(x.new_ones(x.size()), grid)
-    # mask = torch.where(mask<0.9999, mask.new_zeros(1), mask.new_ones(1))
-    # return output * mask
-    if mask is not None:
-        output = torch.where(mask>0.5, output, output.new_ones(1).mul_(mask_value))
-    return output
-
 class Identity(nn.Module):
     def __init__(self, dim=None):
         super(Identity, self).__init__()
@@ -157,6 +127,20 @@ class SPADE(nn.Module):
 
         return gamma, beta
 
+def region_mean_pool(codes, segmap):
+    '''
+    average features inside each region of a (one-hot) segmentation map, for all samples and regions at once.
+    Input:
+        codes: (bsz, f, h, w)
+        segmap: (bsz, s, h, w). nonzero entries mark the pixels of each region.
+    Output:
+        codes_vector: (bsz, s, f). regions with empty mask get zero vectors.
+    '''
+    mask = (segmap != 0).to(codes.dtype)
+    area = mask.sum(dim=(2, 3)).clamp(min=1).unsqueeze(2)
+    codes_vector = torch.einsum('bshw,bfhw->bsf', mask, codes) / area
+    return codes_vector
+
 class Zencoder(torch.nn.Module):
     def __init__(self, input_nc, output_nc, ngf=32, n_downsampling=2, norm_layer=nn.InstanceNorm2d):
         super(Zencoder, self).__init__()
@@ -186,28 +170,8 @@ class Zencoder(torch.nn.Module):
 
         segmap = F.interpolate(segmap, size=codes.size()[2:], mode='nearest')
 
-        b_size = codes.shape[0]
-        # h_size = codes.shape[2]
-        # w_size = codes.shape[3]
-        f_size = codes.shape[1]
-
-        s_size = segmap.shape[1]
-
-        codes_vector = torch.zeros((b_size, s_size, f_size), dtype=codes.dtype, device=codes.device)
-
-
-        for i in range(b_size):
-            for j in range(s_size):
-                # segmap_bool=segmap.type(torch.uint8)
-                component_mask_area = torch.sum(segmap.bool()[i, j])
+        return region_mean_pool(codes, segmap)
 
-                if component_mask_area > 0:
-                    codes_component_feature = codes[i].masked_select(segmap.bool()[i, j]).reshape(f_size,  component_mask_area).mean(1)
-                    codes_vector[i][j] = codes_component_feature
-
-                    # codes_avg[i].masked_scatter_(segmap.bool()[i, j], codes_component_mu)
-
-        return codes_vector
 
 class ACE(nn.Module):
     def __init__(self, config_text, norm_nc, label_nc, ACE_Name=None, status='train', spade_params=None, use_rgb=True):
@@ -251,7 +215,7 @@ class ACE(nn.Module):
     def forward(self, x, segmap, style_codes=None, obj_dic=None):
 
         # Part 1. generate parameter-free normalized activations
-        added_noise = (torch.randn(x.shape[0], x.shape[3], x.shape[2], 1).cuda() * self.noise_var).transpose(1, 3)
+        added_noise = (torch.randn(x.shape[0], x.shape[3], x.shape[2], 1, device=x.device, dtype=x.dtype) * self.noise_var).transpose(1, 3)
         normalized = self.param_free_norm(x+added_noise)
 
         # Part 2. produce scaling and bias conditioned on semantic map
@@ -259,10 +223,10 @@ class ACE(nn.Module):
 
         if self.use_rgb:
             [b_size, f_size, h_size, w_size] = normalized.shape
-            middle_avg = torch.zeros((b_size, self.style_length, h_size, w_size), device=normalized.device)
 
             if self.status == 'UI_mode':
                 ############## hard coding
+                middle_avg = torch.zeros((b_size, self.style_length, h_size, w_size), device=normalized.device)
 
                 for i in range(1):
                     for j in range(segmap.shape[1]):
@@ -275,41 +239,20 @@ class ACE(nn.Module):
                             else:
                                 style_code_tmp = obj_dic[str(j)]['ACE']
 
-                                middle_mu = F.relu(self.__getattr__('fc_mu' + str(j))(style_code_tmp))
+                                middle_mu = F.relu(self.fc_mu(style_code_tmp, j))
                                 component_mu = middle_mu.reshape(self.style_length, 1).expand(self.style_length,component_mask_area)
 
                                 middle_avg[i].masked_scatter_(segmap.bool()[i, j], component_mu)
 
             else:
+                # all (sample, part) style vectors in one grouped matmul, then broadcast them onto their
+                # regions with a single segmap-weighted sum (segmap is one-hot, so each pixel picks one part)
+                region_mask = (segmap[:, :self.fc_mu.n_group] != 0).to(normalized.dtype)
+                middle_mu = F.relu(self.fc_mu(style_codes))
+                middle_avg = torch.einsum('bsc,bshw->bchw', middle_mu, region_mask)
 
-                for i in range(b_size):
-                    for j in range(segmap.shape[1]):
-                        # segmap_bool = segmap.type(torch.uint8)
-                        component_mask_area = torch.sum(segmap.bool()[i, j])
-
-                        if component_mask_area > 0:
-
-
-                            middle_mu = F.relu(self.__getattr__('fc_mu' + str(j))(style_codes[i][j]))
-                            component_mu = middle_mu.reshape(self.style_length, 1).expand(self.style_length, component_mask_area)
-
-                            middle_avg[i].masked_scatter_(segmap.bool()[i, j], component_mu)
-
-
-                            if self.status == 'test' and self.save_npy and self.ACE_Name=='up_2_ACE_0':
-                                tmp = style_codes[i][j].cpu().numpy()
-                                dir_path = 'styles_test'
-
-                                ############### some problem with obj_dic[i]
-
-                                im_name = os.path.basename(obj_dic[i])
-                                folder_path = os.path.join(dir_path, 'style_codes', im_name, str(j))
-                                if not os.path.exists(folder_path):
-                                    os.makedirs(folder_path)
-
-                                style_code_path = os.path.join(folder_path, 'ACE.npy')
-                                np.save(style_code_path, tmp)
-
+                if self.status == 'test' and self.save_npy and self.ACE_Name=='up_2_ACE_0':
+                    self.save_style_codes(style_codes, region_mask, obj_dic)
 
             gamma_avg = self.conv_gamma(middle_avg)
             beta_avg = self.conv_beta(middle_avg)
@@ -331,33 +274,70 @@ class ACE(nn.Module):
 
         return out
 
-    def create_gamma_beta_fc_layers(self):
-
-
-        ###################  These codes should be replaced with torch.nn.ModuleList
-
-        style_length = self.style_length
-        # print(style_length)
-        self.fc_mu0 = nn.Linear(style_length, style_length)
-        self.fc_mu1 = nn.Linear(style_length, style_length)
-        self.fc_mu2 = nn.Linear(style_length, style_length)
-        self.fc_mu3 = nn.Linear(style_length, style_length)
-        self.fc_mu4 = nn.Linear(style_length, style_length)
-        self.fc_mu5 = nn.Linear(style_length, style_length)
-        self.fc_mu6 = nn.Linear(style_length, style_length)
-        self.fc_mu7 = nn.Linear(style_length, style_length)
-        self.fc_mu8 = nn.Linear(style_length, style_length)
-        self.fc_mu9 = nn.Linear(style_length, style_length)
-        self.fc_mu10 = nn.Linear(style_length, style_length)
-        self.fc_mu11 = nn.Linear(style_length, style_length)
-        self.fc_mu12 = nn.Linear(style_length, style_length)
-        self.fc_mu13 = nn.Linear(style_length, style_length)
-        self.fc_mu14 = nn.Linear(style_length, style_length)
-        self.fc_mu15 = nn.Linear(style_length, style_length)
-        self.fc_mu16 = nn.Linear(style_length, style_length)
-        self.fc_mu17 = nn.Linear(style_length, style_length)
-        self.fc_mu18 = nn.Linear(style_length, style_length)
-        self.fc_mu19 = nn.Linear(style_length, style_length)
+    def save_style_codes(self, style_codes, region_mask, obj_dic):
+        dir_path = 'styles_test'
+        for i in range(style_codes.size(0)):
+            for j in range(region_mask.size(1)):
+                if region_mask[i, j].sum() > 0:
+                    tmp = style_codes[i][j].cpu().numpy()
+
+                    ############### some problem with obj_dic[i]
+
+                    im_name = os.path.basename(obj_dic[i])
+                    folder_path = os.path.join(dir_path, 'style_codes', im_name, str(j))
+                    if not os.path.exists(folder_path):
+                        os.makedirs(folder_path)
+
+                    style_code_path = os.path.join(folder_path, 'ACE.npy')
+                    np.save(style_code_path, tmp)
+
+    def create_gamma_beta_fc_layers(self, n_group=20):
+        # one (style_length x style_length) linear layer per cihp part, stored as a single stacked parameter
+        self.fc_mu = LinearStack(self.style_length, self.style_length, n_group)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                              error_msgs):
+        # old checkpoints store the per-part layers separately as fc_mu0 ... fc_mu19
+        if self.use_rgb and (prefix + 'fc_mu0.weight') in state_dict:
+            for name in ['weight', 'bias']:
+                keys = [prefix + 'fc_mu%d.%s' % (j, name) for j in range(self.fc_mu.n_group)]
+                state_dict[prefix + 'fc_mu.' + name] = torch.cat([state_dict.pop(k) for k in keys], dim=0)
+        super(ACE, self)._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys,
+                                               unexpected_keys, error_msgs)
+
+
+class LinearStack(nn.Module):
+    '''
+    n_group independent linear layers applied in one batched matmul.
+    weight is stored as (n_group*out_features, in_features) so that the classname-based initializers
+    in networks.init_weights treat it like a regular nn.Linear weight.
+    '''
+
+    def __init__(self, in_features, out_features, n_group):
+        super(LinearStack, self).__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.n_group = n_group
+        self.weight = nn.Parameter(torch.Tensor(n_group * out_features, in_features))
+        self.bias = nn.Parameter(torch.Tensor(n_group * out_features))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # same distribution as the default nn.Linear initialization
+        bound = 1. / np.sqrt(self.in_features)
+        nn.init.uniform_(self.weight, -bound, bound)
+        nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, x, group: Optional[int] = None):
+        '''
+        x: (bsz, n_group, in_features), or (in_features,) when group is given
+        group: apply only the group-th layer
+        '''
+        weight = self.weight.view(self.n_group, self.out_features, self.in_features)
+        bias = self.bias.view(self.n_group, self.out_features)
+        if group is not None:
+            return F.linear(x, weight[group], bias[group])
+        return torch.einsum('bgi,goi->bgo', x, weight) + bias
 
 
 class ResidualBlock_SEAN(nn.Module):
@@ -506,6 +486,34 @@ class SPADEResnetBlock(nn.Module):
         return F.leaky_relu(x, 2e-1)
 
 
+@contextlib.contextmanager
+def frozen_norm_updates(modules):
+    '''
+    no spectral-norm power iteration and no batchnorm running-statistics update in modules, while batchnorm still
+    normalizes with batch statistics in training mode. used when activation checkpointing recomputes a forward pass:
+    the recomputation then gives the same spectral-norm weights (the u, v vectors updated by the first pass) and the
+    same outputs as the first pass, and the statistics are updated only once per step.
+    '''
+    saved = []
+    for m in modules:
+        if hasattr(m, 'weight_u') and m.training:
+            # the spectral-norm hook only runs the power iteration in training mode
+            saved.append((m, 'training', m.training))
+            m.training = False
+        elif isinstance(m, nn.modules.batchnorm._BatchNorm) and m.training and m.track_running_stats:
+            saved.append((m, 'momentum', m.momentum))
+            saved.append((m, 'num_batches_tracked', m.num_batches_tracked.clone()))
+            m.momentum = 0.
+    try:
+        yield
+    finally:
+        for m, name, value in reversed(saved):
+            if name == 'num_batches_tracked':
+                m.num_batches_tracked.copy_(value)
+            else:
+                setattr(m, name, value)
+
+
 class DualUnetGenerator_SEAN(nn.Module):
     '''
     Generator with spade, spade in both encoder and decoder.
@@ -513,10 +521,13 @@ class DualUnetGenerator_SEAN(nn.Module):
 
     def __init__(self, pose_nc, appearance_nc, output_nc, aux_output_nc=[], nf=32, max_nf=128, num_scales=7,
                  num_warp_scales=5, n_residual_blocks=2, norm='batch', vis_mode='none', activation=nn.ReLU(False),
-                 use_dropout=False, no_end_norm=False, gpu_ids=[], use_dismap='',isTrain=True):
+                 use_dropout=False, no_end_norm=False, gpu_ids=[], use_dismap='',isTrain=True, checkpoint_scales=()):
         '''
         vis_mode: ['none', 'hard_gate', 'soft_gate', 'residual']
         no_end_norm: remove normalization layer at the start and the end.
+        checkpoint_scales: scales whose encoder residual blocks and decoder blocks are recomputed in backward instead
+            of keeping their activations (activation checkpointing). only applies when gradients are computed. the
+            recomputation does not update spectral-norm vectors or batchnorm statistics again.
         '''
         super(DualUnetGenerator_SEAN, self).__init__()
         self.pose_nc = pose_nc
@@ -539,6 +550,7 @@ class DualUnetGenerator_SEAN(nn.Module):
         # if first layer of encoder and last layer of decoder to use norm (absolute symmetry for encoder and decoder)
         self.no_end_norm = no_end_norm
         self.is_train = isTrain
+        self.checkpoint_scales = set(checkpoint_scales)
         # cihp model's num of labels, here parsing human into 20 part
         self.nc_cihp = 20
         self.usedismap = (use_dismap != '')
@@ -547,7 +559,8 @@ class DualUnetGenerator_SEAN(nn.Module):
             self.nc_cihp_dec = self.nc_cihp + 12
         else:
             # print('****')
-            self.alpha = torch.Tensor([-0.1]).cuda()
+            # plain tensor (not a parameter/buffer); moved to the input's device in forward()
+            self.alpha = torch.Tensor([-0.1])
             self.nc_cihp_dec = self.nc_cihp
 
         if norm == 'batch':
@@ -665,11 +678,26 @@ class DualUnetGenerator_SEAN(nn.Module):
         '''
         expand feature from n channels to n*vis_expand_mult channels
         '''
-        feat_exp = [feat * (vis == i).float() for i in range(self.vis_expand_mult)]
+        feat_exp = [feat * (vis == i).to(feat.dtype) for i in range(self.vis_expand_mult)]
         return torch.cat(feat_exp, dim=1)
 
+    def build_flow_pyramid(self, flow, vis):
+        '''
+        flow and visibility maps at each warping scale, each level pooled from the previous one.
+        Output:
+            flow_pyramid: list of (flow_l, vis_l), l = 0 ... num_warp_scales-1. flow_l is in units of pixels at scale l.
+        '''
+        flow_l = flow
+        vis_l = vis.round()
+        flow_pyramid = [(flow_l, vis_l)]
+        for l in range(1, min(self.num_warp_scales, self.num_scales)):
+            flow_l = F.avg_pool2d(flow_l, kernel_size=2).div_(2)
+            vis_l = -F.max_pool2d(-vis_l, kernel_size=2)  # the priority is visible>invisible>background
+            flow_pyramid.append((flow_l, vis_l))
+        return flow_pyramid
+
     def forward(self, x_p, x_a, s_seg, d_seg, flow=None, vis=None, dismap=None, output_feats=False,
-                single_device=False):
+                single_device=False, flow_pyramid=None):
         '''
         x_p: (bsz, pose_nc, h, w), pose input
         x_a: (bsz, appearance_nc, h, w), appearance input
@@ -677,9 +705,14 @@ class DualUnetGenerator_SEAN(nn.Module):
         flow: (bsz, 2, h, w) or None. if flow==None, feature warping will not be performed
         s_seg: source seg
         d_seg: dest seg
+        flow_pyramid: output of build_flow_pyramid(flow, vis). if given, flow and vis are not needed.
         '''
         if len(self.gpu_ids) > 1 and (not single_device):
-            if flow is not None:
+            if flow_pyramid is not None:
+                return nn.parallel.data_parallel(self, (x_p, x_a, s_seg, d_seg, None, None, dismap),
+                                                 module_kwargs={'single_device': True, 'output_feats': output_feats,
+                                                                'flow_pyramid': flow_pyramid})
+            elif flow is not None:
                 assert vis is not None
                 # nn.parallel.data_parallel: not set device_ids, use all gpu. module_kwargs set model args.
                 return nn.parallel.data_parallel(self, (x_p, x_a, s_seg, d_seg, flow, vis, dismap),
@@ -689,78 +722,159 @@ class DualUnetGenerator_SEAN(nn.Module):
                                                  module_kwargs={'flow': None, 'vis': None, 'single_device': True,
                                                                 'output_feats': output_feats})
         else:
+            if flow_pyramid is None and flow is not None:
+                flow_pyramid = self.build_flow_pyramid(flow, vis)
+            hidden_a, x_a, style_codes = self.encode_appearance(x_a, s_seg)
+            hidden_p, x_p = self.encode_pose(x_p)
+            return self.decode(hidden_p, x_p, hidden_a, x_a, style_codes, d_seg, flow_pyramid, dismap, output_feats)
 
-            if dismap is not None:
-                dismap = torch.exp(self.alpha * dismap)
-
-            style_codes = self.Zencoder(input=x_a, segmap=s_seg)
-
-            use_fw = flow is not None
-            if use_fw:
-                vis = vis.round()
-            hidden_p = []
-            hidden_a = []
-            # encoding p
-            x_p = self.encp_pre_conv(x_p)
-            for l in range(self.num_scales):
-                for i in range(self.n_residual_blocks):
-                    x_p = self.__getattr__('encp_%d_res_%d' % (l, i))(x_p)
-                    hidden_p.append(x_p)
-                x_p = self.__getattr__('encp_%d_downsample' % l)(x_p)
-            # encoding a
-            x_a = self.enca_pre_conv(x_a)
-            for l in range(self.num_scales):
-                for i in range(self.n_residual_blocks):
-                    x_a = self.__getattr__('enca_%d_res_%d' % (l, i))(x_a)
-                    # feature warping
-                    if use_fw and l < self.num_warp_scales:
-                        if i == 0:  # compute flow and vis once at each scale
-                            flow_l = F.avg_pool2d(flow, kernel_size=2 ** l).div_(2 ** l) if l > 0 else flow
-                            vis_l = -F.max_pool2d(-vis,
-                                                  kernel_size=2 ** l) if l > 0 else vis  # the priority is visible>invisible>background
-                        x_w = warp_acc_flow(x_a, flow_l)
-                        if self.vis_mode == 'none':
-                            pass
-                        # x_w * vis
-                        elif self.vis_mode == 'hard_gate':
-                            x_w = x_w * (vis_l < 2).float()
-                        # x_w * conv(vis)
-                        elif self.vis_mode == 'soft_gate':
-                            x_we = self._vis_expand(x_w, vis_l)
-                            x_w = self.__getattr__('enca_%d_vis_%d' % (l, i))(x_w, x_we)
-                        # conv(x_w concat vis)
-                        elif self.vis_mode == 'residual':
-                            x_we = self._vis_expand(x_w, vis_l)
-                            x_w = self.__getattr__('enca_%d_vis_%d' % (l, i))(x_w, x_we)
-                        # conv(x_w)
-                        elif self.vis_mode == 'res_no_vis':
-                            x_w = self.__getattr__('enca_%d_vis_%d' % (l, i))(x_w)
-                        hidden_a.append(x_w)
-                    else:
-                        hidden_a.append(x_a)
-                x_a = self.__getattr__('enca_%d_downsample' % l)(x_a)
-            # bottleneck fusion
-            x = self.dec_fuse(torch.cat((x_p, x_a), dim=1))
-            feats = [x]
-            # decoding
-            if dismap is not None:
-                d_seg = torch.cat((d_seg, dismap), 1)
-            for l in range(self.num_scales - 1, -1, -1):
-                x = self.__getattr__('dec_%d_upsample_norm' % l)(x, d_seg,style_codes)
-                x = self.__getattr__('dec_%d_upsample' % l)(x)
-                feats = [x] + feats
-                for i in range(self.n_residual_blocks - 1, -1, -1):
-                    h_p = hidden_p.pop()
-                    h_a = hidden_a.pop()
-                    x = self.__getattr__('dec_%d_res_%d' % (l, i))(x, d_seg, style_codes,torch.cat((h_p, h_a), dim=1))
-            out = self.dec_output(x)
-            if self.aux_output_nc or output_feats:
-                aux_out = []
-                if self.aux_output_nc:
-                    for i in range(len(self.aux_output_nc)):
-                        aux_out.append(self.__getattr__('dec_aux_output_%d' % i)(x))
-                if output_feats:
-                    aux_out.append(feats)
-                return out, aux_out
-            else:
-                return out
+    def encode_pose(self, x_p):
+        '''
+        pose encoder. depends on the target pose only.
+        Output:
+            hidden_p: skip features after each residual block, from fine to coarse
+            x_p: bottleneck feature
+        '''
+        hidden_p = []
+        x_p = self.encp_pre_conv(x_p)
+        for l in range(self.num_scales):
+            x_p, hidden = self._run_checkpointed(l, self._encode_scale, 'encp', l, x_p)
+            hidden_p += hidden
+        return hidden_p, x_p
+
+    def encode_appearance(self, x_a, s_seg):
+        '''
+        appearance encoder and style codes. depends on the source only: feature warping is applied to the skip
+        features afterwards (see warp_appearance), so the result can be reused for many target poses.
+        Output:
+            hidden_a: unwarped skip features after each residual block, from fine to coarse
+            x_a: bottleneck feature
+            style_codes: (bsz, nc_cihp, style_length)
+        '''
+        style_codes = self.Zencoder(input=x_a, segmap=s_seg)
+        hidden_a = []
+        x_a = self.enca_pre_conv(x_a)
+        for l in range(self.num_scales):
+            x_a, hidden = self._run_checkpointed(l, self._encode_scale, 'enca', l, x_a)
+            hidden_a += hidden
+        return hidden_a, x_a, style_codes
+
+    def _encode_scale(self, branch, l, x):
+        '''
+        residual blocks and downsampling of the pose ('encp') or appearance ('enca') encoder at scale l
+        '''
+        hidden = []
+        for i in range(self.n_residual_blocks):
+            x = self.__getattr__('%s_%d_res_%d' % (branch, l, i))(x)
+            hidden.append(x)
+        x = self.__getattr__('%s_%d_downsample' % (branch, l))(x)
+        return x, hidden
+
+    def _decode_scale(self, l, x, d_seg, style_codes, hidden_p, hidden_a):
+        '''
+        upsampling and residual blocks of the decoder at scale l. hidden_p, hidden_a: skip features of scale l
+        Output:
+            x: output of scale l
+            x_up: upsampled feature (before the residual blocks)
+        '''
+        x = self.__getattr__('dec_%d_upsample_norm' % l)(x, d_seg, style_codes)
+        x_up = self.__getattr__('dec_%d_upsample' % l)(x)
+        x = x_up
+        for i in range(self.n_residual_blocks - 1, -1, -1):
+            x = self.__getattr__('dec_%d_res_%d' % (l, i))(x, d_seg, style_codes,
+                                                          torch.cat((hidden_p[i], hidden_a[i]), dim=1))
+        return x, x_up
+
+    def _run_checkpointed(self, l, fn, *args):
+        '''
+        fn(*args), with activation checkpointing if scale l is in checkpoint_scales and gradients are computed. the RNG
+        state is restored for the recomputation, so the ACE noise is the same in both passes, and spectral-norm /
+        batchnorm updates are frozen during the recomputation (see frozen_norm_updates), so backward differentiates the
+        function that produced the loss.
+        '''
+        if l in self.checkpoint_scales and torch.is_grad_enabled():
+            n_call = [0]
+
+            def run(*args):
+                n_call[0] += 1
+                if n_call[0] == 1:
+                    return fn(*args)
+                with frozen_norm_updates(self._scale_modules(l)):
+                    return fn(*args)
+            return torch.utils.checkpoint.checkpoint(run, *args, use_reentrant=False)
+        return fn(*args)
+
+    def _scale_modules(self, l):
+        '''
+        all modules of the encoder and decoder blocks at scale l
+        '''
+        prefixes = ('encp_%d_' % l, 'enca_%d_' % l, 'dec_%d_' % l)
+        return [m for name, child in self.named_children() if name.startswith(prefixes) for m in child.modules()]
+
+    def warp_appearance(self, hidden_a, flow_pyramid):
+        '''
+        warp the appearance skip features at the first num_warp_scales scales and integrate visibility.
+        '''
+        if flow_pyramid is None:
+            return list(hidden_a)
+        hidden_w = []
+        for l in range(self.num_scales):
+            for i in range(self.n_residual_blocks):
+                x_a = hidden_a[l * self.n_residual_blocks + i]
+                # feature warping
+                if l < self.num_warp_scales:
+                    flow_l, vis_l = flow_pyramid[l]
+                    x_w = warp_acc_flow(x_a, flow_l)
+                    if self.vis_mode == 'none':
+                        pass
+                    # x_w * vis
+                    elif self.vis_mode == 'hard_gate':
+                        x_w = x_w * (vis_l < 2).to(x_w.dtype)
+                    # x_w * conv(vis)
+                    elif self.vis_mode == 'soft_gate':
+                        x_we = self._vis_expand(x_w, vis_l)
+                        x_w = self.__getattr__('enca_%d_vis_%d' % (l, i))(x_w, x_we)
+                    # conv(x_w concat vis)
+                    elif self.vis_mode == 'residual':
+                        x_we = self._vis_expand(x_w, vis_l)
+                        x_w = self.__getattr__('enca_%d_vis_%d' % (l, i))(x_w, x_we)
+                    # conv(x_w)
+                    elif self.vis_mode == 'res_no_vis':
+                        x_w = self.__getattr__('enca_%d_vis_%d' % (l, i))(x_w)
+                    hidden_w.append(x_w)
+                else:
+                    hidden_w.append(x_a)
+        return hidden_w
+
+    def decode(self, hidden_p, x_p, hidden_a, x_a, style_codes, d_seg, flow_pyramid=None, dismap=None,
+               output_feats=False):
+        '''
+        warp the appearance features (outputs of encode_appearance) to the target pose and decode with the pose
+        features (outputs of encode_pose). the input lists are not modified.
+        '''
+        if dismap is not None:
+            dismap = torch.exp(self.alpha.to(dismap) * dismap)
+        hidden_a = self.warp_appearance(hidden_a, flow_pyramid)
+        # bottleneck fusion
+        x = self.dec_fuse(torch.cat((x_p, x_a), dim=1))
+        feats = [x]
+        # decoding
+        if dismap is not None:
+            d_seg = torch.cat((d_seg, dismap), 1)
+        n = self.n_residual_blocks
+        for l in range(self.num_scales - 1, -1, -1):
+            x, x_up = self._run_checkpointed(l, self._decode_scale, l, x, d_seg, style_codes,
+                                             hidden_p[l * n:(l + 1) * n], hidden_a[l * n:(l + 1) * n])
+            if output_feats:
+                feats = [x_up] + feats
+        out = self.dec_output(x)
+        if self.aux_output_nc or output_feats:
+            aux_out = []
+            if self.aux_output_nc:
+                for i in range(len(self.aux_output_nc)):
+                    aux_out.append(self.__getattr__('dec_aux_output_%d' % i)(x))
+            if output_feats:
+                aux_out.append(feats)
+            return out, aux_out
+        else:
+            return out
@@ -0,0 +1,430 @@
+'''
+Export-ready variant of SPG_net_deepfashion.DualUnetGenerator_SEAN for TorchScript and ONNX (see
+tools/export_generator.py).
+
+DualUnetGenerator_SEAN registers its layers under formatted names (encp_%d_res_%d, ...) and branches on python state
+(data_parallel, status == 'test' with np.save of style codes), which cannot be scripted. DualUnetGenerator_SEAN_Export
+regroups the same layers in nn.ModuleList stages with a fixed single-device inference path:
+    - spectral norm is folded into the conv weights (eval-mode weights, no power iteration)
+    - warping builds its sampling grid inline instead of using the python-side grid cache of warp_acc_flow
+    - dismap, aux outputs and output_feats are not supported
+The ACE noise injection is kept by default (same outputs as the original generator for the same random seed) and can
+be switched off with set_noise(False) before export for deterministic serving.
+'''
+from __future__ import division
+
+import copy
+import re
+from typing import List, Tuple
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from .SPG_net_deepfashion import DualUnetGenerator_SEAN
+
+
+def remove_all_spectral_norm(module):
+    '''
+    fold spectral norm into the weights of all submodules (in place)
+    '''
+    for m in module.modules():
+        if hasattr(m, 'weight_orig'):
+            nn.utils.remove_spectral_norm(m)
+    return module
+
+
+def fold_spectral_norm(state_dict):
+    '''
+    replace the weight_orig/weight_u/weight_v entries of spectral-normalized layers by the normalized weight, as
+    computed by spectral norm in eval mode
+    '''
+    state_dict = copy.copy(state_dict)
+    for key in [k for k in state_dict if k.endswith('.weight_orig')]:
+        prefix = key[:-len('weight_orig')]
+        weight = state_dict.pop(key)
+        u = state_dict.pop(prefix + 'weight_u')
+        v = state_dict.pop(prefix + 'weight_v')
+        sigma = torch.dot(u, torch.mv(weight.view(weight.size(0), -1), v))
+        state_dict[prefix + 'weight'] = weight / sigma
+    return state_dict
+
+
+def warp_flow(x, flow):
+    '''
+    same as modules.warp_acc_flow (bilinear, no mask), with the sampling grid built inline. sampling is done in
+    float32 and the output has the dtype of x.
+    Input:
+        x: (bsz, c, h, w)
+        flow: (bsz, 2, h, w)
+    '''
+    h = x.size(2)
+    w = x.size(3)
+    scale_x = 2.0 / max(w - 1, 1)
+    scale_y = 2.0 / max(h - 1, 1)
+    xx = torch.arange(w, dtype=torch.float32, device=x.device).view(1, 1, w).expand(1, h, w)
+    yy = torch.arange(h, dtype=torch.float32, device=x.device).view(1, h, 1).expand(1, h, w)
+    flow = flow.float()
+    grid_x = (xx * scale_x - 1.0) + flow[:, 0] * scale_x
+    grid_y = (yy * scale_y - 1.0) + flow[:, 1] * scale_y
+    grid = torch.stack((grid_x, grid_y), dim=3)
+    # align_corners=False is the grid_sample default used by warp_acc_flow
+    output = F.grid_sample(x.float(), grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+    return output.to(x.dtype)
+
+
+##################################################
+# blocks (wrap the layers of the original blocks)
+##################################################
+class ACE_Export(nn.Module):
+    '''
+    ACE (use_rgb=True) with the style codes of all parts given as a tensor.
+    '''
+    __constants__ = ['add_noise', 'n_group']
+
+    def __init__(self, ace, add_noise=True):
+        super(ACE_Export, self).__init__()
+        assert ace.use_rgb
+        self.add_noise = add_noise
+        self.n_group = ace.fc_mu.n_group
+        self.param_free_norm = ace.param_free_norm
+        self.Spade = ace.Spade
+        self.fc_mu = ace.fc_mu
+        self.conv_gamma = ace.conv_gamma
+        self.conv_beta = ace.conv_beta
+        self.blending_gamma = ace.blending_gamma
+        self.blending_beta = ace.blending_beta
+        self.noise_var = ace.noise_var
+
+    def forward(self, x, segmap, style_codes):
+        if self.add_noise:
+            added_noise = torch.randn(x.size(0), x.size(3), x.size(2), 1, device=x.device, dtype=x.dtype)
+            x = x + (added_noise * self.noise_var).transpose(1, 3)
+        normalized = self.param_free_norm(x)
+        segmap = F.interpolate(segmap, size=[x.size(2), x.size(3)], mode='nearest')
+
+        region_mask = (segmap[:, :self.n_group] != 0).to(normalized.dtype)
+        middle_mu = F.relu(self.fc_mu(style_codes))
+        middle_avg = torch.einsum('bsc,bshw->bchw', middle_mu, region_mask)
+        gamma_avg = self.conv_gamma(middle_avg)
+        beta_avg = self.conv_beta(middle_avg)
+
+        gamma_spade, beta_spade = self.Spade(segmap)
+        gamma_alpha = torch.sigmoid(self.blending_gamma)
+        beta_alpha = torch.sigmoid(self.blending_beta)
+        gamma_final = gamma_alpha * gamma_avg + (1 - gamma_alpha) * gamma_spade
+        beta_final = beta_alpha * beta_avg + (1 - beta_alpha) * beta_spade
+        return normalized * (1 + gamma_final) + beta_final
+
+
+class ResidualBlock_Export(nn.Module):
+    '''
+    ResidualBlock w/o additional input
+    '''
+    __constants__ = ['use_dropout']
+
+    def __init__(self, block):
+        super(ResidualBlock_Export, self).__init__()
+        self.use_dropout = block.use_dropout
+        self.activation = block.activation
+        self.conv = block.conv
+
+    def forward(self, x):
+        out = x + self.conv(self.activation(x))
+        if self.use_dropout:
+            out = F.dropout(out, p=0.5, training=self.training)
+        return out
+
+
+class ResidualBlockA_Export(nn.Module):
+    '''
+    ResidualBlock w/ additional input
+    '''
+    __constants__ = ['use_dropout']
+
+    def __init__(self, block):
+        super(ResidualBlockA_Export, self).__init__()
+        self.use_dropout = block.use_dropout
+        self.activation = block.activation
+        self.conv_a = block.conv_a
+        self.conv = block.conv
+
+    def forward(self, x, a):
+        a = self.conv_a(self.activation(a))
+        out = x + self.conv(self.activation(torch.cat((x, a), dim=1)))
+        if self.use_dropout:
+            out = F.dropout(out, p=0.5, training=self.training)
+        return out
+
+
+class ResidualBlock_SEAN_Export(nn.Module):
+    __constants__ = ['use_dropout']
+
+    def __init__(self, block, add_noise=True):
+        super(ResidualBlock_SEAN_Export, self).__init__()
+        self.use_dropout = block.use_dropout
+        self.activation = block.activation
+        self.conv_a = block.conv_a
+        self.conv_a_norm = ACE_Export(block.conv_a_norm, add_noise)
+        self.conv = block.conv
+        self.conv_norm = ACE_Export(block.conv_norm, add_noise)
+
+    def forward(self, x, x_seg, style_codes, a):
+        a = self.conv_a(self.activation(self.conv_a_norm(a, x_seg, style_codes)))
+        residual = torch.cat((x, a), dim=1)
+        residual = self.conv(self.activation(self.conv_norm(residual, x_seg, style_codes)))
+        out = x + residual
+        if self.use_dropout:
+            out = F.dropout(out, p=0.5, training=self.training)
+        return out
+
+
+##################################################
+# visibility gates of the warped appearance features
+##################################################
+class NoGate(nn.Module):
+    ''' vis_mode: none '''
+    def forward(self, x, vis):
+        return x
+
+
+class HardGate(nn.Module):
+    ''' vis_mode: hard_gate '''
+    def forward(self, x, vis):
+        return x * (vis < 2).to(x.dtype)
+
+
+class ExpandGate(nn.Module):
+    ''' vis_mode: soft_gate (block is a GateBlock) and residual (block is a ResidualBlockA_Export) '''
+    __constants__ = ['vis_expand_mult']
+
+    def __init__(self, block, vis_expand_mult):
+        super(ExpandGate, self).__init__()
+        self.block = block
+        self.vis_expand_mult = vis_expand_mult
+
+    def forward(self, x, vis):
+        x_we = torch.cat([x * (vis == i).to(x.dtype) for i in range(self.vis_expand_mult)], dim=1)
+        return self.block(x, x_we)
+
+
+class ResGate(nn.Module):
+    ''' vis_mode: res_no_vis '''
+    def __init__(self, block):
+        super(ResGate, self).__init__()
+        self.block = block
+
+    def forward(self, x, vis):
+        return self.block(x)
+
+
+##################################################
+# u-net stages
+##################################################
+class EncoderStage(nn.Module):
+    '''
+    residual blocks and downsampling of one encoder scale
+    '''
+    def __init__(self, res_blocks, downsample):
+        super(EncoderStage, self).__init__()
+        self.res = nn.ModuleList(res_blocks)
+        self.downsample = downsample
+
+    def forward(self, x):
+        # type: (torch.Tensor) -> Tuple[torch.Tensor, List[torch.Tensor]]
+        hidden = []
+        for block in self.res:
+            x = block(x)
+            hidden.append(x)
+        return self.downsample(x), hidden
+
+
+class DecoderStage(nn.Module):
+    '''
+    upsampling and residual blocks of one decoder scale. res_blocks are in decoding order (last skip feature first).
+    '''
+    def __init__(self, upsample_norm, upsample, res_blocks):
+        super(DecoderStage, self).__init__()
+        self.upsample_norm = upsample_norm
+        self.upsample = upsample
+        self.res = nn.ModuleList(res_blocks)
+
+    def forward(self, x, d_seg, style_codes, hidden_p, hidden_a):
+        # type: (torch.Tensor, torch.Tensor, torch.Tensor, List[torch.Tensor], List[torch.Tensor]) -> torch.Tensor
+        x = self.upsample(self.upsample_norm(x, d_seg, style_codes))
+        n = len(hidden_p)
+        for k, block in enumerate(self.res):
+            i = n - 1 - k
+            x = block(x, d_seg, style_codes, torch.cat((hidden_p[i], hidden_a[i]), dim=1))
+        return x
+
+
+class DualUnetGenerator_SEAN_Export(nn.Module):
+    '''
+    DualUnetGenerator_SEAN regrouped in nn.ModuleList stages, for torch.jit.script and torch.onnx.export.
+    forward(x_p, x_a, s_seg, d_seg, flow, vis) returns the same (pre-tanh) output as netG(x_p, x_a, s_seg, d_seg,
+    flow, vis) in eval mode.
+
+    usage:
+        netE = DualUnetGenerator_SEAN_Export(netG)          # netG: a trained DualUnetGenerator_SEAN
+    or, from a checkpoint of netG:
+        netE = DualUnetGenerator_SEAN_Export(DualUnetGenerator_SEAN(**kwargs))
+        netE.load_generator_state_dict(torch.load('checkpoints/<id>/best_net_netG.pth'))
+    '''
+    __constants__ = ['num_scales', 'n_residual_blocks', 'n_warp_scales', 'feat_warp']
+
+    def __init__(self, netG, feat_warp=True, add_noise=True):
+        '''
+        netG: DualUnetGenerator_SEAN. it is copied, the original is not modified.
+        feat_warp: same as --G_feat_warp. if False, flow and vis are ignored
+        add_noise: keep the noise injection of the ACE layers
+        '''
+        super(DualUnetGenerator_SEAN_Export, self).__init__()
+        assert isinstance(netG, DualUnetGenerator_SEAN)
+        assert not netG.usedismap and not netG.aux_output_nc, 'dismap and aux outputs are not supported'
+        netG = remove_all_spectral_norm(copy.deepcopy(netG))
+        self.num_scales = netG.num_scales
+        self.n_residual_blocks = netG.n_residual_blocks
+        self.feat_warp = feat_warp
+        n_warp_scales = min(netG.num_warp_scales, netG.num_scales) if feat_warp else 0
+        self.n_warp_scales = n_warp_scales
+
+        self.Zencoder = netG.Zencoder
+        self.encp_pre_conv = netG.encp_pre_conv
+        self.enca_pre_conv = netG.enca_pre_conv
+        self.dec_fuse = netG.dec_fuse
+        self.dec_output = netG.dec_output
+
+        def get(name, *index):
+            return netG.__getattr__(name % index)
+
+        res_range = range(self.n_residual_blocks)
+        self.encp_stages = nn.ModuleList([
+            EncoderStage([ResidualBlock_Export(get('encp_%d_res_%d', l, i)) for i in res_range],
+                         get('encp_%d_downsample', l)) for l in range(self.num_scales)])
+        self.enca_stages = nn.ModuleList([
+            EncoderStage([ResidualBlock_Export(get('enca_%d_res_%d', l, i)) for i in res_range],
+                         get('enca_%d_downsample', l)) for l in range(self.num_scales)])
+        # one gate per warped skip feature, in the order of the skip features
+        gates = []
+        for l in range(n_warp_scales):
+            for i in res_range:
+                if netG.vis_mode == 'none':
+                    gates.append(NoGate())
+                elif netG.vis_mode == 'hard_gate':
+                    gates.append(HardGate())
+                elif netG.vis_mode == 'soft_gate':
+                    gates.append(ExpandGate(get('enca_%d_vis_%d', l, i), netG.vis_expand_mult))
+                elif netG.vis_mode == 'residual':
+                    gates.append(ExpandGate(ResidualBlockA_Export(get('enca_%d_vis_%d', l, i)), netG.vis_expand_mult))
+                elif netG.vis_mode == 'res_no_vis':
+                    gates.append(ResGate(ResidualBlock_Export(get('enca_%d_vis_%d', l, i))))
+        self.vis_gates = nn.ModuleList(gates)
+        # from the coarsest to the finest scale
+        self.dec_stages = nn.ModuleList([
+            DecoderStage(ACE_Export(get('dec_%d_upsample_norm', l), add_noise), get('dec_%d_upsample', l),
+                         [ResidualBlock_SEAN_Export(get('dec_%d_res_%d', l, i), add_noise) for i in reversed(res_range)])
+            for l in range(self.num_scales - 1, -1, -1)])
+
+    def set_noise(self, add_noise):
+        '''
+        switch the noise injection of all ACE layers (before scripting / exporting)
+        '''
+        for m in self.modules():
+            if isinstance(m, ACE_Export):
+                m.add_noise = add_noise
+
+    def remap_key(self, key):
+        '''
+        state dict key of DualUnetGenerator_SEAN -> key of this module
+        '''
+        n = self.n_residual_blocks
+        m = re.match(r'(encp|enca)_(\d+)_res_(\d+)\.(.*)', key)
+        if m:
+            return '%s_stages.%s.res.%s.%s' % m.groups()
+        m = re.match(r'(encp|enca)_(\d+)_downsample\.(.*)', key)
+        if m:
+            return '%s_stages.%s.downsample.%s' % m.groups()
+        m = re.match(r'enca_(\d+)_vis_(\d+)\.(.*)', key)
+        if m:
+            l, i, rest = int(m.group(1)), int(m.group(2)), m.group(3)
+            # the gating layers are unused (and not exported) without feature warping
+            return 'vis_gates.%d.block.%s' % (l * n + i, rest) if l < self.n_warp_scales else None
+        m = re.match(r'dec_(\d+)_(upsample_norm|upsample)\.(.*)', key)
+        if m:
+            return 'dec_stages.%d.%s.%s' % (self.num_scales - 1 - int(m.group(1)), m.group(2), m.group(3))
+        m = re.match(r'dec_(\d+)_res_(\d+)\.(.*)', key)
+        if m:
+            return 'dec_stages.%d.res.%d.%s' % (self.num_scales - 1 - int(m.group(1)), n - 1 - int(m.group(2)),
+                                                m.group(3))
+        return key
+
+    def load_generator_state_dict(self, state_dict, strict=True):
+        '''
+        load a state dict (checkpoint) of DualUnetGenerator_SEAN: keys are remapped to the stages of this module,
+        spectral norm is folded into the weights and the old per-part ACE layers (fc_mu0 ... fc_mu19) are stacked.
+        '''
+        state_dict = fold_spectral_norm(state_dict)
+        # old checkpoints store the per-part ACE layers separately (see ACE._load_from_state_dict)
+        fc_mu = {}
+        for key in list(state_dict.keys()):
+            m = re.match(r'(.*)fc_mu(\d+)\.(weight|bias)$', key)
+            if m:
+                fc_mu.setdefault((m.group(1), m.group(3)), {})[int(m.group(2))] = state_dict.pop(key)
+        for (prefix, name), items in fc_mu.items():
+            state_dict[prefix + 'fc_mu.' + name] = torch.cat([items[j] for j in sorted(items)], dim=0)
+
+        remapped = {}
+        for key, value in state_dict.items():
+            new_key = self.remap_key(key)
+            if new_key is not None:
+                remapped[new_key] = value
+        return self.load_state_dict(remapped, strict=strict)
+
+    def build_flow_pyramid(self, flow, vis):
+        # type: (torch.Tensor, torch.Tensor) -> List[Tuple[torch.Tensor, torch.Tensor]]
+        '''
+        same as DualUnetGenerator_SEAN.build_flow_pyramid
+        '''
+        flow_l = flow
+        vis_l = vis.round()
+        flow_pyramid = [(flow_l, vis_l)]
+        for l in range(1, self.n_warp_scales):
+            flow_l = F.avg_pool2d(flow_l, kernel_size=2) / 2
+            vis_l = -F.max_pool2d(-vis_l, kernel_size=2)
+            flow_pyramid.append((flow_l, vis_l))
+        return flow_pyramid
+
+    def forward(self, x_p, x_a, s_seg, d_seg, flow, vis):
+        '''
+        x_p: (bsz, pose_nc, h, w), pose input
+        x_a: (bsz, appearance_nc, h, w), appearance input
+        s_seg, d_seg: (bsz, 20, h, w), source and target parsing (one-hot)
+        flow: (bsz, 2, h, w), vis: (bsz, 1, h, w). ignored if feat_warp is False
+        '''
+        style_codes = self.Zencoder(x_a, s_seg)
+        # appearance encoder
+        hidden_a = []
+        x_a = self.enca_pre_conv(x_a)
+        for stage in self.enca_stages:
+            x_a, hidden = stage(x_a)
+            hidden_a.extend(hidden)
+        # pose encoder
+        hidden_p = []
+        x_p = self.encp_pre_conv(x_p)
+        for stage in self.encp_stages:
+            x_p, hidden = stage(x_p)
+            hidden_p.extend(hidden)
+        # feature warping
+        if self.feat_warp:
+            flow_pyramid = self.build_flow_pyramid(flow, vis)
+            for k, gate in enumerate(self.vis_gates):
+                flow_l, vis_l = flow_pyramid[k // self.n_residual_blocks]
+                hidden_a[k] = gate(warp_flow(hidden_a[k], flow_l), vis_l)
+        # decoder
+        n = self.n_residual_blocks
+        x = self.dec_fuse(torch.cat((x_p, x_a), dim=1))
+        for j, stage in enumerate(self.dec_stages):
+            l = self.num_scales - 1 - j
+            x = stage(x, d_seg, style_codes, hidden_p[l * n:(l + 1) * n], hidden_a[l * n:(l + 1) * n])
+        return self.dec_output(x)
@@ -3,6 +3,7 @@ from __future__ import division, print_function
 import torch
 import torch.nn 
 import os
+from collections import OrderedDict
 
 class BaseModel(object):
     def name(self):
@@ -52,10 +53,9 @@ class BaseModel(object):
     def save_network(self, network, network_label, epoch_label, gpu_ids):
         save_filename = '%s_net_%s.pth' % (epoch_label, network_label)
         save_path = os.path.join(self.save_dir, save_filename)
-        torch.save(network.cpu().state_dict(), save_path)
-
-        if len(gpu_ids) and torch.cuda.is_available():
-            network.cuda()
+        # copy the weights instead of moving the network to CPU and back, which would swap the parameters of a network
+        # wrapped in DistributedDataParallel
+        torch.save(OrderedDict([(k, v.cpu()) for k, v in network.state_dict().items()]), save_path)
 
     def load_network(self, network, network_label, epoch_label, model_id = None, forced = True):
         save_filename = '%s_net_%s.pth' % (epoch_label, network_label)
@@ -69,7 +69,7 @@ class BaseModel(object):
         if (not forced) and (not os.path.isfile(save_path)):
             print('[%s] FAIL to load [%s] parameters from %s' % (self.name(), network_label, save_path))
         else:
-            network.load_state_dict(torch.load(save_path))
+            network.load_state_dict(torch.load(save_path, map_location=lambda storage, loc: storage))
             print('[%s] load [%s] parameters from %s' % (self.name(), network_label, save_path))
 
     def save_optim(self, optim, optim_label, epoch_label):
@@ -80,7 +80,7 @@ class BaseModel(object):
     def load_optim(self, optim, optim_label, epoch_label):
         save_filename = '%s_optim_%s.pth'%(epoch_label, optim_label)
         save_path = os.path.join(self.save_dir, save_filename)
-        optim.load_state_dict(torch.load(save_path))
+        optim.load_state_dict(torch.load(save_path, map_location=lambda storage, loc: storage))
 
     # update learning rate (called once every epoch)
     def update_learning_rate(self):
@@ -7,9 +7,8 @@ from torch.nn import init
 from torch.autograd import Variable
 from torch.optim import lr_scheduler
 import functools
+import contextlib
 import numpy as np
-from skimage.measure import compare_ssim, compare_psnr
-# from skimage.metrics import structural_similarity,peak_signal_noise_ratio
 
 ###############################################################################
 # model helper functions
@@ -21,6 +20,23 @@ def print_network(net):
     print(net)
     print('Total number of parameters: %d' % num_params)
 
+def autocast(device_type, dtype=None, enabled=True):
+    '''
+    torch.autocast context (pytorch>=1.10). a no-op context when disabled, so that callers also run on older versions
+    '''
+    if not enabled:
+        return contextlib.nullcontext() if hasattr(contextlib, 'nullcontext') else contextlib.suppress()
+    return torch.autocast(device_type=device_type, dtype=dtype)
+
+def fp32_region(x):
+    '''
+    context that disables autocast on the device of x. ops inside run in the precision of their inputs, which the
+    caller casts to float32 (e.g. sampling grids and gram matrices, whose precision/range fp16 cannot hold)
+    '''
+    if not hasattr(torch, 'autocast'):
+        return autocast(None, enabled=False)
+    return torch.autocast(device_type=x.device.type, enabled=False)
+
 def get_norm_layer(norm_type = 'instance'):
     if norm_type == 'batch':
         norm_layer = functools.partial(nn.BatchNorm2d, affine=True)
@@ -239,8 +255,11 @@ class GANLoss(nn.Module):
         return target_tensor.expand_as(input)
 
     def forward(self, input, target_is_real):
-        target_tensor = self.get_target_tensor(input, target_is_real)
-        return self.loss(input, target_tensor)
+        # binary_cross_entropy is not allowed under fp16 autocast
+        with fp32_region(input):
+            input = input.float()
+            target_tensor = self.get_target_tensor(input, target_is_real)
+            return self.loss(input, target_tensor)
 
 
 class VGGLoss(nn.Module):
@@ -286,7 +305,8 @@ class VGGLoss(nn.Module):
 
     def forward(self, X, Y, mask=None, loss_type='content', device_mode=None):
         '''
-        loss_type: 'content', 'style'
+        loss_type: 'content', 'style', or a list of them (e.g. ['content', 'style']) to compute several losses from a
+            single VGG pass over X and Y. a tuple of losses is returned in the latter case.
         device_mode: multi, single, sub
         '''
         bsz = X.size(0)
@@ -295,45 +315,64 @@ class VGGLoss(nn.Module):
 
         if device_mode == 'multi':
             if mask is None:
-                return nn.parallel.data_parallel(self, (X, Y), module_kwargs={'loss_type': loss_type, 'device_mode': 'sub', 'mask': None}).mean(dim=0)
+                loss = nn.parallel.data_parallel(self, (X, Y), module_kwargs={'loss_type': loss_type, 'device_mode': 'sub', 'mask': None})
             else:
-                return nn.parallel.data_parallel(self, (X, Y, mask), module_kwargs={'loss_type': loss_type, 'device_mode': 'sub'}).mean(dim=0)
+                loss = nn.parallel.data_parallel(self, (X, Y, mask), module_kwargs={'loss_type': loss_type, 'device_mode': 'sub'})
+            if isinstance(loss_type, (list, tuple)):
+                return tuple([l.mean(dim=0) for l in loss])
+            return loss.mean(dim=0)
         else:
+            # the target is usually a real image: its features (and gram matrices) need no graph
+            grad_y = torch.is_grad_enabled() and Y.requires_grad
             features_x = self.compute_feature(self.normalize(X))
-            features_y = self.compute_feature(self.normalize(Y))
+            with torch.set_grad_enabled(grad_y):
+                features_y = self.compute_feature(self.normalize(Y))
             if mask is not None:
                 features_x = [feat * F.adaptive_max_pool2d(mask, (feat.size(2), feat.size(3))) for feat in features_x]
                 features_y = [feat * F.adaptive_max_pool2d(mask, (feat.size(2), feat.size(3))) for feat in features_y]
 
-            # compute content loss
-            if loss_type == 'content':
-                loss = 0
-                for i, (feat_x, feat_y) in enumerate(zip(features_x, features_y)):
-                    loss += self.content_weights[i] * F.l1_loss(feat_x, feat_y, reduce=False).view(bsz, -1).mean(dim=1)
-            # compute style loss
-            if loss_type == 'style':
-                loss = 0
+            losses = []
+            for t in (loss_type if isinstance(loss_type, (list, tuple)) else [loss_type]):
+                if t == 'content':
+                    loss = self.content_loss(features_x, features_y)
+                elif t == 'style':
+                    loss = self.style_loss(features_x, features_y, grad_y)
+                else:
+                    raise ValueError('invalid loss_type: %s' % t)
+                if device_mode == 'single':
+                    loss = loss.mean(dim=0)
+                losses.append(loss)
+            return tuple(losses) if isinstance(loss_type, (list, tuple)) else losses[0]
+
+    def content_loss(self, features_x, features_y):
+        bsz = features_x[0].size(0)
+        loss = 0
+        for i, (feat_x, feat_y) in enumerate(zip(features_x, features_y)):
+            loss += self.content_weights[i] * F.l1_loss(feat_x, feat_y, reduction='none').view(bsz, -1).mean(dim=1)
+        return loss
+
+    def style_loss(self, features_x, features_y, grad_y=False):
+        '''
+        with shifted_style, the gram matrices of all shifts of a layer are computed in one batched matmul (see
+        shifted_gram_stack). a shift (dx, dy) contributes with weight 0.5, the unshifted gram matrix with weight 1.
+        '''
+        bsz = features_x[0].size(0)
+        loss = 0
+        for i, (feat_x, feat_y) in enumerate(zip(features_x, features_y)):
+            if self.style_weights[i] > 0:
                 if self.shifted_style:
                     # with cross_correlation
-                    for i, (feat_x, feat_y) in enumerate(zip(features_x, features_y)):
-                        if self.style_weights[i] > 0:
-                            for delta in self.shift_delta[i]:
-                                if delta == 0:
-                                    loss += self.style_weights[i] * F.mse_loss(self.gram_matrix(feat_x), self.gram_matrix(feat_y), reduce=False).view(bsz, -1).sum(dim=1)
-                                else:
-                                    loss += 0.5*self.style_weights[i] * \
-                                            (F.mse_loss(self.shifted_gram_matrix(feat_x, delta, 0), self.shifted_gram_matrix(feat_y, delta, 0), reduce=False) \
-                                            +F.mse_loss(self.shifted_gram_matrix(feat_x, 0, delta), self.shifted_gram_matrix(feat_y, 0, delta), reduce=False)).view(bsz, -1).sum(dim=1)
+                    shifts = [(0, 0)] + [s for delta in self.shift_delta[i] if delta > 0 for s in [(delta, 0), (0, delta)]]
                 else:
                     # without cross_correlation
-                    for i, (feat_x, feat_y) in enumerate(zip(features_x, features_y)):
-                        if self.style_weights[i] > 0:
-                            loss += self.style_weights[i] * F.mse_loss(self.gram_matrix(feat_x), self.gram_matrix(feat_y), reduce=False).view(bsz, -1).sum(dim=1)
-                            # loss += self.style_weights[i] * ((self.gram_matrix(feat_x) - self.gram_matrix(feat_y))**2).view(bsz, -1).mean(dim=1)
-                
-            if device_mode == 'single':
-                loss = loss.mean(dim=0)
-            return loss
+                    shifts = [(0, 0)]
+                coef = feat_x.new_tensor([1.] + [0.5] * (len(shifts) - 1))
+                gram_x = self.shifted_gram_stack(feat_x, shifts)
+                with torch.set_grad_enabled(grad_y):
+                    gram_y = self.shifted_gram_stack(feat_y, shifts)
+                err = (gram_x - gram_y).pow(2).view(bsz, len(shifts), -1).sum(dim=2)
+                loss += self.style_weights[i] * (err * coef).sum(dim=1)
+        return loss
 
     def normalize(self, x):
         # normalization parameters of input
@@ -352,6 +391,30 @@ class VGGLoss(nn.Module):
         g = torch.matmul(feat, feat_T) / (c*h*w)
         return g
 
+    def shifted_gram_stack(self, feat, shifts):
+        '''
+        gram matrices of feat and its shifted copies, equal to stacking shifted_gram_matrix(feat, shift_x, shift_y) for
+        all shifts. the shifted copies are zero padded to the full size, so all shifts share one batched matmul.
+        Input:
+            feat: (bsz, c, h, w)
+            shifts: list of (shift_x, shift_y)
+        Output:
+            g: (bsz, len(shifts), c, c)
+        '''
+        bsz, c, h, w = feat.size()
+        shifted = []
+        for shift_x, shift_y in shifts:
+            assert shift_x<w and shift_y<h
+            if shift_x == 0 and shift_y == 0:
+                shifted.append(feat)
+            else:
+                shifted.append(F.pad(feat[:,:,:(h-shift_y),:(w-shift_x)], (shift_x, 0, shift_y, 0)))
+        shifted = torch.stack(shifted, dim=1).view(bsz, len(shifts), c, h*w)
+        # sums over h*w products overflow in fp16 at high resolution
+        with fp32_region(feat):
+            g = torch.matmul(feat.float().view(bsz, 1, c, h*w), shifted.float().transpose(2,3)) / (c*h*w)
+        return g
+
     def shifted_gram_matrix(self, feat, shift_x, shift_y):
         bsz, c, h, w = feat.size()
         assert shift_x<w and shift_y<h
@@ -559,43 +622,113 @@ class MeanAP():
 ###############################################################################
 # image similarity metrics
 ###############################################################################
-class PSNR(nn.Module):
-    def forward(self, images_1, images_2):
-        numpy_imgs_1 = images_1.cpu().detach().numpy().transpose(0,2,3,1)
-        numpy_imgs_1 = ((numpy_imgs_1 + 1.0) * 127.5).clip(0,255).astype(np.uint8)
-        numpy_imgs_2 = images_2.cpu().detach().numpy().transpose(0,2,3,1)
-        numpy_imgs_2 = ((numpy_imgs_2 + 1.0) * 127.5).clip(0,255).astype(np.uint8)
+def to_uint8_range(images):
+    '''
+    [-1, 1] images to the integer values of their uint8 version, computed as the numpy conversion
+    ((x + 1) * 127.5).clip(0, 255).astype(np.uint8) (which truncates) but kept as a float tensor on the device.
+    '''
+    return ((images.detach().float() + 1.0) * 127.5).clamp(0, 255).floor()
 
-        psnr_score = []
-        for img_1, img_2 in zip(numpy_imgs_1, numpy_imgs_2):
-            psnr_score.append(compare_psnr(img_2, img_1))
-            # psnr_score.append(peak_signal_noise_ratio(img_2, img_1))
 
-        return Variable(images_1.data.new(1).fill_(np.mean(psnr_score)))
+class PSNR(nn.Module):
+    '''
+    mean PSNR of a batch of [-1, 1] images, equal to averaging skimage compare_psnr over the uint8 images. batched,
+    on the device of the input and without host synchronization.
+    Output:
+        psnr: (1,)
+    '''
+    def forward(self, images_1, images_2):
+        x = to_uint8_range(images_1)
+        y = to_uint8_range(images_2)
+        mse = (x - y).pow(2).flatten(1).mean(dim=1)
+        psnr = 10 * torch.log10(255. ** 2 / mse)
+        return psnr.mean().view(1)
 
 
 class SSIM(nn.Module):
+    '''
+    mean SSIM of a batch of [-1, 1] images, equal (up to float32 rounding) to averaging skimage
+    compare_ssim(img_1, img_2, multichannel=True) over the uint8 images: 7x7 uniform window, or with
+    gaussian_weights=True, the 11x11 gaussian window (sigma=1.5) of compare_ssim(..., gaussian_weights=True).
+    batched, on the device of the input and without host synchronization.
+    Input:
+        mask: (bsz, 1, h, w) optional. images are multiplied by the (binarized) mask before comparison
+    Output:
+        ssim: (1,)
+    '''
+    def __init__(self, gaussian_weights=False, K1=0.01, K2=0.03):
+        super(SSIM, self).__init__()
+        self.gaussian_weights = gaussian_weights
+        if gaussian_weights:
+            sigma = 1.5
+            win_size = 2 * int(3.5 * sigma + 0.5) + 1
+            k = torch.exp(-(torch.arange(win_size, dtype=torch.float64) - win_size // 2) ** 2 / (2 * sigma ** 2))
+            k = k / k.sum()
+        else:
+            win_size = 7
+            k = torch.ones(win_size, dtype=torch.float64) / win_size
+        self.win_size = win_size
+        # skimage normalizes the (co)variances as sample statistics of the window
+        n = win_size ** 2
+        self.cov_norm = n / (n - 1.)
+        self.C1 = (K1 * 255) ** 2
+        self.C2 = (K2 * 255) ** 2
+        self.register_buffer('window', k.float())
+
+    def filter(self, x):
+        # separable filter without padding: skimage crops the (win_size-1)/2 border before averaging anyway
+        if not self.gaussian_weights:
+            return F.avg_pool2d(x, self.win_size, stride=1)
+        c = x.size(1)
+        k = self.window.to(x)
+        x = F.conv2d(x, k.view(1, 1, 1, -1).expand(c, 1, 1, -1), groups=c)
+        x = F.conv2d(x, k.view(1, 1, -1, 1).expand(c, 1, -1, 1), groups=c)
+        return x
+
     def forward(self, images_1, images_2, mask=None):
-        numpy_imgs_1 = images_1.cpu().detach().numpy().transpose(0,2,3,1)
-        numpy_imgs_1 = ((numpy_imgs_1 + 1.0) * 127.5).clip(0,255).astype(np.uint8)
-        numpy_imgs_2 = images_2.cpu().detach().numpy().transpose(0,2,3,1)
-        numpy_imgs_2 = ((numpy_imgs_2 + 1.0) * 127.5).clip(0,255).astype(np.uint8)
+        x = to_uint8_range(images_1)
+        y = to_uint8_range(images_2)
         if mask is not None:
-            mask = mask.cpu().detach().numpy().transpose(0,2,3,1).astype(np.uint8)
-            numpy_imgs_1 = numpy_imgs_1 * mask
-            numpy_imgs_2 = numpy_imgs_2 * mask
-
-        ssim_score = []
-        for img_1, img_2 in zip(numpy_imgs_1, numpy_imgs_2):
-            ssim_score.append(compare_ssim(img_1, img_2, multichannel=True))
-            # ssim_score.append(structural_similarity(img_1, img_2, multichannel=True))
-        return Variable(images_1.data.new(1).fill_(np.mean(ssim_score)))
+            mask = mask.detach().float().floor()
+            x = x * mask
+            y = y * mask
+        # second moments of the centered images, to limit cancellation in float32. all five maps in one filter call
+        xc = x - 127.5
+        yc = y - 127.5
+        uxc, uyc, uxx, uyy, uxy = self.filter(torch.cat((xc, yc, xc * xc, yc * yc, xc * yc), dim=1)).chunk(5, dim=1)
+        ux = uxc + 127.5
+        uy = uyc + 127.5
+        vx = self.cov_norm * (uxx - uxc * uxc)
+        vy = self.cov_norm * (uyy - uyc * uyc)
+        vxy = self.cov_norm * (uxy - uxc * uyc)
+        S = ((2 * ux * uy + self.C1) * (2 * vxy + self.C2)) / ((ux ** 2 + uy ** 2 + self.C1) * (vx + vy + self.C2))
+        return S.flatten(1).mean(dim=1).mean().view(1)
 
 
 
 ###############################################################################
 # flow-based warping
 ###############################################################################
+_warp_base_grids = {}
+
+def get_warp_base_grid(h, w, dtype, device):
+    '''
+    identity sampling grid in grid_sample coordinates ([-1, 1]), together with the factor that maps a pixel
+    displacement to the same coordinates. cached per (h, w, dtype, device) since the warping is called at every
+    scale of every generator forward.
+    Output:
+        base_grid: (1, h, w, 2)
+        scale: (2,)
+    '''
+    key = (h, w, dtype, device)
+    if key not in _warp_base_grids:
+        scale = torch.tensor([2.0 / max(w - 1, 1), 2.0 / max(h - 1, 1)], dtype=dtype, device=device)
+        xx = torch.arange(w, dtype=dtype, device=device).view(1, -1).expand(h, w)
+        yy = torch.arange(h, dtype=dtype, device=device).view(-1, 1).expand(h, w)
+        base_grid = torch.stack((xx, yy), dim=2).mul(scale).sub(1.0).unsqueeze(0)
+        _warp_base_grids[key] = (base_grid, scale)
+    return _warp_base_grids[key]
+
 def warp_acc_flow(x, flow, mode='bilinear', mask=None, mask_value=-1):
     '''
     warp an image/tensor according to given flow.
@@ -607,24 +740,15 @@ def warp_acc_flow(x, flow, mode='bilinear', mask=None, mask_value=-1):
         y: (bsz, c, h, w)
     '''
     bsz, c, h, w = x.size()
-    # mesh grid
-    xx = x.new_tensor(range(w)).view(1,-1).repeat(h,1)
-    yy = x.new_tensor(range(h)).view(-1,1).repeat(1,w)
-    xx = xx.view(1,1,h,w).repeat(bsz,1,1,1)
-    yy = yy.view(1,1,h,w).repeat(bsz,1,1,1)
-    grid = torch.cat((xx,yy), dim=1).float()
-    grid = grid + flow
-    # scale to [-1, 1]
-    grid[:,0,:,:] = 2.0*grid[:,0,:,:]/max(w-1,1) - 1.0
-    grid[:,1,:,:] = 2.0*grid[:,1,:,:]/max(h-1,1) - 1.0
-
-    grid = grid.permute(0,2,3,1)
-    output = F.grid_sample(x, grid, mode=mode, padding_mode='zeros')
-    # mask = F.grid_sample(x.new_ones(x.size()), grid)
-    # mask = torch.where(mask<0.9999, mask.new_zeros(1), mask.new_ones(1))
-    # return output * mask
+    # sampling is always done in float32: half precision grid coordinates are off by up to 1/4 pixel at 512 px.
+    # the output has the dtype of x
+    with fp32_region(x):
+        base_grid, scale = get_warp_base_grid(h, w, torch.float32, x.device)
+        # grid = (base + flow) scaled to [-1, 1], in one op
+        grid = torch.addcmul(base_grid, flow.permute(0,2,3,1).float(), scale)
+        output = F.grid_sample(x.float(), grid, mode=mode, padding_mode='zeros').to(x.dtype)
     if mask is not None:
-        output = torch.where(mask>0.5, output, output.new_ones(1).mul_(mask_value))
+        output = output.masked_fill(mask <= 0.5, mask_value)
     return output
 
 ###############################################################################
@@ -1,7 +1,6 @@
 from __future__ import division
 from .modules import *
 
-from skimage.measure import compare_ssim, compare_psnr
 import functools
 
 ##############################################
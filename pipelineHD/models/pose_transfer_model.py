@@ -12,6 +12,9 @@ from . import SPG_net_deepfashion
 from . import networks
 from .base_model import BaseModel
 from util import io, pose_util
+from util import distributed as dist_util
+from util.lru_cache import LRUCache, tensor_hash
+from data.base_dataset import kp_to_map_tensor, seg_label_to_map_tensor
 
 class PoseTransferModel(BaseModel):
     '''
@@ -49,7 +52,8 @@ class PoseTransferModel(BaseModel):
                     use_dropout=opt.use_dropout,
                     no_end_norm=opt.G_no_end_norm,
                     gpu_ids=opt.gpu_ids,
-                    isTrain = self.is_train
+                    isTrain = self.is_train,
+                    checkpoint_scales=opt.G_checkpoint_scales
         )
         # print(self.netG)
         if opt.gpu_ids:
@@ -99,12 +103,41 @@ class PoseTransferModel(BaseModel):
             self.netF.eval()
             if opt.gpu_ids:
                 self.netF.cuda()
+        ###################################
+        # target-pose caches (used by render)
+        ###################################
+        if opt.pose_cache_size > 0:
+            self.pose_cache = LRUCache(opt.pose_cache_size)
+            self.flow_cache = LRUCache(opt.pose_cache_size)
+        else:
+            self.pose_cache = None
+            self.flow_cache = None
+        # number of encode_source() calls: identifies the source in cache keys
+        self.n_source = 0
+
+        ###################################
+        # mixed precision
+        ###################################
+        self.amp_device = 'cuda' if opt.gpu_ids else 'cpu'
+        if opt.amp == 'none':
+            self.amp_dtype = None
+        elif opt.amp == 'fp16' and opt.gpu_ids:
+            self.amp_dtype = torch.float16
+        else:
+            # CPU autocast only supports bf16
+            self.amp_dtype = torch.bfloat16
+        # loss scaling is only needed with fp16 (bf16 has the exponent range of fp32). one scaler for the losses of netG
+        # and netD, updated once per iteration
+        self.scaler = torch.cuda.amp.GradScaler() if self.is_train and self.amp_dtype == torch.float16 else None
 
         ###################################
         # loss and optimizers
         ###################################
-        # self.crit_psnr = networks.PSNR().cuda()
-        self.crit_ssim = networks.SSIM().cuda()
+        self.crit_psnr = networks.PSNR()
+        self.crit_ssim = networks.SSIM()
+        if opt.gpu_ids:
+            self.crit_psnr.cuda()
+            self.crit_ssim.cuda()
 
         if self.is_train:
             self.crit_vgg = networks.VGGLoss(opt.gpu_ids, shifted_style=opt.shifted_style_loss,
@@ -154,44 +187,123 @@ class PoseTransferModel(BaseModel):
             self.schedulers = []
             for optim in self.optimizers:
                 self.schedulers.append(networks.get_scheduler(optim, opt))
-
-    def set_input(self, data):
-        self.input_list = [
+        # DistributedDataParallel wrappers of the trained networks (see wrap_distributed)
+        self.ddp_nets = {}
+
+    def wrap_distributed(self):
+        '''
+        wrap the trained networks in DistributedDataParallel (torch.distributed must be initialized), so that their
+        gradients are averaged over all processes in backward. parameters and buffers of all networks start from the
+        ones of rank 0. the plain networks stay in self.netG / self.netPW / self.netD for saving, loading and inference.
+        '''
+        device_ids = [torch.cuda.current_device()] if self.gpu_ids else None
+        trained = ['netPW'] if self.opt.G_pix_warp else ['netG']
+        if self.use_gan:
+            trained.append('netD')
+        for name in ['netG', 'netPW']:
+            if hasattr(self, name) and name not in trained:
+                # used but not trained: only needs the same weights everywhere
+                dist_util.broadcast_module(getattr(self, name))
+        for name in trained:
+            self.ddp_nets[name] = nn.parallel.DistributedDataParallel(getattr(self, name), device_ids=device_ids)
+
+    def get_network(self, name):
+        '''
+        network to call in a forward pass: its DistributedDataParallel wrapper when training in distributed mode, the
+        plain network otherwise (and always under torch.no_grad, where no gradient has to be synchronized)
+        '''
+        if name in self.ddp_nets and torch.is_grad_enabled():
+            return self.ddp_nets[name]
+        return getattr(self, name)
+
+    def autocast(self):
+        '''
+        autocast context of --amp (a no-op context with --amp none)
+        '''
+        return networks.autocast(self.amp_device, self.amp_dtype, enabled=self.amp_dtype is not None)
+
+    def scale_loss(self, loss):
+        return self.scaler.scale(loss) if self.scaler is not None else loss
+
+    def step_optimizer(self, optim):
+        if self.scaler is not None:
+            # skips the step if the scaled gradients contain inf/nan
+            self.scaler.step(optim)
+        else:
+            optim.step()
+
+    def set_input(self, data, inputs=None):
+        '''
+        inputs: the result of assemble_input(data) if it has already been computed (see data/prefetcher.py)
+        '''
+        if inputs is None:
+            inputs = self.assemble_input(data)
+        self.input_list = self.get_input_list()
+        self.input.update(inputs)
+
+    def get_input_list(self):
+        input_list = [
             'img_1',
             'img_2',
             'joint_1',
             'joint_2',
         ]
         if self.use_parsing:
-            self.input_list += ['seg_cihp_1',
-                                'seg_cihp_2'
-                                ]
-
-        for item in self.input_list:
-            self.input[item] = self.Tensor(data[item].size()).copy_(data[item])
-
-        self.input['id'] = zip(data['id_1'], data['id_2'])
+            input_list += ['seg_cihp_1',
+                           'seg_cihp_2'
+                           ]
+        if not self.opt.flow_on_the_fly:
+            # precomputed by tools/precompute_flow.py
+            input_list += ['flow_2to1', 'vis_2']
+        return input_list
+
+    def assemble_input(self, data):
+        '''
+        input tensors of a batch on the model device. model state is not touched, so this can run in a background
+        thread while the previous batch is computed.
+        '''
+        inputs = OrderedDict()
+        for item in self.get_input_list():
+            inputs[item] = self.load_input(data, item)
+        inputs['id'] = zip(data['id_1'], data['id_2'])
+        return inputs
+
+    def payload_item(self, item):
+        '''
+        name of the dataloader item that carries input item (see --compact_payload)
+        '''
+        if self.opt.compact_payload:
+            if item.startswith('joint_'):
+                return 'joint_c_' + item[len('joint_'):]
+            elif item.startswith('seg_cihp_'):
+                return 'seg_cihp_label_' + item[len('seg_cihp_'):]
+        return item
+
+    def load_input(self, data, item):
+        '''
+        an input item on the model device. with --compact_payload, images arrive as uint8, joints as (18,2)
+        keypoints and parsing maps as uint8 labels, and are expanded here. other items are not copied if they already
+        are float32 tensors on the device (e.g. staged by data/prefetcher.py): the result may share their memory.
+        '''
+        src = data[self.payload_item(item)]
+        if self.gpu_ids:
+            # no copy for tensors already staged on the device by the prefetcher
+            src = src.cuda(non_blocking=True)
+        if not self.opt.compact_payload or item.startswith(('flow_', 'vis_')):
+            # float32 tensors are used as they are
+            return src.float()
+        if item.startswith('img_'):
+            return src.float().div_(255.).sub_(0.5).div_(0.5)
+        elif item.startswith('joint_'):
+            h, w = self.opt.image_size
+            return kp_to_map_tensor(src, img_sz=(w, h), mode=self.opt.joint_mode, radius=self.opt.joint_radius)
+        elif item.startswith('seg_cihp_'):
+            return seg_label_to_map_tensor(src, nc=self.seg_cihp_nc)
+        else:
+            raise ValueError('unknown input item: %s' % item)
 
     def forward(self, test=False):
-        # generate flow
-        flow_scale = 20.
-        if self.opt.flow_on_the_fly:
-            with torch.no_grad():
-                input_F = self.get_tensor(self.opt.F_input_type)
-                flow_out, vis_out, _, _ = self.netF(input_F)
-                self.output['vis_out'] = vis_out.argmax(dim=1, keepdim=True).float()
-                self.output['mask_out'] = (self.output['vis_out'] < 2).float()
-                self.output['flow_out'] = flow_out * flow_scale * self.output['mask_out']
-        else:
-            self.output['flow_out'] = self.input['flow_2to1']
-            self.output['vis_out'] = self.input['vis_2']
-            self.output['mask_out'] = (self.output['vis_out'] < 2).float()
-            self.output['flow_tar'] = self.output['flow_out']
-            self.output['vis_tar'] = self.output['vis_out']
-            self.output['maks_tar'] = self.output['mask_out']
-        bsz, _, h, w = self.output['vis_out'].size()
-        self.output['vismap_out'] = self.output['vis_out'].new(bsz, 3, h, w).scatter_(dim=1, index=self.output[
-            'vis_out'].long(), value=1)
+        self.generate_flow()
 
         # warp image
         self.output['img_warp'] = networks.warp_acc_flow(self.input['img_1'], self.output['flow_out'],
@@ -200,8 +312,8 @@ class PoseTransferModel(BaseModel):
         # generate image
         if self.opt.which_model_G == 'unet':
             input_G = self.get_tensor('+'.join([self.opt.G_appearance_type, self.opt.G_pose_type]))
-            out = self.netG(input_G)
-            self.output['img_out'] = F.tanh(out)
+            out = self.get_network('netG')(input_G)
+            self.output['img_out'] = F.tanh(out.float())
         elif self.opt.which_model_G == 'dual_unet':
             input_G_pose = self.get_tensor(self.opt.G_pose_type)
             input_G_appearance = self.get_tensor(self.opt.G_appearance_type)
@@ -213,14 +325,14 @@ class PoseTransferModel(BaseModel):
 
             dismap = None
             if not self.opt.G_pix_warp:
-                out = self.netG(input_G_pose, input_G_appearance, input_G_s_seg, input_G_d_seg, flow_in, vis_in, dismap)
-                self.output['img_out'] = F.tanh(out)
+                out = self.get_network('netG')(input_G_pose, input_G_appearance, input_G_s_seg, input_G_d_seg, flow_in, vis_in, dismap)
+                self.output['img_out'] = F.tanh(out.float())
             else:
                 with torch.no_grad():
                     out = self.netG(input_G_pose, input_G_appearance, input_G_s_seg, input_G_d_seg, flow_in, vis_in)
-                self.output['img_out_G'] = F.tanh(out)
-                pw_out = self.netPW(self.get_tensor(self.opt.G_pix_warp_input_type))
-                self.output['pix_mask'] = F.sigmoid(pw_out[0])
+                self.output['img_out_G'] = F.tanh(out.float())
+                pw_out = self.get_network('netPW')(self.get_tensor(self.opt.G_pix_warp_input_type))
+                self.output['pix_mask'] = F.sigmoid(pw_out[0].float())
                 if self.opt.G_pix_warp_detach:
                     self.output['img_out'] = self.output['img_warp'] * self.output['pix_mask'] + self.output[
                         'img_out_G'].detach() * (1 - self.output['pix_mask'])
@@ -229,10 +341,163 @@ class PoseTransferModel(BaseModel):
                         'img_out_G'] * (1 - self.output['pix_mask'])
         self.output['img_tar'] = self.input['img_2']
 
+    def generate_flow(self, flow_keys=None):
+        '''
+        flow_keys: per-sample keys of netF input. if given, flow is looked up in / added to self.flow_cache
+        '''
+        if self.opt.flow_on_the_fly:
+            with torch.no_grad():
+                input_F = self.get_tensor(self.opt.F_input_type)
+                if flow_keys is None:
+                    flow_out, vis_out = self.run_flow_network(input_F)
+                else:
+                    flow_out, vis_out = self.cached_per_sample(self.flow_cache, flow_keys,
+                                                               lambda index: self.run_flow_network(input_F[index]))
+                self.output['vis_out'] = vis_out
+                self.output['mask_out'] = (self.output['vis_out'] < 2).float()
+                self.output['flow_out'] = flow_out
+        else:
+            self.output['flow_out'] = self.input['flow_2to1']
+            self.output['vis_out'] = self.input['vis_2']
+            self.output['mask_out'] = (self.output['vis_out'] < 2).float()
+            self.output['flow_tar'] = self.output['flow_out']
+            self.output['vis_tar'] = self.output['vis_out']
+            self.output['maks_tar'] = self.output['mask_out']
+        bsz, _, h, w = self.output['vis_out'].size()
+        self.output['vismap_out'] = self.output['vis_out'].new_zeros(bsz, 3, h, w).scatter_(dim=1, index=self.output[
+            'vis_out'].long(), value=1)
+
+    def run_flow_network(self, input_F):
+        flow_scale = 20.
+        # netF runs in float32 even with --amp: low precision visibility logits change the argmax, and the flow is used
+        # for sampling. netF is frozen, so this only costs its forward pass
+        with networks.fp32_region(input_F):
+            flow_out, vis_out, _, _ = self.netF(input_F.float())
+        vis_out = vis_out.argmax(dim=1, keepdim=True).float()
+        flow_out = flow_out * flow_scale * (vis_out < 2).float()
+        return flow_out, vis_out
+
+    def cached_per_sample(self, cache, keys, compute):
+        '''
+        batch computation with a per-sample cache. only the samples whose key is not in the cache are computed.
+        keys: list of bsz keys
+        compute: function(index) -> list of batched tensors, computed for the samples in index (LongTensor)
+        Output:
+            list of batched tensors for all bsz samples
+        '''
+        entries = [cache.get(k) for k in keys]
+        miss = [i for i, e in enumerate(entries) if e is None]
+        if miss:
+            out = compute(torch.LongTensor(miss))
+            for j, i in enumerate(miss):
+                # clone: a slice would keep the whole batch alive in the cache
+                entries[i] = [t[j:(j + 1)].clone() for t in out]
+                cache.put(keys[i], entries[i])
+        return [torch.cat(items, dim=0) for items in zip(*entries)]
+
+    def get_cache_keys(self, tensor_type, data):
+        '''
+        per-sample keys of the input items in tensor_type. source items ('*_1') are keyed from the source encoded by
+        encode_source(), never from data; target items from data. joint items are keyed by a hash of their keypoint
+        cordinates ('joint_c_1', 'joint_c_2'), so that the same pose hits the cache whatever sample it comes from.
+        other source items are keyed by the encode_source() call, other target items by a hash of their payload.
+        '''
+        bsz = data['joint_c_2'].size(0)
+        n_src = len(self.source['joint_keys'])
+        keys = []
+        for i in range(bsz):
+            keys.append(tuple(self.get_item_key(item, data, i, i if n_src > 1 else 0)
+                              for item in tensor_type.split('+')))
+        return keys
+
+    def get_item_key(self, item, data, i, i_src):
+        if item == 'joint_1':
+            return (item, self.source['joint_keys'][i_src])
+        elif item.endswith('_1'):
+            return (item, self.source['index'], i_src)
+        elif item == 'joint_2':
+            return (item, tensor_hash(data['joint_c_2'][i]))
+        else:
+            # e.g. the target parsing map
+            return (item, tensor_hash(data[self.payload_item(item)][i]))
+
+    def encode_pose_list(self, input_G_pose):
+        hidden_p, x_p = self.netG.encode_pose(input_G_pose)
+        return hidden_p + [x_p]
+
+    def get_cache_stats(self):
+        stats = OrderedDict()
+        if self.pose_cache is not None:
+            stats['pose_cache'] = self.pose_cache.get_stats()
+            stats['flow_cache'] = self.flow_cache.get_stats()
+        return stats
+
+    def encode_source(self, data):
+        '''
+        encode the source image(s) once, so that they can be rendered into many target poses with render().
+        data: dict with 'img_1', 'joint_1' and 'seg_cihp_1' of one source (bsz=1) or of a batch of sources, and with
+            --pose_cache_size > 0 the keypoints 'joint_c_1', as dataloader batches have them.
+        '''
+        assert self.opt.which_model_G == 'dual_unet' and not self.opt.G_pix_warp
+        self.n_source += 1
+        self.source = {'index': self.n_source}
+        if self.pose_cache is not None:
+            self.source['joint_keys'] = [tensor_hash(kp) for kp in data['joint_c_1']]
+        for item in ['img_1', 'joint_1', 'seg_cihp_1']:
+            self.source[item] = self.load_input(data, item)
+            self.input[item] = self.source[item]
+        with torch.no_grad(), self.autocast():
+            self.source['feats'] = self.netG.encode_appearance(self.get_tensor(self.opt.G_appearance_type),
+                                                               self.get_tensor('seg_cihp_1'))
+
+    def render(self, data):
+        '''
+        render the source encoded by encode_source() into a batch of target poses. only the flow, the pose encoder,
+        the feature warping and the decoder are computed. with --pose_cache_size > 0, pose encoder outputs (keyed by
+        target pose) and flows (keyed by source/target joints) are reused across calls; see get_cache_keys.
+        data: dict with 'joint_2' and 'seg_cihp_2' (and 'flow_2to1', 'vis_2' if flow_on_the_fly=0). if one source
+            was encoded, it is shared by all targets; otherwise the batch sizes must match. with --pose_cache_size > 0,
+            data also needs the target keypoints 'joint_c_2', as dataloader batches have them.
+        Output:
+            img_out: (bsz, 3, h, w). also stored in self.output['img_out']
+        '''
+        bsz = data[self.payload_item('joint_2')].size(0)
+        self.output = {}
+        target_list = ['joint_2', 'seg_cihp_2']
+        if not self.opt.flow_on_the_fly:
+            target_list += ['flow_2to1', 'vis_2']
+        for item in target_list:
+            self.input[item] = self.load_input(data, item)
+        for item in ['img_1', 'joint_1', 'seg_cihp_1']:
+            self.input[item] = expand_batch(self.source[item], bsz)
+        hidden_a, x_a, style_codes = self.source['feats']
+        hidden_a = [expand_batch(h, bsz) for h in hidden_a]
+        x_a = expand_batch(x_a, bsz)
+        style_codes = expand_batch(style_codes, bsz)
+
+        with torch.no_grad(), self.autocast():
+            if self.pose_cache is None:
+                self.generate_flow()
+                hidden_p, x_p = self.netG.encode_pose(self.get_tensor(self.opt.G_pose_type))
+            else:
+                self.generate_flow(self.get_cache_keys(self.opt.F_input_type, data) if self.opt.flow_on_the_fly else None)
+                input_G_pose = self.get_tensor(self.opt.G_pose_type)
+                pose_feats = self.cached_per_sample(self.pose_cache, self.get_cache_keys(self.opt.G_pose_type, data),
+                                                    lambda index: self.encode_pose_list(input_G_pose[index]))
+                hidden_p, x_p = pose_feats[:-1], pose_feats[-1]
+            flow_pyramid = self.netG.build_flow_pyramid(self.output['flow_out'], self.output['vis_out']) \
+                if self.opt.G_feat_warp else None
+            out = self.netG.decode(hidden_p, x_p, hidden_a, x_a, style_codes, self.get_tensor('seg_cihp_2'),
+                                   flow_pyramid)
+            self.output['img_out'] = F.tanh(out.float())
+        return self.output['img_out']
+
     def test(self, compute_loss=True, meas_only=True):
         ''' meas_only: only compute measurements (psrn, ssim) when computing loss'''
         with torch.no_grad():
-            self.forward(test=True)
+            with self.autocast():
+                self.forward(test=True)
+            # measurements in float32
             if compute_loss:
                 assert self.is_train or meas_only, 'when is_train is False, meas_only must be True'
                 self.compute_loss(meas_only=meas_only, compute_ssim=True)
@@ -243,22 +508,31 @@ class PoseTransferModel(BaseModel):
         # measurements
         ##############################
         if compute_ssim:
+            # computed on the device; the values are only synchronized when LossBuffer averages them
             self.output['SSIM'] = self.crit_ssim(self.output['img_out'], self.output['img_tar'])
+            # other measurements only if requested (--extra_metrics)
+            if 'PSNR' in self.opt.extra_metrics:
+                self.output['PSNR'] = self.crit_psnr(self.output['img_out'], self.output['img_tar'])
+            if 'mask_SSIM' in self.opt.extra_metrics:
+                # foreground (non-background parsing label) of the target
+                mask = 1 - self.get_tensor('seg_cihp_2')[:, 0:1]
+                self.output['mask_SSIM'] = self.crit_ssim(self.output['img_out'], self.output['img_tar'], mask)
         if meas_only:
             return
         ##############################
         # losses
         ##############################
         self.output['loss_l1'] = F.l1_loss(self.output['img_out'], self.output['img_tar'])
-        # Content (Perceptual)
-        self.output['loss_content'] = self.crit_vgg(self.output['img_out'], self.output['img_tar'], loss_type='content')
-        # Style
+        # Content (Perceptual) and Style, from one VGG pass over output and target
         if self.opt.loss_weight_style > 0:
-            self.output['loss_style'] = self.crit_vgg(self.output['img_out'], self.output['img_tar'], loss_type='style')
+            self.output['loss_content'], self.output['loss_style'] = self.crit_vgg(
+                self.output['img_out'], self.output['img_tar'], loss_type=['content', 'style'])
+        else:
+            self.output['loss_content'] = self.crit_vgg(self.output['img_out'], self.output['img_tar'], loss_type='content')
         # GAN
         if self.use_gan:
             input_D = self.get_tensor(self.opt.D_input_type_fake)
-            self.output['loss_G'] = self.crit_gan(self.netD(input_D), True)
+            self.output['loss_G'] = self.crit_gan(self.get_network('netD')(input_D), True)
 
     def backward(self, check_grad=False):
         loss_ce = 0.5
@@ -272,29 +546,35 @@ class PoseTransferModel(BaseModel):
             loss += self.output['loss_G'] * self.opt.loss_weight_gan
 
         self.output['total_G_loss'] = loss
-        loss.backward()
+        self.scale_loss(loss).backward()
 
     def backward_D(self):
         input_D_real = self.get_tensor(self.opt.D_input_type_real).detach()
         input_D_fake = self.get_tensor(self.opt.D_input_type_fake).detach()
-        self.output['loss_D'] = 0.5 * (self.crit_gan(self.netD(input_D_real), True) + \
-                                       self.crit_gan(self.netD(input_D_fake), False))
-        (self.output['loss_D'] * self.opt.loss_weight_gan).backward()
+        netD = self.get_network('netD')
+        with self.autocast():
+            self.output['loss_D'] = 0.5 * (self.crit_gan(netD(input_D_real), True) + \
+                                           self.crit_gan(netD(input_D_fake), False))
+        self.scale_loss(self.output['loss_D'] * self.opt.loss_weight_gan).backward()
 
     def optimize_parameters(self, check_grad=False):
         self.output = {}
         # forward
-        self.forward()
+        with self.autocast():
+            self.forward()
         # optim netD
         if self.use_gan:
             self.optim_D.zero_grad()
             self.backward_D()
-            self.optim_D.step()
+            self.step_optimizer(self.optim_D)
         # optim netG
         self.optim.zero_grad()
-        self.compute_loss()
+        with self.autocast():
+            self.compute_loss()
         self.backward(check_grad)
-        self.optim.step()
+        self.step_optimizer(self.optim)
+        if self.scaler is not None:
+            self.scaler.update()
 
     def get_tensor_dim(self, tensor_type):
         dim = 0
@@ -367,7 +647,11 @@ class PoseTransferModel(BaseModel):
         tensor = torch.cat(tensor, dim=1)
         return tensor
 
-    def get_current_errors(self):
+    def get_current_errors(self, as_tensor=False):
+        '''
+        as_tensor: return detached tensors instead of python floats, so that no host synchronization happens per batch
+        (LossBuffer accepts both)
+        '''
         error_list = [
             'PSNR',
             'SSIM',
@@ -387,14 +671,15 @@ class PoseTransferModel(BaseModel):
         errors = OrderedDict()
         for item in error_list:
             if item in self.output:
-                errors[item] = self.output[item].item()
+                errors[item] = self.output[item].detach() if as_tensor else self.output[item].item()
 
         return errors
 
     def delvar(self):
         for k in self.output.keys():
             del self.output[k]
-        torch.cuda.empty_cache()
+        if self.gpu_ids:
+            torch.cuda.empty_cache()
 
     def get_current_visuals(self):
         visual_items = [
@@ -462,4 +747,13 @@ def load_flow_network(model_id, epoch='best', gpu_ids=[]):
     # create network
     model = FlowRegressionModel()
     model.initialize(opt)
-    return model.netF
\ No newline at end of file
+    return model.netF
+
+def expand_batch(x, bsz):
+    '''
+    broadcast a single-sample tensor to bsz samples without copying.
+    '''
+    if x.size(0) == bsz:
+        return x
+    assert x.size(0) == 1, 'batch size mismatch: %d vs. %d' % (x.size(0), bsz)
+    return x.expand(bsz, *x.size()[1:])
@@ -0,0 +1,147 @@
+'''
+Int8 post-training quantization of the generator (DualUnetGenerator_SEAN) and the flow network (FlowUnet) for CPU
+inference (see tools/quantize_generator.py).
+
+    - conv stacks: static quantization. BatchNorm layers directly after a conv are folded into it, then every conv
+      (except the output heads given in skip) is wrapped in a QuantWrapper. activations are quantized at the input of
+      each conv and dequantized at its output, so the layers between convs (ACE / SPADE modulation, warping,
+      instance norm, pixel shuffle) keep running in float32. activation ranges are calibrated with prepare_static(),
+      a few forward passes, and convert_static().
+    - ACE per-part linear layers (LinearStack): dynamic quantization with per-channel int8 weights.
+
+quantized modules only run on CPU.
+'''
+from __future__ import division
+
+import copy
+from typing import Optional
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+try:
+    import torch.ao.quantization as tq
+except ImportError:
+    import torch.quantization as tq
+
+from .SPG_net_deepfashion import LinearStack
+from .SPG_net_export import remove_all_spectral_norm
+
+
+def fuse_conv_bn(module):
+    '''
+    fold BatchNorm2d layers that directly follow a conv in an nn.Sequential into the conv (in place, eval mode)
+    '''
+    for m in module.modules():
+        if isinstance(m, nn.Sequential):
+            names = list(m._modules.keys())
+            for name, next_name in zip(names[:-1], names[1:]):
+                conv, bn = m._modules[name], m._modules[next_name]
+                if isinstance(conv, (nn.Conv2d, nn.ConvTranspose2d)) and isinstance(bn, nn.BatchNorm2d) and \
+                        bn.track_running_stats:
+                    m._modules[name] = fuse_conv_bn_eval(conv, bn, transpose=isinstance(conv, nn.ConvTranspose2d))
+                    m._modules[next_name] = nn.Identity()
+    return module
+
+
+def get_qconfig(conv, backend):
+    if isinstance(conv, nn.ConvTranspose2d):
+        # quantized transposed convolution only supports per-tensor weights
+        return tq.QConfig(activation=tq.get_default_qconfig(backend).activation, weight=tq.default_weight_observer)
+    return tq.get_default_qconfig(backend)
+
+
+def prepare_static(net, skip=(), backend='fbgemm'):
+    '''
+    copy net, fold spectral norm and batch norm, and insert observers around all convs whose qualified name does not
+    contain one of the strings in skip. run the returned network on calibration data, then call convert_static().
+    '''
+    torch.backends.quantized.engine = backend
+    net = fuse_conv_bn(remove_all_spectral_norm(copy.deepcopy(net).cpu().eval()))
+    for parent_name, parent in list(net.named_modules()):
+        for name, child in list(parent._modules.items()):
+            full_name = '%s.%s' % (parent_name, name) if parent_name else name
+            if type(child) in (nn.Conv2d, nn.ConvTranspose2d) and not any(s in full_name for s in skip):
+                wrapper = tq.QuantWrapper(child)
+                wrapper.qconfig = get_qconfig(child, backend)
+                parent._modules[name] = wrapper
+    tq.prepare(net, inplace=True)
+    return net
+
+
+def convert_static(net):
+    '''
+    replace the observed convs by int8 convs (in place)
+    '''
+    tq.convert(net, inplace=True)
+    return net
+
+
+class DynamicQuantLinearStack(nn.Module):
+    '''
+    LinearStack with int8 weights (per output channel) and dynamically quantized input: one dynamically quantized
+    nn.Linear per group, each applied to its own group of the input only.
+    '''
+
+    def __init__(self, linear_stack):
+        super(DynamicQuantLinearStack, self).__init__()
+        self.in_features = linear_stack.in_features
+        self.out_features = linear_stack.out_features
+        self.n_group = linear_stack.n_group
+        weight = linear_stack.weight.data.view(self.n_group, self.out_features, self.in_features)
+        bias = linear_stack.bias.data.view(self.n_group, self.out_features)
+        linears = []
+        for g in range(self.n_group):
+            linear = nn.Linear(self.in_features, self.out_features)
+            linear.weight.data.copy_(weight[g])
+            linear.bias.data.copy_(bias[g])
+            linears.append(linear)
+        linears = tq.quantize_dynamic(nn.Sequential(*linears), {nn.Linear: tq.per_channel_dynamic_qconfig},
+                                      dtype=torch.qint8)
+        self.linears = nn.ModuleList(list(linears))
+
+    def forward(self, x, group: Optional[int] = None):
+        '''
+        same as LinearStack.forward
+        '''
+        if group is not None:
+            return self.linears[group](x.view(1, -1)).view(self.out_features)
+        return torch.stack([linear(x[:, g]) for g, linear in enumerate(self.linears)], dim=1)
+
+
+def quantize_dynamic_linear_stacks(net):
+    '''
+    replace all LinearStack layers (ACE fc_mu) by DynamicQuantLinearStack (in place)
+    '''
+    for parent in list(net.modules()):
+        for name, child in list(parent._modules.items()):
+            if isinstance(child, LinearStack):
+                parent._modules[name] = DynamicQuantLinearStack(child)
+    return net
+
+
+def quantize_pose_transfer_model(model, calib_data, quantize_flow=True, backend='fbgemm', skip_G=('dec_output',),
+                                 skip_F=('predict_flow', 'predict_vis')):
+    '''
+    quantize netG (and netF) of a PoseTransferModel on CPU in place, calibrating the activation ranges with
+    model.test() over calib_data.
+    Input:
+        model: PoseTransferModel on CPU (--gpu_ids -1)
+        calib_data: iterable of dataloader batches
+        skip_G, skip_F: convs whose name contains one of these strings stay in float32 (output heads by default)
+    Output:
+        (netG, netF): the float32 networks that were replaced
+    '''
+    float_nets = (model.netG, getattr(model, 'netF', None))
+    model.netG = prepare_static(model.netG, skip_G, backend)
+    quantize_flow = quantize_flow and model.opt.flow_on_the_fly
+    if quantize_flow:
+        model.netF = prepare_static(model.netF, skip_F, backend)
+    for data in calib_data:
+        model.set_input(data)
+        model.test(compute_loss=False)
+    model.netG = quantize_dynamic_linear_stacks(convert_static(model.netG))
+    if quantize_flow:
+        model.netF = convert_static(model.netF)
+    return float_nets
@@ -23,6 +23,9 @@ class BaseOptions(object):
         # basic experiment options
         parser.add_argument('--id', type = str, default = 'default', help = 'experiment ID. the experiment dir will be set as "./checkpoint/id/"')
         parser.add_argument('--gpu_ids', type = str, default = '0', help = 'gpu ids: e.g. 0  0,1,2, 0,2. use -1 for CPU')
+        # data loading
+        parser.add_argument('--n_workers', type = int, default = 8, help = 'number of dataloader worker processes')
+        parser.add_argument('--prefetch_depth', type = int, default = 2, help = 'number of batches whose input is assembled (moved to the device) in the background while the current batch runs. 0 to disable')
  
         self.initialized = True
         
@@ -41,6 +44,10 @@ class BaseOptions(object):
             g_id = int(str_id)
             if g_id >= 0:
                 self.opt.gpu_ids.append(g_id)
+        # in distributed mode (see util/distributed.py), each process uses the gpu of its local rank
+        if getattr(self.opt, 'distributed', 0) and len(self.opt.gpu_ids) > 0:
+            local_rank = int(os.environ.get('LOCAL_RANK', 0))
+            self.opt.gpu_ids = [self.opt.gpu_ids[local_rank]]
         # set gpu devices
         if len(self.opt.gpu_ids) > 0:
             os.environ['CUDA_VISIBLE_DEVICES'] = ','.join([str(i) for i in self.opt.gpu_ids])
@@ -23,6 +23,7 @@ class BasePoseTransferOptions(BaseOptions):
         parser.add_argument('--G_feat_warp', type=int, default=1, choices=[0,1], help='set 1 to use feature warping; otherwise the model is a simple unet with 2 encoders for pose and appearance respectively')
         parser.add_argument('--G_n_warp_scale', type=int, default=5, help='at scales higher than this, feature warping will not be performed (because the resolution of feature map is too small)')
         parser.add_argument('--G_vis_mode', type=str, default='residual', choices=['none', 'hard_gate', 'soft_gate', 'residual', 'res_no_vis'], help='different approaches to integrate visibility map in feature warping module')
+        parser.add_argument('--G_checkpoint_scales', type=int, nargs='*', default=[], help='scales (0: finest) whose encoder residual blocks and SEAN decoder blocks are recomputed in backward instead of keeping their activations. saves memory at the cost of one more forward of these blocks per step (the recomputation does not update batchnorm statistics or spectral-norm vectors again). see tools/benchmark_checkpointing.py')
         parser.add_argument('--G_no_end_norm', type=int, default=0, choices=[0,1], help='if set as 1, convolution at the start and the end of netG will not followed by norm_layer like BN.')
         # netG (pixel warping module)
         parser.add_argument('--G_pix_warp', type=int, default=0, choices=[0,1], help='use pixel warping module')
@@ -40,6 +41,10 @@ class BasePoseTransferOptions(BaseOptions):
         parser.add_argument('--F_input_type', type=str, default='joint_1+joint_2', help='input data items for netF(flow) which flow is generated on-the-fly')
         parser.add_argument('--pretrained_flow_id', type=str, default='FlowReg_0.1', help='model id of flow regression model')
         parser.add_argument('--pretrained_flow_epoch', type=str, default='best', help='which epoch to load pretrained flow regression module')
+        parser.add_argument('--extra_metrics', type=str, nargs='*', default=[], choices=['PSNR', 'mask_SSIM'], help='measurements computed by PoseTransferModel.test() besides SSIM (mask_SSIM: SSIM on the foreground of the target parsing map)')
+        parser.add_argument('--pose_cache_size', type=int, default=0, help='number of target poses whose pose-encoder features and flows are cached by PoseTransferModel.render(). 0 to disable')
+        parser.add_argument('--amp', type=str, default='none', choices=['none', 'fp16', 'bf16'], help='run netG, netD and the VGG loss under autocast (pytorch>=1.10), with gradient scaling for fp16. netF, warping, gram matrices and losses stay in float32. fp16 falls back to bf16 on CPU')
+        parser.add_argument('--flow_store_dir', type=str, default='flow_store', help='dir (relative to data_root) of flow precomputed by tools/precompute_flow.py. used when flow_on_the_fly=0')
         ##############################
         # Pose Setting
         ##############################
@@ -60,7 +65,14 @@ class BasePoseTransferOptions(BaseOptions):
         parser.add_argument('--seg_dir', type=str, default=None, help='Set in Options.auto_set()')
         parser.add_argument('--seg_pred_dir', type=str, default=None, help='dest parsing label preded by our model')
         parser.add_argument('--fn_pose', type=str, default=None, help='Set in Options.auto_set()')
+        parser.add_argument('--shard_dir', type=str, default='shard', help='dir (relative to data_root) of the memory-mapped shard built by tools/build_shard.py. used by dataset_type=pose_transfer_parsing_personHD_shard')
+        parser.add_argument('--image_cache_mb', type=int, default=0, help='size (MB) of the shared-memory LRU cache of decoded images / parsing labels of each dataset, shared by all dataloader workers. 0 to disable')
+        parser.add_argument('--locality_chunk', type=int, default=0, help='shuffle training pairs in chunks of # pairs with the same source subject/video (see data/pair_sampler.py). larger is more cache-friendly and less random. 0 for plain shuffle')
+        parser.add_argument('--locality_level', type=str, default='video', choices=['subject', 'video'], help='group level of --locality_chunk')
+        parser.add_argument('--raw_image_size', type=int, nargs=2, default=None, help='(h, w) of the images in img_dir if they are raw frames rather than preprocessed ones (see tools/preprocess_personHD.py). samples are then decoded at reduced scale and resized on the fly')
+        parser.add_argument('--raw_crop', type=str, default='full', choices=['full', 'center'], help='region of the raw frames used with --raw_image_size. full: whole frame, resized anisotropically like the preprocessed sets and pose labels; center: largest centered box with the aspect ratio of image_size (cuts off the top and bottom of portrait frames)')
         parser.add_argument('--debug', action='store_true', help='debug')
+        parser.add_argument('--compact_payload', type=int, default=0, choices=[0,1], help='dataloader returns uint8 images / parsing labels and (18,2) keypoints; joint maps, one-hot maps and normalization are computed on the model device')
 
         parser.add_argument('--use_augmentation', type=int, default=0, choices=[0,1])
         parser.add_argument('--aug_scale_range', type=float, default=1.2)
@@ -188,6 +200,8 @@ class TrainPoseTransferOptions(BasePoseTransferOptions):
         parser.add_argument('--resume_train', action = 'store_true', default = False, help = 'resume training from saved checkpoint')
         parser.add_argument('--last_epoch', type=int, default=1)
         parser.add_argument('--small_val_set', type=int, default=1, choices=[0,1], help='use 1/5 test samples as validation set')
+        parser.add_argument('--distributed', type=int, default=0, choices=[0,1], help='DistributedDataParallel training, one process per gpu (or per CPU worker with --gpu_ids -1). launch with torchrun, see util/distributed.py. batch_size is per process')
+        parser.add_argument('--dist_backend', type=str, default='', help='torch.distributed backend. default: nccl on GPU, gloo on CPU')
         # optimizer
         parser.add_argument('--lr', type = float, default = 2e-4, help = 'initial learning rate')
         parser.add_argument('--beta1', type = float, default = 0.5, help = 'momentum1 term for Adam')
@@ -207,6 +221,7 @@ class TrainPoseTransferOptions(BasePoseTransferOptions):
         parser.add_argument('--vis_epoch_freq', type = int, default = 1, help='frequency of visualizing generated images')
         parser.add_argument('--check_grad_freq', type = int, default = 100, help = 'frequency of checking gradient of each loss')
         parser.add_argument('--n_vis', type = int, default = 64, help='number of visualized images')
+        parser.add_argument('--vis_on_device', type=int, default=0, choices=[0,1], help='keep the assembled input of the visualization batches on the model device between epochs (about n_vis*4*(6+2*joint_nc+40)*h*w bytes), instead of copying the cached batches again at every visualization')
         # loss setting
         parser.add_argument('--epoch_add_gan', type=int, default=6, help='add gan loss after # epochs of training')
         parser.add_argument('--loss_weight_l1', type=float, default=1.)
@@ -241,5 +256,55 @@ class TestPoseTransferOptions(BasePoseTransferOptions):
         parser.add_argument('--save_output', action='store_true', help='save output images in the folder exp_dir/test/')
         parser.add_argument('--output_dir', type=str, default='output', help='path to save generated images')
         parser.add_argument('--masked', action='store_true', help='also test masked-ssim (for market-1501)')
-        
-        
+
+
+class PrecomputeFlowOptions(BasePoseTransferOptions):
+    def initialize(self):
+        super(PrecomputeFlowOptions, self).initialize()
+        self.is_train = True
+        parser = self.parser
+        parser.add_argument('--for_train', type=int, default=1, choices=[0,1], help='resolve dataset paths as in training (1) or testing (0)')
+        parser.add_argument('--splits', type=str, nargs='+', default=None, help='keys of the split file to precompute. default: all')
+
+    def auto_set(self):
+        self.is_train = bool(self.opt.for_train)
+        super(PrecomputeFlowOptions, self).auto_set()
+
+
+class BuildShardOptions(PrecomputeFlowOptions):
+    def initialize(self):
+        super(BuildShardOptions, self).initialize()
+        parser = self.parser
+        parser.add_argument('--with_seg_pred', type=int, default=0, choices=[0,1], help='also pack the predicted target parsing (seg_pred_dir) of every pair, which is used at test time')
+
+
+class ExportGeneratorOptions(TestPoseTransferOptions):
+    def initialize(self):
+        super(ExportGeneratorOptions, self).initialize()
+        parser = self.parser
+        parser.add_argument('--export_dir', type=str, default=None, help='output dir of the exported generator. default: checkpoints/<id>/export')
+        parser.add_argument('--export_formats', type=str, nargs='+', default=['torchscript', 'onnx'], choices=['torchscript', 'onnx'])
+        parser.add_argument('--onnx_opset', type=int, default=16, help='ONNX opset (grid_sample needs >= 16)')
+        parser.add_argument('--export_noise', type=int, default=1, choices=[0,1], help='keep the (learned) noise injection of the ACE layers in the exported generator, as in the trained netG. its output is then random, so the ONNX parity check is skipped. 0 exports a deterministic generator whose output differs from netG (the drift is printed)')
+        parser.add_argument('--parity_atol', type=float, default=1e-3, help='max abs difference of the generator outputs allowed by the parity checks')
+
+
+class QuantizeGeneratorOptions(TestPoseTransferOptions):
+    def initialize(self):
+        super(QuantizeGeneratorOptions, self).initialize()
+        parser = self.parser
+        parser.add_argument('--n_calib_pairs', type=int, default=256, help='number of test pairs used to calibrate the activation ranges')
+        parser.add_argument('--n_eval_pairs', type=int, default=256, help='number of test pairs (after the calibration pairs) used to compare int8 with float32')
+        parser.add_argument('--quantize_flow', type=int, default=1, choices=[0,1], help='also quantize netF (with --flow_on_the_fly 1)')
+        parser.add_argument('--quant_backend', type=str, default='fbgemm', choices=['fbgemm', 'x86', 'qnnpack'], help='quantized engine. fbgemm/x86 for x86 CPUs, qnnpack for ARM')
+        parser.add_argument('--n_threads', type=int, default=0, help='torch CPU threads for the throughput measurement. 0 to keep the default')
+
+
+class BenchmarkCheckpointingOptions(TrainPoseTransferOptions):
+    def initialize(self):
+        super(BenchmarkCheckpointingOptions, self).initialize()
+        parser = self.parser
+        parser.add_argument('--bench_sizes', type=int, nargs='+', default=[256, 512], help='square image sizes to benchmark')
+        parser.add_argument('--bench_configs', type=str, nargs='+', default=['none', '0', '0,1', '0,1,2', 'all'], help='values of --G_checkpoint_scales to compare: comma-separated scales, "none" or "all"')
+        parser.add_argument('--bench_iters', type=int, default=10, help='timed training steps per configuration (after 2 warm-up steps)')
+        parser.add_argument('--bench_memory_only', type=int, default=0, choices=[0, 1], help='only count the activations kept for backward, on fake tensors (torch FakeTensorMode): nothing is allocated or computed, so sizes that do not fit in memory can be compared. no step time or peak memory')
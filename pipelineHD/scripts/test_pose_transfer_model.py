@@ -3,6 +3,7 @@ import sys
 sys.path.append('.')
 import torch
 from data.data_loader import CreateDataLoader
+from data.prefetcher import prefetch
 from options.pose_transfer_options import TestPoseTransferOptions
 from models.pose_transfer_model import PoseTransferModel
 from util.visualizer import Visualizer
@@ -34,7 +35,8 @@ if opt.n_vis > 0:
     for i, data in enumerate(tqdm.tqdm(val_loader, desc='Visualize')):
         model.eval()
         model.netG.eval()
-        model.netF.eval()
+        if opt.flow_on_the_fly:
+            model.netF.eval()
         model.set_input(data)
         model.test(compute_loss=False)
         visuals = model.get_current_visuals()
@@ -80,16 +82,17 @@ if opt.n_test_batch != 0:
         io.mkdir_if_missing(output_dir)
 
     total_time = 0
-    for i, data in enumerate(tqdm.tqdm(val_loader, desc='Test')):
+    for i, (data, inputs) in enumerate(tqdm.tqdm(prefetch(val_loader, model, opt), desc='Test')):
         tic = time.time()
         model.eval()
         model.netG.eval()
-        model.netF.eval()
-        model.set_input(data)
+        if opt.flow_on_the_fly:
+            model.netF.eval()
+        model.set_input(data, inputs)
         model.test()
         toc = time.time()
         total_time += (toc - tic)
-        loss_buffer.add(model.get_current_errors())
+        loss_buffer.add(model.get_current_errors(as_tensor=True))
         # save output
         if opt.save_output:
             id_list = model.input['id']
@@ -6,35 +6,65 @@ sys.path.append('.')
 import torch
 import tensorboardX
 from data.data_loader import CreateDataLoader
+from data.prefetcher import prefetch
 from models.pose_transfer_model import PoseTransferModel
 from options.pose_transfer_options import TrainPoseTransferOptions
 from util.visualizer import Visualizer
 from util.loss_buffer import LossBuffer
+from util import distributed as dist_util
 
 import util.io as io
+import itertools
 import tqdm
 import time
 from collections import OrderedDict
 
+
+def sample_vis_batches(loader, n_batch, model, on_device):
+    '''
+    take the first n_batch batches of a loader once. they are reused by the visualization of every epoch, so that no
+    worker is restarted and the visuals of different epochs show the same samples. returns a list of (data, inputs),
+    where inputs is the assembled model input kept on the device with --vis_on_device 1, and None otherwise.
+    '''
+    batches = []
+    for data in itertools.islice(loader, n_batch):
+        inputs = None
+        if on_device:
+            inputs = model.assemble_input(data)
+            # reused every epoch: materialize the iterator
+            inputs['id'] = list(inputs['id'])
+        batches.append((data, inputs))
+    return batches
+
+
 # parse and save options
 parser = TrainPoseTransferOptions()
-opt = parser.parse()
-parser.save()
+opt = parser.parse(display=dist_util.is_main_process())
+# in distributed mode, only rank 0 writes logs, visualizations and checkpoints
+main_process = dist_util.is_main_process()
+if opt.distributed:
+    dist_util.init_distributed(opt)
+if main_process:
+    parser.save()
 # create model
 model = PoseTransferModel()
 model.initialize(opt)
+if opt.distributed:
+    model.wrap_distributed()
 # save terminal line
-io.save_str_list([' '.join(sys.argv)], os.path.join(model.save_dir, 'order_line.txt'))
+if main_process:
+    io.save_str_list([' '.join(sys.argv)], os.path.join(model.save_dir, 'order_line.txt'))
 # create data loader
 train_loader = CreateDataLoader(opt, split='train')
 val_loader = CreateDataLoader(opt, split='test' if not opt.small_val_set else 'test_small')
 # create visualizer
 visualizer = Visualizer(opt)
 
-logdir = os.path.join('logs', opt.id)
-if not os.path.exists(logdir):
-    os.makedirs(logdir)
-writer = tensorboardX.SummaryWriter(logdir)
+if main_process:
+    logdir = os.path.join('logs', opt.id)
+    if not os.path.exists(logdir):
+        os.makedirs(logdir)
+    writer = tensorboardX.SummaryWriter(logdir)
 
 # set "saving best"
 best_info = {
@@ -56,7 +86,15 @@ else:
 if opt.debug:
     opt.display_freq = 2
 
-for epoch in tqdm.trange(epoch_count, opt.n_epoch+opt.n_epoch_decay+1, desc='Epoch'):
+# fixed visualization batches (the batches on cpu are in pinned memory when training on gpu, see CreateDataLoader)
+if main_process:
+    num_vis_batch = int(1.*opt.n_vis/opt.batch_size)
+    vis_batches = OrderedDict([
+        ('train', sample_vis_batches(train_loader, num_vis_batch, model, opt.vis_on_device)),
+        ('test', sample_vis_batches(val_loader, num_vis_batch, model, opt.vis_on_device)),
+    ])
+
+for epoch in tqdm.trange(epoch_count, opt.n_epoch+opt.n_epoch_decay+1, desc='Epoch', disable=not main_process):
     #train model
     model.train()
     model.netG.train()
@@ -65,12 +103,15 @@ for epoch in tqdm.trange(epoch_count, opt.n_epoch+opt.n_epoch_decay+1, desc='Epo
         model.netPW.train()
 
     model.use_gan = (opt.loss_weight_gan > 0) and (epoch >= opt.epoch_add_gan)
-    for i,data in enumerate(tqdm.tqdm(train_loader, desc='Train')):
+    if hasattr(train_loader.sampler, 'set_epoch'):
+        train_loader.sampler.set_epoch(epoch)
+    for i,(data, inputs) in enumerate(tqdm.tqdm(prefetch(train_loader, model, opt), desc='Train', disable=not main_process)):
         total_steps += 1
-        model.set_input(data)
+        model.set_input(data, inputs)
         model.optimize_parameters(check_grad=(opt.check_grad_freq>0 and total_steps%opt.check_grad_freq==0))
         
-        if total_steps % opt.display_freq == 0:
+        if main_process and total_steps % opt.display_freq == 0:
+            # errors of the batch of rank 0
             train_error = model.get_current_errors()
             info = OrderedDict([
                     ('id', opt.id),
@@ -87,6 +128,11 @@ for epoch in tqdm.trange(epoch_count, opt.n_epoch+opt.n_epoch_decay+1, desc='Epo
     #update learning rate(lr_scheduler.step()) after optim.step(), otherwise lost first lr
     model.update_learning_rate()    
 
+    if main_process and hasattr(train_loader.dataset, 'get_cache_stats'):
+        for name, stats in train_loader.dataset.get_cache_stats().items():
+            tqdm.tqdm.write('%s: %s' % (name, ', '.join(['%s: %s' % (k, v) for k, v in stats.items()])))
+            writer.add_scalar('%s/hit_rate' % name, stats['hit_rate'], total_steps)
+
     if epoch % opt.test_epoch_freq == 0:
         # model.get_current_errors() #erase training error information
         model.output = {}
@@ -97,66 +143,55 @@ for epoch in tqdm.trange(epoch_count, opt.n_epoch+opt.n_epoch_decay+1, desc='Epo
         if model.opt.G_pix_warp:
             model.netPW.eval()
 
-        for i, data in enumerate(tqdm.tqdm(val_loader, desc='Test')):
-            model.set_input(data)
+        for i, (data, inputs) in enumerate(tqdm.tqdm(prefetch(val_loader, model, opt), desc='Test', disable=not main_process)):
+            model.set_input(data, inputs)
             model.test(compute_loss=True)
-            loss_buffer.add(model.get_current_errors())
-        test_error = loss_buffer.get_errors()
+            loss_buffer.add(model.get_current_errors(as_tensor=True))
+        # average over the validation parts of all processes (same result on every rank)
+        test_error = dist_util.all_reduce_errors(loss_buffer.get_errors(), len(val_loader))
         info = OrderedDict([
                 ('time', time.ctime()),
                 ('id', opt.id),
                 ('epoch', epoch),
         ])
-        tqdm.tqdm.write(visualizer.log(info, test_error))
+        if main_process:
+            tqdm.tqdm.write(visualizer.log(info, test_error))
         # save best
         if best_info['best_epoch']==-1 or (test_error[best_info['meas']].item()<best_info['best_value'] and best_info['type']=='min') or (test_error[best_info['meas']].item()>best_info['best_value'] and best_info['type']=='max'):
-            tqdm.tqdm.write('save as best epoch!')
             best_info['best_epoch'] = epoch
             best_info['best_value'] = test_error[best_info['meas']].item()
-            model.save('best')
-        tqdm.tqdm.write(visualizer.log(best_info))
+            if main_process:
+                tqdm.tqdm.write('save as best epoch!')
+                model.save('best')
+        if main_process:
+            tqdm.tqdm.write(visualizer.log(best_info))
     
-    if epoch % opt.vis_epoch_freq == 0:
+    if main_process and epoch % opt.vis_epoch_freq == 0:
         #eval model
         model.eval()
         model.netG.eval()
         if model.opt.G_pix_warp:
             model.netPW.eval()
 
-        num_vis_batch = int(1.*opt.n_vis/opt.batch_size)
-        visuals = None
-        for i, data in enumerate(train_loader):
-            if i == num_vis_batch:
-                break
-            model.set_input(data)
-            model.test(compute_loss=True)
-            v = model.get_current_visuals()
-            if visuals is None:
-                visuals = v
-            else:
-                for name, item in v.items():
-                    visuals[name][0] = torch.cat((visuals[name][0], item[0]), dim=0)
-        tqdm.tqdm.write('visualizing training sample')
-        fn_vis = os.path.join('checkpoints', opt.id, 'vis', 'train_epoch%d.jpg'%epoch)
-        visualizer.visualize_results(visuals, fn_vis)
-
-        visuals = None
-        for i, data in enumerate(val_loader):
-            if i == num_vis_batch:
-                break
-            model.set_input(data)
-            model.test(compute_loss=True)
-            v = model.get_current_visuals()
-            if visuals is None:
-                visuals = v
-            else:
-                for name, item in v.items():
-                    visuals[name][0] = torch.cat((visuals[name][0], item[0]), dim=0)
-        tqdm.tqdm.write('visualizing test sample')
-        fn_vis = os.path.join('checkpoints', opt.id, 'vis', 'test_epoch%d.jpg'%epoch)
-        visualizer.visualize_results(visuals, fn_vis)
+        for split, batches in vis_batches.items():
+            visuals = None
+            for data, inputs in batches:
+                model.set_input(data, inputs)
+                model.test(compute_loss=True)
+                v = model.get_current_visuals()
+                if visuals is None:
+                    visuals = v
+                else:
+                    for name, item in v.items():
+                        visuals[name][0] = torch.cat((visuals[name][0], item[0]), dim=0)
+            tqdm.tqdm.write('visualizing %s sample' % ('training' if split == 'train' else split))
+            fn_vis = os.path.join('checkpoints', opt.id, 'vis', '%s_epoch%d.jpg' % (split, epoch))
+            visualizer.visualize_results(visuals, fn_vis)
     
-    if epoch % opt.save_epoch_freq == 0:
-        model.save(epoch)
-    model.save('latest')
-print(best_info)
+    if main_process:
+        if epoch % opt.save_epoch_freq == 0:
+            model.save(epoch)
+        model.save('latest')
+if main_process:
+    print(best_info)
+dist_util.cleanup_distributed()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# tests import the packages of pipelineHD (models, data, util, ...) as the scripts do when run from pipelineHD/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
@@ -0,0 +1,89 @@
+'''
+SSIM / PSNR modules against the skimage metrics they replaced (compare_ssim(multichannel=True), compare_psnr), computed
+the way the old modules did: uint8 conversion on the host and one skimage call per image.
+'''
+import numpy as np
+import pytest
+import torch
+
+from models.modules import PSNR, SSIM
+
+skimage = pytest.importorskip('skimage')
+try:
+    from skimage.measure import compare_psnr, compare_ssim
+except ImportError:
+    # skimage >= 0.18
+    from skimage.metrics import peak_signal_noise_ratio as compare_psnr
+    from skimage.metrics import structural_similarity
+
+    def compare_ssim(img_1, img_2, multichannel=False, **kwargs):
+        if multichannel:
+            kwargs['channel_axis'] = -1
+        return structural_similarity(img_1, img_2, **kwargs)
+
+# SSIM is in [-1, 1], PSNR in dB
+SSIM_ATOL = 1e-5
+PSNR_ATOL = 1e-4
+
+
+def to_uint8(images):
+    images = images.numpy().transpose(0, 2, 3, 1)
+    return ((images + 1.0) * 127.5).clip(0, 255).astype(np.uint8)
+
+
+def ssim_skimage(images_1, images_2, mask=None, **kwargs):
+    imgs_1, imgs_2 = to_uint8(images_1), to_uint8(images_2)
+    if mask is not None:
+        mask = mask.numpy().transpose(0, 2, 3, 1).astype(np.uint8)
+        imgs_1, imgs_2 = imgs_1 * mask, imgs_2 * mask
+    return np.mean([compare_ssim(img_1, img_2, multichannel=True, **kwargs) for img_1, img_2 in zip(imgs_1, imgs_2)])
+
+
+def psnr_skimage(images_1, images_2):
+    return np.mean([compare_psnr(img_2, img_1) for img_1, img_2 in zip(to_uint8(images_1), to_uint8(images_2))])
+
+
+def random_pair(bsz=4, h=64, w=48, seed=0):
+    # a noisy copy, so that the scores are in a realistic range rather than those of two independent noise images
+    rng = torch.Generator().manual_seed(seed)
+    images_1 = torch.rand(bsz, 3, h, w, generator=rng) * 2 - 1
+    images_2 = (images_1 + 0.2 * torch.randn(bsz, 3, h, w, generator=rng)).clamp(-1, 1)
+    return images_1, images_2
+
+
+def random_mask(bsz=4, h=64, w=48, seed=0):
+    rng = torch.Generator().manual_seed(seed)
+    mask = torch.zeros(bsz, 1, h, w)
+    for i in range(bsz):
+        y0, x0 = torch.randint(0, h // 2, (1,), generator=rng).item(), torch.randint(0, w // 2, (1,), generator=rng).item()
+        mask[i, :, y0:y0 + h // 2, x0:x0 + w // 2] = 1
+    return mask
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_ssim(seed):
+    images_1, images_2 = random_pair(seed=seed)
+    out = SSIM()(images_1, images_2)
+    assert out.shape == (1,)
+    assert abs(out.item() - ssim_skimage(images_1, images_2)) < SSIM_ATOL
+
+
+def test_ssim_masked():
+    images_1, images_2 = random_pair(seed=2)
+    mask = random_mask(seed=2)
+    out = SSIM()(images_1, images_2, mask)
+    assert abs(out.item() - ssim_skimage(images_1, images_2, mask)) < SSIM_ATOL
+
+
+def test_ssim_gaussian_weights():
+    images_1, images_2 = random_pair(seed=3)
+    out = SSIM(gaussian_weights=True)(images_1, images_2)
+    ref = ssim_skimage(images_1, images_2, gaussian_weights=True, sigma=1.5, use_sample_covariance=True)
+    assert abs(out.item() - ref) < SSIM_ATOL
+
+
+def test_psnr():
+    images_1, images_2 = random_pair(seed=4)
+    out = PSNR()(images_1, images_2)
+    assert out.shape == (1,)
+    assert abs(out.item() - psnr_skimage(images_1, images_2)) < PSNR_ATOL
@@ -0,0 +1,57 @@
+'''
+region_mean_pool against the per-sample, per-region masked_select loop it replaced in Zencoder.forward
+'''
+import torch
+
+from models.SPG_net_deepfashion import region_mean_pool
+
+
+def region_mean_pool_loop(codes, segmap):
+    b_size, f_size = codes.shape[0], codes.shape[1]
+    s_size = segmap.shape[1]
+    codes_vector = torch.zeros((b_size, s_size, f_size), dtype=codes.dtype, device=codes.device)
+    for i in range(b_size):
+        for j in range(s_size):
+            component_mask_area = torch.sum(segmap.bool()[i, j])
+            if component_mask_area > 0:
+                codes_component_feature = codes[i].masked_select(segmap.bool()[i, j]).reshape(
+                    f_size, component_mask_area).mean(1)
+                codes_vector[i][j] = codes_component_feature
+    return codes_vector
+
+
+def random_segmap(bsz, nc, h, w, n_used):
+    # one-hot map that only uses the first n_used labels, so the other regions are empty
+    label = torch.randint(0, n_used, (bsz, 1, h, w))
+    return (label == torch.arange(nc).view(1, nc, 1, 1)).float()
+
+
+def test_matches_loop_batched():
+    torch.manual_seed(0)
+    codes = torch.randn(4, 16, 32, 24)
+    segmap = random_segmap(4, 20, 32, 24, n_used=20)
+    torch.testing.assert_close(region_mean_pool(codes, segmap), region_mean_pool_loop(codes, segmap),
+                               rtol=1e-5, atol=1e-6)
+
+
+def test_empty_regions_are_zero():
+    torch.manual_seed(1)
+    codes = torch.randn(3, 8, 16, 16)
+    segmap = random_segmap(3, 20, 16, 16, n_used=5)
+    # one sample without any labelled pixel
+    segmap[1] = 0
+    out = region_mean_pool(codes, segmap)
+    torch.testing.assert_close(out, region_mean_pool_loop(codes, segmap), rtol=1e-5, atol=1e-6)
+    assert out[:, 5:].abs().max().item() == 0
+    assert out[1].abs().max().item() == 0
+
+
+def test_single_pixel_region():
+    codes = torch.randn(2, 4, 8, 8)
+    segmap = torch.zeros(2, 3, 8, 8)
+    segmap[:, 0] = 1
+    segmap[:, 0, 2, 5] = 0
+    segmap[:, 1, 2, 5] = 1
+    out = region_mean_pool(codes, segmap)
+    torch.testing.assert_close(out[:, 1], codes[:, :, 2, 5])
+    torch.testing.assert_close(out, region_mean_pool_loop(codes, segmap), rtol=1e-5, atol=1e-6)
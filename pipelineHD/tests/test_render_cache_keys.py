@@ -0,0 +1,67 @@
+'''
+cache keys of PoseTransferModel.render(): source items follow the source given to encode_source(), target items the
+target pose content
+'''
+import argparse
+
+import torch
+
+from models.base_model import BaseModel
+from models.pose_transfer_model import PoseTransferModel
+from util.lru_cache import LRUCache
+
+
+class AppearanceEncoder(object):
+    def encode_appearance(self, img, seg):
+        return None
+
+
+def make_model():
+    opt = argparse.Namespace(gpu_ids=[], is_train=False, id='test', compact_payload=False, which_model_G='dual_unet',
+                             G_pix_warp=False, G_appearance_type='img_1')
+    model = PoseTransferModel()
+    BaseModel.initialize(model, opt)
+    model.netG = AppearanceEncoder()
+    model.amp_device, model.amp_dtype = 'cpu', None
+    model.pose_cache, model.flow_cache = LRUCache(8), LRUCache(8)
+    model.n_source = 0
+    return model
+
+
+def make_data(kps, suffix, ids):
+    bsz = kps.size(0)
+    return {
+        'img_' + suffix: torch.rand(bsz, 3, 8, 8),
+        'joint_' + suffix: torch.rand(bsz, 18, 8, 8),
+        'joint_c_' + suffix: kps,
+        'seg_cihp_' + suffix: torch.rand(bsz, 20, 8, 8),
+        'id_' + suffix: ids,
+    }
+
+
+def test_source_keys_follow_encoded_source():
+    model = make_model()
+    kps = torch.rand(2, 18, 2) * 8
+    target = make_data(kps[:1], '2', ['t'])
+    model.encode_source(make_data(kps[:1], '1', ['s']))
+    keys_a = model.get_cache_keys('joint_1+joint_2', target)
+    keys_seg_a = model.get_cache_keys('seg_cihp_1+joint_2', target)
+    # another source: target data (with stale source items and ids) is the same, the keys must change
+    model.encode_source(make_data(kps[1:], '1', ['s']))
+    target.update(make_data(kps[:1], '1', ['s']))
+    assert model.get_cache_keys('joint_1+joint_2', target) != keys_a
+    assert model.get_cache_keys('seg_cihp_1+joint_2', target) != keys_seg_a
+
+
+def test_target_keys_follow_pose_content():
+    model = make_model()
+    kps = torch.rand(3, 18, 2) * 8
+    model.encode_source(make_data(kps[:1], '1', ['s']))
+    # same pose under different ids hits, different poses under the same id do not
+    keys = model.get_cache_keys('joint_1+joint_2', make_data(torch.stack([kps[1], kps[1], kps[2]]), '2', ['a', 'b', 'a']))
+    assert keys[0] == keys[1]
+    assert keys[0] != keys[2]
+    # batched sources are keyed per sample
+    model.encode_source(make_data(kps, '1', ['s'] * 3))
+    keys = model.get_cache_keys('joint_1+joint_2', make_data(kps[:1].expand(3, 18, 2), '2', ['t'] * 3))
+    assert len(set(keys)) == 3
@@ -0,0 +1,171 @@
+'''
+Measure the memory / time trade-off of activation checkpointing in DualUnetGenerator_SEAN (--G_checkpoint_scales).
+For every image size and checkpointing configuration, runs generator training steps (forward + backward of an L1
+loss) on random inputs and prints a table of memory and step time, relative to the first configuration. Memory is the
+size of the activations kept for backward (measured on any device) and, on GPU, the peak allocated memory. The
+generator is built from the usual training options (--G_n_scale, --G_nf, --batch_size, ...). With
+--bench_memory_only 1, the activations are counted on fake tensors, without allocating them, on any machine.
+
+example:
+    python tools/benchmark_checkpointing.py --gpu_ids 0 --batch_size 4 --bench_sizes 256 512
+    python tools/benchmark_checkpointing.py --gpu_ids -1 --batch_size 4 --bench_sizes 256 512 --bench_memory_only 1
+'''
+from __future__ import division, print_function
+import sys
+sys.path.append('.')
+import time
+
+import torch
+import torch.nn as nn
+from torch.multiprocessing.reductions import StorageWeakRef
+
+from data.base_dataset import seg_label_to_map_tensor
+from models import SPG_net_deepfashion
+from models.pose_transfer_model import PoseTransferModel
+from options.pose_transfer_options import BenchmarkCheckpointingOptions
+
+
+def parse_scales(config, num_scales):
+    if config == 'none':
+        return []
+    if config == 'all':
+        return list(range(num_scales))
+    return [int(l) for l in config.split(',')]
+
+
+def train_step(netG, inputs):
+    netG.zero_grad()
+    out = netG(*inputs)
+    out.abs().mean().backward()
+
+
+def saved_activation_mb(netG, inputs):
+    '''
+    size of the tensors (unique storages, parameters excluded) that one forward pass keeps for backward. checkpointed
+    blocks only keep their inputs
+    '''
+    # storages are identified by StorageWeakRef, which also works for fake tensors (they have no data pointer)
+    params = set(StorageWeakRef(p.untyped_storage()).cdata for p in netG.parameters())
+    storages = {}
+
+    def pack(t):
+        storage = t.untyped_storage()
+        key = StorageWeakRef(storage).cdata
+        if key not in params:
+            storages[key] = storage.nbytes()
+        return t
+
+    netG.zero_grad()
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        out = netG(*inputs)
+    out.abs().mean().backward()
+    return sum(storages.values()) / 2.**20
+
+
+def measure(netG, inputs, opt):
+    '''
+    Output:
+        saved activations (MB), peak allocated memory (MB, None on cpu), seconds per training step (None with
+        --bench_memory_only)
+    '''
+    if opt.bench_memory_only:
+        return saved_activation_mb(netG, inputs), None, None
+    for _ in range(2):
+        train_step(netG, inputs)
+    saved = saved_activation_mb(netG, inputs)
+    if opt.gpu_ids:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    tic = time.time()
+    for _ in range(opt.bench_iters):
+        train_step(netG, inputs)
+    if opt.gpu_ids:
+        torch.cuda.synchronize()
+    step_time = (time.time() - tic) / opt.bench_iters
+    memory = torch.cuda.max_memory_allocated() / 2.**20 if opt.gpu_ids else None
+    return saved, memory, step_time
+
+
+def relative(value, base):
+    return '%+.0f%%' % (100. * (value / base - 1)) if value is not None and base is not None else '-'
+
+
+def mb(value):
+    return '%.0f' % value if value is not None else '-'
+
+
+def ms(value):
+    return '%.1f' % (value * 1e3) if value is not None else '-'
+
+
+parser = BenchmarkCheckpointingOptions()
+opt = parser.parse(display=False)
+device = torch.device('cuda' if opt.gpu_ids else 'cpu')
+if opt.bench_memory_only:
+    assert not opt.gpu_ids, 'fake tensors are created on cpu: use --gpu_ids -1 with --bench_memory_only 1'
+    from torch._subclasses.fake_tensor import FakeTensorMode
+    # every tensor created from here on (parameters, inputs, activations) is a fake tensor
+    FakeTensorMode().__enter__()
+
+# input dimensions as in PoseTransferModel (get_tensor_dim only reads opt and seg_cihp_nc)
+dims = PoseTransferModel()
+dims.opt, dims.seg_cihp_nc = opt, 20
+netG = SPG_net_deepfashion.DualUnetGenerator_SEAN(
+    pose_nc=dims.get_tensor_dim(opt.G_pose_type),
+    appearance_nc=dims.get_tensor_dim(opt.G_appearance_type),
+    output_nc=3,
+    nf=opt.G_nf,
+    max_nf=opt.G_max_nf,
+    num_scales=opt.G_n_scale,
+    num_warp_scales=opt.G_n_warp_scale,
+    n_residual_blocks=2,
+    norm=opt.G_norm,
+    vis_mode=opt.G_vis_mode,
+    activation=nn.LeakyReLU(0.1) if opt.G_activation == 'leaky_relu' else nn.ReLU(),
+    use_dropout=opt.use_dropout,
+    no_end_norm=opt.G_no_end_norm,
+    gpu_ids=opt.gpu_ids[:1],
+).train()
+if opt.gpu_ids:
+    netG.cuda()
+
+rows = []
+for size in opt.bench_sizes:
+    bsz = opt.batch_size
+    seg = lambda: seg_label_to_map_tensor(torch.randint(0, dims.seg_cihp_nc, (bsz, 1, size, size)),
+                                          nc=dims.seg_cihp_nc).to(device)
+    inputs = (torch.rand(bsz, netG.pose_nc, size, size, device=device),
+              torch.rand(bsz, netG.appearance_nc, size, size, device=device) * 2 - 1,
+              seg(), seg(),
+              torch.randn(bsz, 2, size, size, device=device) * 4 if opt.G_feat_warp else None,
+              torch.randint(0, 3, (bsz, 1, size, size), device=device).float() if opt.G_feat_warp else None)
+    base = None
+    for config in opt.bench_configs:
+        netG.checkpoint_scales = set(parse_scales(config, opt.G_n_scale))
+        try:
+            saved, memory, step_time = measure(netG, inputs, opt)
+            status = ''
+        except RuntimeError as e:
+            # a configuration that does not fit on the GPU is reported as such, the next ones may still fit
+            if 'out of memory' not in str(e):
+                raise
+            netG.zero_grad(set_to_none=True)
+            torch.cuda.empty_cache()
+            saved, memory, step_time = None, None, None
+            status = ' (out of memory)'
+        if base is None and saved is not None:
+            base = (saved, memory, step_time)
+        rows.append((size, config + status, saved, memory, step_time, base))
+        print('size %d, checkpoint scales %s: saved %s MB, peak %s MB, %s ms/step' % (
+            size, config + status, mb(saved), mb(memory), ms(step_time)))
+
+print('\nG_n_scale=%d, G_nf=%d, G_max_nf=%d, batch_size=%d, device=%s' % (
+    opt.G_n_scale, opt.G_nf, opt.G_max_nf, opt.batch_size, torch.cuda.get_device_name() if opt.gpu_ids else 'cpu'))
+print('| size | checkpoint scales | saved activations (MB) | vs. %s | peak memory (MB) | vs. %s | step time (ms) | vs. %s |'
+      % ((opt.bench_configs[0],) * 3))
+print('|---|---|---|---|---|---|---|---|')
+for size, config, saved, memory, step_time, base in rows:
+    base_saved, base_memory, base_time = base or (None, None, None)
+    print('| %d | %s | %s | %s | %s | %s | %s | %s |' % (
+        size, config, mb(saved), relative(saved, base_saved), mb(memory), relative(memory, base_memory),
+        ms(step_time), relative(step_time, base_time)))
@@ -0,0 +1,109 @@
+'''
+Pack the images, parsing labels and keypoints of one or more splits into a memory-mapped shard (see
+data/shard_store.py). Train / test with --dataset_type pose_transfer_parsing_personHD_shard to read samples from the
+shard instead of decoding jpg/png files.
+
+example:
+    python tools/build_shard.py --dataset_name personHD_2e5_front --for_train 1
+    python tools/build_shard.py --dataset_name personHD_2e5_front --for_train 0 --splits test --with_seg_pred 1
+'''
+from __future__ import division, print_function
+import os
+import sys
+sys.path.append('.')
+
+import numpy as np
+import torch
+import torch.utils.data
+import tqdm
+
+from data.pose_transfer_parsing_dataset_personHD import PoseTransferParsingDataset
+from data.shard_store import ShardStore
+from options.pose_transfer_options import BuildShardOptions
+import util.io as io
+
+
+class SampleDataset(torch.utils.data.Dataset):
+    '''
+    decode the samples with the readers of the file-based dataset, so both datasets return the same data.
+    '''
+    def __init__(self, source, ids):
+        self.source = source
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        sid = self.ids[index]
+        return {
+            'index': index,
+            'img': self.source.read_image_uint8(sid),
+            'seg': self.source.read_seg_cihp(sid)[..., 0].astype(np.uint8),
+            'joint': self.source.read_joint(sid).astype(np.float32),
+        }
+
+
+class SegPredDataset(torch.utils.data.Dataset):
+    def __init__(self, source, pairs):
+        self.source = source
+        self.pairs = pairs
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def __getitem__(self, index):
+        sid1, sid2 = self.pairs[index]
+        return {
+            'index': index,
+            'seg_pred': self.source.read_seg_pred_cihp(sid1, sid2)[..., 0].astype(np.uint8),
+        }
+
+
+parser = BuildShardOptions()
+opt = parser.parse()
+
+data_split = io.load_json(os.path.join(opt.data_root, opt.fn_split))
+splits = opt.splits if opt.splits is not None else list(data_split.keys())
+ids = []
+id_set = set()
+pairs = []
+pair_set = set()
+for split in splits:
+    for sid1, sid2 in data_split[split]:
+        # store samples in the order they are first used, so that pairs of a split are close in the file
+        for sid in (sid1, sid2):
+            if sid not in id_set:
+                id_set.add(sid)
+                ids.append(sid)
+        if (sid1, sid2) not in pair_set:
+            pair_set.add((sid1, sid2))
+            pairs.append((sid1, sid2))
+
+source = PoseTransferParsingDataset()
+source.opt = opt
+source.init_source(opt)
+
+shard_dir = os.path.join(opt.data_root, opt.shard_dir)
+store = ShardStore.create(shard_dir, ids, opt.image_size, joint_nc=opt.joint_nc,
+                          pairs=pairs if opt.with_seg_pred else None)
+print('pack %d samples / %d pairs (splits: %s) into %s' % (len(ids), len(pairs) if opt.with_seg_pred else 0,
+                                                          ', '.join(splits), shard_dir))
+
+h, w = opt.image_size
+loader = torch.utils.data.DataLoader(SampleDataset(source, ids), batch_size=32, shuffle=False,
+                                     num_workers=opt.n_workers)
+for data in tqdm.tqdm(loader, desc='Sample'):
+    assert data['img'].shape[1:3] == (h, w), 'image size %s does not match opt.image_size' % (data['img'].shape[1:3],)
+    rows = data['index'].numpy()
+    store.write('img', rows, data['img'].numpy())
+    store.write('seg', rows, data['seg'].numpy())
+    store.write('joint', rows, data['joint'].numpy())
+
+if opt.with_seg_pred:
+    loader = torch.utils.data.DataLoader(SegPredDataset(source, pairs), batch_size=32, shuffle=False,
+                                         num_workers=opt.n_workers)
+    for data in tqdm.tqdm(loader, desc='SegPred'):
+        store.write('seg_pred', data['index'].numpy(), data['seg_pred'].numpy())
+store.flush()
+print('done')
@@ -0,0 +1,121 @@
+'''
+Export the trained generator (netG) of a pose transfer model as TorchScript and ONNX (see models/SPG_net_export.py),
+and check that the exported artifacts reproduce the output of netG on random inputs.
+
+The checkpoint is read by the key-remapping loader of DualUnetGenerator_SEAN_Export. Export runs on CPU; use
+--flow_on_the_fly 0 to skip loading the flow network, which is not part of the exported generator.
+
+The exported generator keeps the learned ACE noise injection of netG by default. With --export_noise 0 it is
+deterministic (and the ONNX output can be checked), but it computes a different function from the trained netG: the
+drift from netG is printed, and serving outputs will differ from the ones of the training / test scripts.
+
+example:
+    python tools/export_generator.py --id personHD_2e5_front --which_epoch best --gpu_ids -1 --flow_on_the_fly 0
+outputs (in checkpoints/PoseTransfer_<id>/export/):
+    netG_<which_epoch>.pt     TorchScript, load with torch.jit.load
+    netG_<which_epoch>.onnx   ONNX, inputs x_p, x_a, s_seg, d_seg, flow, vis; output out (pre-tanh)
+'''
+from __future__ import division, print_function
+import os
+import sys
+sys.path.append('.')
+
+import torch
+
+from data.base_dataset import seg_label_to_map_tensor
+from models.pose_transfer_model import PoseTransferModel
+from models.SPG_net_export import DualUnetGenerator_SEAN_Export
+from options.pose_transfer_options import ExportGeneratorOptions
+
+
+def run(net, inputs, seed=0):
+    # the same seed gives the same ACE noise in eager mode and TorchScript
+    torch.manual_seed(seed)
+    with torch.no_grad():
+        return net(*inputs)
+
+
+def check_parity(name, out, ref, atol, failed):
+    diff = (out - ref).abs().max().item()
+    print('[parity] %s: max abs diff %.3e (atol %.1e) %s' % (name, diff, atol, 'OK' if diff <= atol else 'FAILED'))
+    if diff > atol:
+        failed.append(name)
+
+
+parser = ExportGeneratorOptions()
+opt = parser.parse(display=False)
+assert opt.which_model_G == 'dual_unet' and not opt.G_pix_warp, 'only the dual_unet generator can be exported'
+
+model = PoseTransferModel()
+model.initialize(opt)
+netG = model.netG.cpu().eval()
+export_dir = opt.export_dir or os.path.join(model.save_dir, 'export')
+if not os.path.exists(export_dir):
+    os.makedirs(export_dir)
+
+# export-ready generator, loaded from the checkpoint through the key-remapping loader
+netE = DualUnetGenerator_SEAN_Export(netG, feat_warp=bool(opt.G_feat_warp))
+fn_ckpt = os.path.join(model.save_dir, '%s_net_netG.pth' % opt.which_epoch)
+netE.load_generator_state_dict(torch.load(fn_ckpt, map_location=lambda storage, loc: storage))
+netE.eval()
+print('[export] loaded %s' % fn_ckpt)
+
+# random inputs
+bsz = opt.batch_size
+h, w = opt.image_size
+x_p = torch.rand(bsz, model.get_tensor_dim(opt.G_pose_type), h, w)
+x_a = torch.rand(bsz, model.get_tensor_dim(opt.G_appearance_type), h, w) * 2 - 1
+s_seg = seg_label_to_map_tensor(torch.randint(0, model.seg_cihp_nc, (bsz, 1, h, w)), nc=model.seg_cihp_nc)
+d_seg = seg_label_to_map_tensor(torch.randint(0, model.seg_cihp_nc, (bsz, 1, h, w)), nc=model.seg_cihp_nc)
+flow = torch.randn(bsz, 2, h, w) * 4
+vis = torch.randint(0, 3, (bsz, 1, h, w)).float()
+inputs = (x_p, x_a, s_seg, d_seg, flow, vis)
+input_names = ['x_p', 'x_a', 's_seg', 'd_seg', 'flow', 'vis']
+
+failed = []
+# conversion (with noise, which the original generator always adds)
+flow_in, vis_in = (flow, vis) if opt.G_feat_warp else (None, None)
+torch.manual_seed(0)
+with torch.no_grad():
+    ref = netG(x_p, x_a, s_seg, d_seg, flow_in, vis_in, single_device=True)
+check_parity('eager export model', run(netE, inputs), ref, opt.parity_atol, failed)
+
+netE.set_noise(bool(opt.export_noise))
+if not opt.export_noise:
+    # not a parity check: without noise the exported generator is a different function from netG
+    diff = (run(netE, inputs) - ref).abs()
+    print('[drift] noise-free export vs. netG: max abs diff %.3e, mean abs diff %.3e (pre-tanh output). serving '
+          'outputs differ from the ones of netG' % (diff.max().item(), diff.mean().item()))
+ref = run(netE, inputs)
+
+if 'torchscript' in opt.export_formats:
+    fn_ts = os.path.join(export_dir, 'netG_%s.pt' % opt.which_epoch)
+    torch.jit.script(netE).save(fn_ts)
+    print('[export] TorchScript: %s' % fn_ts)
+    check_parity('TorchScript', run(torch.jit.load(fn_ts), inputs), ref, opt.parity_atol, failed)
+
+if 'onnx' in opt.export_formats:
+    fn_onnx = os.path.join(export_dir, 'netG_%s.onnx' % opt.which_epoch)
+    torch.onnx.export(netE, inputs, fn_onnx, opset_version=opt.onnx_opset, input_names=input_names,
+                      output_names=['out'], dynamic_axes={k: {0: 'bsz'} for k in input_names + ['out']})
+    print('[export] ONNX: %s' % fn_onnx)
+    if opt.export_noise:
+        print('[parity] ONNX: skipped (the output is random with --export_noise 1)')
+    else:
+        try:
+            import onnxruntime
+        except ImportError:
+            onnxruntime = None
+            print('[parity] ONNX: skipped (onnxruntime is not installed)')
+        if onnxruntime is not None:
+            sess = onnxruntime.InferenceSession(fn_onnx, providers=['CPUExecutionProvider'])
+            # unused inputs (flow and vis without feature warping) are removed from the graph
+            feed = dict([(k, v.numpy()) for k, v in zip(input_names, inputs)])
+            feed = dict([(i.name, feed[i.name]) for i in sess.get_inputs()])
+            out = torch.from_numpy(sess.run(None, feed)[0])
+            check_parity('ONNX', out, ref, opt.parity_atol, failed)
+
+if failed:
+    print('parity check failed: %s' % ', '.join(failed))
+    sys.exit(1)
+print('done')
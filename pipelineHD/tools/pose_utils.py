@@ -1,7 +1,13 @@
+import os
+import sys
 import numpy as np
 from skimage.draw import circle, line_aa, polygon
 import json
 
+# the heatmap rendering is shared with the datasets (this module is also imported from tools/)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from data.base_dataset import GAUSSIAN_WINDOW, draw_keypoint_patches
+
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
@@ -46,13 +52,23 @@ def map_to_cord(pose_map, threshold=0.1):
 
 
 def cords_to_map(cords, img_size, sigma=6):
-    result = np.zeros(img_size + cords.shape[0:1], dtype='float32')
-    for i, point in enumerate(cords):
-        if point[0] == MISSING_VALUE or point[1] == MISSING_VALUE:
-            continue
-        xx, yy = np.meshgrid(np.arange(img_size[1]), np.arange(img_size[0]))
-        result[..., i] = np.exp(-((yy - point[0]) ** 2 + (xx - point[1]) ** 2) / (2 * sigma ** 2))
-    return result
+    '''
+    cords: (N,2) or (bsz,N,2) (y,x) cordinates
+    returns (h,w,N) or (bsz,h,w,N) gaussian maps. each keypoint is rendered only within the patch where exp() does not
+    round to 0 in float32 (see data.base_dataset.draw_keypoint_patches), so the result is the same as the dense
+    evaluation.
+    '''
+    cords = np.asarray(cords, dtype=np.float64)
+    batched = cords.ndim == 3
+    if not batched:
+        cords = cords[np.newaxis]
+    y, x = cords[..., 0], cords[..., 1]
+    valid = (y != MISSING_VALUE) & (x != MISSING_VALUE)
+    r2 = 2 * sigma ** 2
+    result = np.zeros((cords.shape[0],) + tuple(img_size) + cords.shape[1:2], dtype='float32')
+    draw_keypoint_patches(result, x, y, valid, np.sqrt(GAUSSIAN_WINDOW * r2),
+                          lambda dy2, dx2: np.exp(-dy2 / r2) * np.exp(-dx2 / r2))
+    return result if batched else result[0]
 
 
 def draw_pose_from_cords(pose_joints, img_size, radius=2, draw_joints=True):
@@ -0,0 +1,83 @@
+'''
+Run the pretrained flow network (netF) once over every pair of a split file and save flow / visibility to a
+memory-mapped store (see data/flow_store.py). Training and testing can then use the store with
+--flow_on_the_fly 0 instead of rerunning netF for every batch.
+
+example:
+    python tools/precompute_flow.py --dataset_name personHD_2e5_front --for_train 1 --gpu_ids 0
+'''
+from __future__ import division, print_function
+import os
+import sys
+sys.path.append('.')
+
+import numpy as np
+import torch
+import torch.utils.data
+import tqdm
+
+from data.base_dataset import kp_to_map
+from data.flow_store import FlowStore
+from data.pose_index import PairList, PoseLabel
+from models.pose_transfer_model import load_flow_network
+from options.pose_transfer_options import PrecomputeFlowOptions
+import util.io as io
+
+
+class JointPairDataset(torch.utils.data.Dataset):
+    '''
+    only renders the joint maps of a pair, which is all netF needs.
+    '''
+    def __init__(self, pairs, pose_label, opt):
+        self.pairs = pairs
+        self.pose_label = pose_label
+        self.opt = opt
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def __getitem__(self, index):
+        h, w = self.opt.image_size
+        data = {'index': index}
+        for i, sid in enumerate(self.pairs[index]):
+            joint = kp_to_map(img_sz=(w, h), kps=np.array(self.pose_label[sid]), mode=self.opt.joint_mode,
+                              radius=self.opt.joint_radius)
+            data['joint_%d' % (i + 1)] = torch.Tensor(joint.transpose((2, 0, 1)))
+        return data
+
+
+parser = PrecomputeFlowOptions()
+opt = parser.parse()
+
+data_split = io.load_json(os.path.join(opt.data_root, opt.fn_split))
+pose_label = PoseLabel(io.load_data(os.path.join(opt.data_root, opt.fn_pose)))
+splits = opt.splits if opt.splits is not None else list(data_split.keys())
+pairs = []
+pair_set = set()
+for split in splits:
+    for sid1, sid2 in data_split[split]:
+        if (sid1, sid2) not in pair_set:
+            pair_set.add((sid1, sid2))
+            pairs.append((sid1, sid2))
+
+store_dir = os.path.join(opt.data_root, opt.flow_store_dir)
+store = FlowStore.create(store_dir, pairs, opt.image_size)
+print('precompute flow of %d pairs (splits: %s) into %s' % (len(pairs), ', '.join(splits), store_dir))
+
+netF = load_flow_network(opt.pretrained_flow_id, opt.pretrained_flow_epoch, opt.gpu_ids)
+netF.eval()
+device = torch.device('cuda' if opt.gpu_ids else 'cpu')
+loader = torch.utils.data.DataLoader(JointPairDataset(PairList(pairs), pose_label, opt), batch_size=opt.batch_size,
+                                     shuffle=False, num_workers=opt.n_workers)
+
+flow_scale = 20.
+with torch.no_grad():
+    for data in tqdm.tqdm(loader, desc='Flow'):
+        input_F = torch.cat([data[item].to(device) for item in opt.F_input_type.split('+')], dim=1)
+        flow_out, vis_out, _, _ = netF(input_F)
+        # same post-processing as PoseTransferModel.forward with flow_on_the_fly=1
+        vis_out = vis_out.argmax(dim=1, keepdim=True).float()
+        flow_out = flow_out * flow_scale * (vis_out < 2).float()
+        store.write(data['index'].numpy(), flow_out.cpu().numpy(), vis_out.cpu().numpy())
+store.flush()
+print('done')
@@ -0,0 +1,94 @@
+'''
+Build cropped and resized image / parsing / pose-label sets (e.g. 256x256 or 512x512) from the raw PersonHD release
+(1520x880 frames). By default the whole frame is resized to the output size (anisotropically, like the existing
+preprocessed sets and pose labels); --crop center keeps the aspect ratio instead. Frames are processed in parallel; frames whose outputs already exist are skipped, so an interrupted
+run can be restarted with the same command.
+
+Output:
+    dst_dir/img/<sid>.jpg
+    dst_dir/seg/<sid>.png
+    dst_dir/pose.pkl      {sid: [[x, y], ...]} keypoints in output pixel cordinates, -1 for missing ones
+
+example:
+    python tools/preprocess_personHD.py --src_img_dir raw/train --src_seg_dir raw/train-mask \
+        --src_pose raw/image_cropped_front_train.pkl --dst_dir resize512/train --size 512 512 --n_workers 16
+'''
+from __future__ import division, print_function
+import argparse
+import multiprocessing
+import os
+import sys
+sys.path.append('.')
+
+import cv2
+import numpy as np
+import tqdm
+
+from data.base_dataset import full_frame_box, center_crop_box, reduced_decode_factor, read_crop_resize, crop_resize_keypoints
+import util.io as io
+
+
+def write_atomic(fn, img, params=None):
+    # write to a temporary file first, so that an interrupted run never leaves a truncated output behind
+    root, ext = os.path.splitext(fn)
+    fn_tmp = root + '.tmp' + ext
+    cv2.imwrite(fn_tmp, img, params or [])
+    os.replace(fn_tmp, fn)
+
+
+def process_frame(job):
+    sid, box, factor, args = job
+    fn_img = os.path.join(args.dst_dir, 'img', sid + '.jpg')
+    fn_seg = os.path.join(args.dst_dir, 'seg', sid + '.png')
+    if not os.path.isfile(fn_img):
+        img = read_crop_resize(os.path.join(args.src_img_dir, sid + '.jpg'), box, args.size, color=True,
+                               factor=factor)
+        write_atomic(fn_img, img, [cv2.IMWRITE_JPEG_QUALITY, args.jpeg_quality])
+    if args.src_seg_dir and not os.path.isfile(fn_seg):
+        seg = read_crop_resize(os.path.join(args.src_seg_dir, sid + '.png'), box, args.size, color=False)
+        write_atomic(fn_seg, seg)
+    return sid
+
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--src_img_dir', type=str, required=True, help='raw frames (<sid>.jpg)')
+parser.add_argument('--src_seg_dir', type=str, default=None, help='raw parsing labels (<sid>.png)')
+parser.add_argument('--src_pose', type=str, required=True, help='pose label file of the raw frames (pickled {sid: [[x, y], ...]})')
+parser.add_argument('--dst_dir', type=str, required=True)
+parser.add_argument('--size', type=int, nargs=2, default=[256, 256], help='output (h, w)')
+parser.add_argument('--crop', type=str, nargs='+', default=None, help='"center" for the largest centered box with the aspect ratio of --size (cuts off the top and bottom of portrait frames), or a crop box x0 y0 x1 y1 in raw pixels. default: whole frame')
+parser.add_argument('--jpeg_quality', type=int, default=95)
+parser.add_argument('--n_workers', type=int, default=8)
+args = parser.parse_args()
+
+pose_label = io.load_data(args.src_pose)
+sids = sorted([fn[:-4] for fn in os.listdir(args.src_img_dir) if fn.endswith('.jpg') and not fn.endswith('.tmp.jpg')])
+src_size = cv2.imread(os.path.join(args.src_img_dir, sids[0] + '.jpg')).shape[0:2]
+if args.crop is None:
+    box = full_frame_box(src_size)
+elif args.crop == ['center']:
+    box = center_crop_box(src_size, args.size)
+elif len(args.crop) == 4:
+    box = tuple(int(v) for v in args.crop)
+else:
+    parser.error('--crop takes "center" or x0 y0 x1 y1')
+factor = reduced_decode_factor(box, args.size)
+print('%d frames of size %s: crop %s, decode at 1/%d, resize to %s' % (len(sids), src_size, box, factor, args.size))
+
+io.mkdir_if_missing(os.path.join(args.dst_dir, 'img'))
+if args.src_seg_dir:
+    io.mkdir_if_missing(os.path.join(args.dst_dir, 'seg'))
+
+pool = multiprocessing.Pool(args.n_workers)
+jobs = [(sid, box, factor, args) for sid in sids]
+for _ in tqdm.tqdm(pool.imap_unordered(process_frame, jobs, chunksize=16), total=len(jobs), desc='Frame'):
+    pass
+pool.close()
+pool.join()
+
+# keypoints are cheap to map, so the label file is always rebuilt from scratch
+pose_out = {}
+for sid, kps in pose_label.items():
+    pose_out[sid] = np.round(crop_resize_keypoints(kps, box, args.size)).astype(np.int64).tolist()
+io.save_data(pose_out, os.path.join(args.dst_dir, 'pose.pkl'))
+print('done')
@@ -0,0 +1,110 @@
+'''
+Quantize netG (and netF) of a trained pose transfer model to int8 for CPU inference (see models/quantization.py),
+and compare the int8 model with the float32 one on test pairs: quality against the target images, drift of the int8
+output from the float32 output (SSIM, PSNR and, if the lpips package is installed, LPIPS) and throughput.
+
+The first --n_calib_pairs pairs of the test split calibrate the activation ranges, the next --n_eval_pairs pairs are
+used for the comparison. Runs on CPU only.
+
+example:
+    python tools/quantize_generator.py --id personHD_2e5_front --which_epoch best --gpu_ids -1 --batch_size 8
+'''
+from __future__ import division, print_function
+import sys
+sys.path.append('.')
+import itertools
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import tqdm
+
+from data.data_loader import CreateDataLoader
+from models.pose_transfer_model import PoseTransferModel
+from models.quantization import quantize_pose_transfer_model
+from options.pose_transfer_options import QuantizeGeneratorOptions
+from util.loss_buffer import LossBuffer
+from util.visualizer import Visualizer
+
+try:
+    import lpips
+except ImportError:
+    lpips = None
+
+
+def run_test(model, nets, data, seed):
+    '''
+    model.test() with the given (netG, netF). the same seed gives the same ACE noise for float32 and int8.
+    Output:
+        img_out, seconds
+    '''
+    model.netG, netF = nets
+    if netF is not None:
+        model.netF = netF
+    model.set_input(data)
+    torch.manual_seed(seed)
+    tic = time.time()
+    model.test(compute_loss=False)
+    return model.output['img_out'], time.time() - tic
+
+
+parser = QuantizeGeneratorOptions()
+opt = parser.parse(display=False)
+assert not opt.gpu_ids, 'quantized networks only run on CPU: use --gpu_ids -1'
+if opt.n_threads > 0:
+    torch.set_num_threads(opt.n_threads)
+
+model = PoseTransferModel()
+model.initialize(opt)
+model.netG.eval()
+if opt.flow_on_the_fly:
+    model.netF.eval()
+val_loader = CreateDataLoader(opt, split='test')
+n_calib_batch = int(np.ceil(1.0 * opt.n_calib_pairs / opt.batch_size))
+n_eval_batch = int(np.ceil(1.0 * opt.n_eval_pairs / opt.batch_size))
+assert n_calib_batch + n_eval_batch <= len(val_loader), 'the test split has only %d batches' % len(val_loader)
+batches = iter(val_loader)
+
+# quantize
+calib_data = tqdm.tqdm(itertools.islice(batches, n_calib_batch), total=n_calib_batch, desc='Calibrate')
+float_nets = quantize_pose_transfer_model(model, calib_data, quantize_flow=bool(opt.quantize_flow),
+                                          backend=opt.quant_backend)
+quant_nets = (model.netG, getattr(model, 'netF', None))
+
+# compare
+lpips_net = lpips.LPIPS(net='alex') if lpips is not None else None
+loss_buffer = LossBuffer(size=n_eval_batch)
+total_time = {'fp32': 0., 'int8': 0.}
+with torch.no_grad():
+    for i, data in enumerate(tqdm.tqdm(itertools.islice(batches, n_eval_batch), total=n_eval_batch, desc='Evaluate')):
+        out_fp32, t = run_test(model, float_nets, data, seed=i)
+        total_time['fp32'] += t
+        out_int8, t = run_test(model, quant_nets, data, seed=i)
+        total_time['int8'] += t
+        img_tar = model.output['img_tar']
+        errors = OrderedDict([
+            ('SSIM_fp32', model.crit_ssim(out_fp32, img_tar)),
+            ('SSIM_int8', model.crit_ssim(out_int8, img_tar)),
+            ('PSNR_fp32', model.crit_psnr(out_fp32, img_tar)),
+            ('PSNR_int8', model.crit_psnr(out_int8, img_tar)),
+            # drift of int8 from fp32
+            ('SSIM_drift', model.crit_ssim(out_int8, out_fp32)),
+            ('PSNR_drift', model.crit_psnr(out_int8, out_fp32)),
+        ])
+        if lpips_net is not None:
+            errors['LPIPS_fp32'] = lpips_net(out_fp32, img_tar).mean()
+            errors['LPIPS_int8'] = lpips_net(out_int8, img_tar).mean()
+            errors['LPIPS_drift'] = lpips_net(out_int8, out_fp32).mean()
+        loss_buffer.add(errors)
+
+n_image = n_eval_batch * opt.batch_size
+test_error = loss_buffer.get_errors()
+for k in ['fp32', 'int8']:
+    test_error['img_per_sec_%s' % k] = n_image / total_time[k]
+test_error['speedup'] = total_time['fp32'] / total_time['int8']
+if lpips_net is None:
+    print('lpips is not installed: LPIPS is not reported')
+info = OrderedDict([('model_id', opt.id), ('epoch', opt.which_epoch), ('threads', torch.get_num_threads()),
+                    ('quantize_flow', opt.quantize_flow and opt.flow_on_the_fly)])
+print(Visualizer(opt).log(info, test_error, log_in_file=False))
@@ -0,0 +1,80 @@
+from __future__ import division
+
+import os
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+#####################################
+# DistributedDataParallel helpers
+#####################################
+# processes are started by torchrun, which sets RANK, LOCAL_RANK, WORLD_SIZE, MASTER_ADDR and MASTER_PORT:
+#   torchrun --nproc_per_node 4 scripts/train_pose_transfer_model.py --distributed 1 --gpu_ids 0,1,2,3 ...
+# each process drives the gpu of its local rank (see BaseOptions.auto_set). with --gpu_ids -1, the processes run on
+# CPU and communicate through gloo, e.g. to test the multi-process path on one machine:
+#   torchrun --nproc_per_node 2 scripts/train_pose_transfer_model.py --distributed 1 --gpu_ids -1 ...
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    '''
+    rank of this process. before the process group is initialized, the rank set by the launcher (0 if none)
+    '''
+    if is_distributed():
+        return dist.get_rank()
+    return int(os.environ.get('RANK', 0))
+
+
+def get_world_size():
+    if is_distributed():
+        return dist.get_world_size()
+    return int(os.environ.get('WORLD_SIZE', 1))
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def init_distributed(opt):
+    '''
+    join the process group of the launcher. backend: opt.dist_backend, or nccl on GPU and gloo on CPU
+    '''
+    backend = opt.dist_backend or ('nccl' if opt.gpu_ids else 'gloo')
+    dist.init_process_group(backend=backend, init_method='env://')
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def broadcast_module(module, src=0):
+    '''
+    copy the parameters and buffers of a module from rank src to all processes (in place)
+    '''
+    if is_distributed():
+        for t in module.state_dict().values():
+            dist.broadcast(t, src)
+
+
+def all_reduce_errors(errors, count):
+    '''
+    average metrics over all processes.
+    Input:
+        errors: OrderedDict of per-process averages (e.g. LossBuffer.get_errors())
+        count: number of values averaged by this process
+    Output:
+        errors: OrderedDict of averages over the values of all processes, identical on all ranks
+    '''
+    if not is_distributed():
+        return errors
+    keys = list(errors.keys())
+    device = 'cuda' if dist.get_backend() == 'nccl' else 'cpu'
+    t = torch.tensor([float(errors[k]) * count for k in keys] + [count], dtype=torch.float64, device=device)
+    dist.all_reduce(t)
+    t = t.cpu()
+    return OrderedDict([(k, np.float64(t[i].item() / t[-1].item())) for i, k in enumerate(keys)])
@@ -1,6 +1,7 @@
 from __future__ import division
 
 import numpy as np
+import torch
 from collections import OrderedDict
 
 class LossBuffer():
@@ -26,6 +27,11 @@ class LossBuffer():
     def get_errors(self, clear=True):
         errors = OrderedDict()
         for k, buff in self.buffer.items():
-            errors[k] = np.mean(buff[-self.size::])
+            buff = buff[-self.size::]
+            if buff and torch.is_tensor(buff[0]):
+                # metrics kept on the device: one synchronization for the whole buffer
+                errors[k] = np.float64(torch.stack([v.float().view(-1).mean() for v in buff]).mean().item())
+            else:
+                errors[k] = np.mean(buff)
         # print('[loss buffer] length: %d'%(len(buff[-self.size::])))
         return errors
@@ -0,0 +1,155 @@
+from __future__ import division
+
+import hashlib
+import multiprocessing
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+class LRUCache():
+    '''
+    least-recently-used cache with hit/miss counters.
+    '''
+
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.data = OrderedDict()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.data.clear()
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key):
+        if key in self.data:
+            self.hits += 1
+            self.data.move_to_end(key)
+            return self.data[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.capacity:
+            self.data.popitem(last=False)
+
+    def get_stats(self):
+        total = self.hits + self.misses
+        return OrderedDict([
+            ('hits', self.hits),
+            ('misses', self.misses),
+            ('hit_rate', 1.0 * self.hits / total if total > 0 else 0.),
+            ('size', len(self.data)),
+        ])
+
+
+def tensor_hash(x):
+    '''
+    content hash of a tensor (used as cache key)
+    '''
+    return hashlib.sha1(x.detach().cpu().contiguous().numpy().tobytes()).hexdigest()
+
+
+class SharedArrayCache():
+    '''
+    least-recently-used cache of fixed-shape uint8 arrays (e.g. decoded images) in shared memory, with a byte budget.
+    Create it in the main process before the DataLoader workers start: all workers then look up and fill the same
+    slots, and hit/miss counters are shared, so get_stats() in the main process covers every worker. arrays of another
+    shape or dtype are not cached; they are counted as rejected in get_stats().
+    '''
+
+    def __init__(self, n_bytes, shape):
+        self.shape = tuple(shape)
+        self.n_slot = max(int(n_bytes // int(np.prod(self.shape))), 0)
+        self.data = torch.zeros((self.n_slot,) + self.shape, dtype=torch.uint8).share_memory_()
+        # key hash of each slot (-1 for empty) and the clock value of its last use
+        self.keys = torch.full((self.n_slot,), -1, dtype=torch.int64).share_memory_()
+        self.last_used = torch.zeros(self.n_slot, dtype=torch.int64).share_memory_()
+        # clock, hits, misses, rejected puts
+        self.counters = torch.zeros(4, dtype=torch.int64).share_memory_()
+        self.lock = multiprocessing.Lock()
+
+    @staticmethod
+    def key_hash(key):
+        # stable across processes (unlike hash()), non-negative so that -1 can mark empty slots
+        return int(hashlib.sha1(key.encode('utf-8')).hexdigest()[:15], 16)
+
+    def _find(self, k):
+        idx = (self.keys == k).nonzero()
+        return idx[0, 0].item() if len(idx) > 0 else -1
+
+    def get(self, key):
+        k = self.key_hash(key)
+        with self.lock:
+            i = self._find(k)
+            if i < 0:
+                self.counters[2] += 1
+                return None
+            self.counters[0] += 1
+            self.counters[1] += 1
+            self.last_used[i] = self.counters[0]
+            return self.data[i].numpy().copy()
+
+    def put(self, key, value):
+        if self.n_slot == 0:
+            return
+        if value.shape != self.shape or value.dtype != np.uint8:
+            # e.g. images whose size is not opt.image_size. counted, so that a 0% hit rate can be told apart from a
+            # cache that is too small
+            with self.lock:
+                self.counters[3] += 1
+            return
+        k = self.key_hash(key)
+        with self.lock:
+            if self._find(k) >= 0:
+                # filled by another worker in the meantime
+                return
+            # empty slots have last_used == 0 and are taken first
+            i = self.last_used.argmin().item()
+            self.keys[i] = k
+            self.data[i].copy_(torch.from_numpy(np.ascontiguousarray(value)))
+            self.counters[0] += 1
+            self.last_used[i] = self.counters[0]
+
+    def fetch(self, key, load):
+        '''
+        cached value of key, or load() it and cache the result
+        '''
+        value = self.get(key)
+        if value is None:
+            value = load()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.keys.fill_(-1)
+            self.last_used.zero_()
+            self.counters.zero_()
+
+    def reset_stats(self):
+        with self.lock:
+            self.counters[1:] = 0
+
+    def get_stats(self):
+        hits, misses = self.counters[1].item(), self.counters[2].item()
+        total = hits + misses
+        return OrderedDict([
+            ('hits', hits),
+            ('misses', misses),
+            ('hit_rate', 1.0 * hits / total if total > 0 else 0.),
+            ('rejected', self.counters[3].item()),
+            ('size', int((self.keys >= 0).sum().item())),
+            ('capacity', self.n_slot),
+            ('mbytes', self.data.numel() / 2.**20),
+        ])
+